@@ -1,26 +1,41 @@
-from google import genai
-from google.genai import types
-from PIL import Image
-from io import BytesIO
-from flask import Flask, jsonify, request
+from flask import Flask, Response, g, jsonify, request, stream_with_context
 import os
-from pydub import AudioSegment
-from google.cloud import texttospeech
-from moviepy.editor import ImageSequenceClip, AudioFileClip
-import numpy as np
-from google.cloud import secretmanager
+import json
+import math
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
 import firebase_admin
 from firebase_admin import storage,credentials,firestore
 from flask_cors import CORS
 from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+from pipeline import Pipeline
+from jobs import JobStore, JobQueue
+from cache import ResultCache, make_key
+from catalog import VideoCatalog
+from views import ViewCounter
+from video_store import VideoStore, to_video, public_fields
+from encoder import SlideshowStream, encode_segment, encode_poster, POSTER_FORMATS
+from media import MediaWorkspace, image_extension
+from audio import concat_mp3, mp3_duration
+from hls import HlsPlaylist
+from chat_sessions import ChatSessionManager
+from curriculum import CurriculumSnapshot
+from image_library import ImageLibrary
+from http_cache import ResponseCache
+from gateway import ModelGateway, is_retryable
+from priority import BATCH, UPGRADE, PriorityGate
+from services import ServiceRegistry
+from contextlib import nullcontext
+from telemetry import metrics, span, bind, start_trace, end_trace, current_request_id, count_firestore, profiled
+import atexit
 load_dotenv()
 
-# Initialize the credentials
-cred = credentials.Certificate("service.json")
-# Initialize the app with the credentials, and the storage bucket
-firebase_admin.initialize_app(cred,{'storageBucket': os.getenv('BUCKET_ID')})
-# Initialize Firestore DB
-db = firestore.client()
 # Initialize the path to the current directory
 script_dir = os.path.dirname(__file__)
 
@@ -33,6 +48,7 @@ def get_secret(secret_name:str):
     Returns:
         str: The value of the secret
     '''
+    from google.cloud import secretmanager
 
     client = secretmanager.SecretManagerServiceClient()
     project_id = "edith-454415"
@@ -40,13 +56,209 @@ def get_secret(secret_name:str):
     response = client.access_secret_version(request={"name": secret_path})
     return response.payload.data.decode("UTF-8")
 
-# Get the API key from the Secret Manager
-api_key = get_secret("my-api-key")
-n = len(api_key)
-api_key = api_key[4:n-4]
-
-# Initialize the client
-client = genai.Client(api_key=api_key)
+def create_firebase_app():
+    '''Initialize the Firebase app with the credentials and the storage bucket'''
+    cred = credentials.Certificate("service.json")
+    return firebase_admin.initialize_app(cred,{'storageBucket': os.getenv('BUCKET_ID')})
+
+def create_db():
+    '''Create the Firestore client of the Firebase app'''
+    return firestore.client(services.get('firebase'))
+
+def create_bucket():
+    '''Get the storage bucket of the Firebase app'''
+    return storage.bucket(app=services.get('firebase'))
+
+def create_genai_client():
+    '''Create the Gemini client with the API key from the Secret Manager'''
+    from google import genai
+
+    # Get the API key from the Secret Manager
+    api_key = get_secret("my-api-key")
+    n = len(api_key)
+    api_key = api_key[4:n-4]
+    return genai.Client(api_key=api_key)
+
+def create_tts_client():
+    '''Create the Text-to-Speech client'''
+    from google.cloud import texttospeech
+
+    return texttospeech.TextToSpeechClient()
+
+# Clients are created on first use, then shared by every request and job thread
+services = ServiceRegistry()
+services.register('firebase', create_firebase_app)
+services.register('db', create_db)
+services.register('bucket', create_bucket)
+services.register('genai', create_genai_client)
+services.register('tts', create_tts_client)
+
+def get_db():
+    return services.get('db')
+
+def get_bucket():
+    return services.get('bucket')
+
+def get_client():
+    return services.get('genai')
+
+def get_tts_client():
+    return services.get('tts')
+
+# Keep one document per video in the users/{user_id}/videos subcollections
+video_store = VideoStore(get_db)
+
+# Maximum number of Imagen requests in flight for a single video
+IMAGE_CONCURRENCY = int(os.getenv('IMAGE_CONCURRENCY', 4))
+# Number of attempts for each prompt before the image stage gives up
+IMAGE_ATTEMPTS = int(os.getenv('IMAGE_ATTEMPTS', 3))
+# Number of background video jobs that run at the same time
+VIDEO_WORKERS = int(os.getenv('VIDEO_WORKERS', 2))
+# Path of the SQLite database the background video jobs are persisted in
+JOBS_DB = os.getenv('JOBS_DB', os.path.join(script_dir, 'jobs.db'))
+# Directory the images and voice of drafts are kept in until their upgrade jobs have run,
+# next to the job database so they last exactly as long as the jobs do
+UPGRADE_DIR = os.getenv('UPGRADE_DIR', os.path.join(os.path.dirname(os.path.abspath(JOBS_DB)), 'upgrades'))
+
+# Number of live chat sessions kept in memory, the seconds an idle one is kept,
+# and the number of most recent turns kept in a persisted history
+CHAT_MAX_SESSIONS = int(os.getenv('CHAT_MAX_SESSIONS', 256))
+CHAT_IDLE_TIMEOUT = float(os.getenv('CHAT_IDLE_TIMEOUT', 1800))
+CHAT_MAX_TURNS = int(os.getenv('CHAT_MAX_TURNS', 40))
+
+# Bump when a change to the prompts or rendering makes cached results stale
+PIPELINE_VERSION = '2'
+# The models and voice the cached results were generated with
+TEXT_MODEL = 'gemini-2.0-flash'
+# Ask for the answer, the title and the image prompts in one structured request instead of three
+STRUCTURED_SCRIPT = os.getenv('STRUCTURED_SCRIPT', '1') == '1'
+SCRIPT_MODE = 'structured' if STRUCTURED_SCRIPT else 'separate'
+IMAGE_MODEL = 'imagen-3.0-generate-002'
+# Shape of the generated images, it matches the frame size of the encoder presets
+IMAGE_ASPECT_RATIO = os.getenv('IMAGE_ASPECT_RATIO', '16:9')
+# Similarity of the words of two image prompts from which a stored image is reused, 1 only reuses identical prompts
+IMAGE_REUSE_THRESHOLD = float(os.getenv('IMAGE_REUSE_THRESHOLD', 0.8))
+# Size of the library of generated images, 0 entries disables the reuse
+IMAGE_LIBRARY_ENTRIES = int(os.getenv('IMAGE_LIBRARY_ENTRIES', 512))
+IMAGE_LIBRARY_MB = int(os.getenv('IMAGE_LIBRARY_MB', 96))
+# Requests per minute allowed to each model, and the most requests in flight per model
+TEXT_MODEL_RPM = float(os.getenv('TEXT_MODEL_RPM', 1000))
+IMAGE_MODEL_RPM = float(os.getenv('IMAGE_MODEL_RPM', 60))
+MODEL_CONCURRENCY = int(os.getenv('MODEL_CONCURRENCY', 16))
+# Number of times a model request that failed with a retryable error is sent
+MODEL_ATTEMPTS = int(os.getenv('MODEL_ATTEMPTS', 4))
+VOICE_LANGUAGE = os.getenv('VOICE_LANGUAGE', 'en-US')
+VOICE_GENDER = os.getenv('VOICE_GENDER', 'NEUTRAL')
+# Maximum number of sentences synthesized at the same time
+TTS_CONCURRENCY = int(os.getenv('TTS_CONCURRENCY', 4))
+# The encoder preset used for the published videos, see encoder.ENCODER_PRESETS
+ENCODER_PRESET = os.getenv('ENCODER_PRESET', 'final')
+# Publish a cheap draft first and replace it with an ENCODER_PRESET encode in the background
+DRAFT_RENDER = os.getenv('DRAFT_RENDER', '1') == '1'
+DRAFT_PRESET = os.getenv('DRAFT_PRESET', 'draft')
+# Directory the per-job scratch directories are created in, defaults to the system temp directory
+SCRATCH_ROOT = os.getenv('SCRATCH_ROOT') or None
+# Size of each chunk of the resumable video upload, a multiple of 256 KiB
+UPLOAD_CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE', 4 * 1024 * 1024))
+# Longest expected HLS segment in seconds, one segment is one sentence
+HLS_TARGET_DURATION = int(os.getenv('HLS_TARGET_DURATION', 30))
+# Format and width of the poster still of every video, see encoder.POSTER_FORMATS
+POSTER_FORMAT = os.getenv('POSTER_FORMAT', 'webp')
+POSTER_WIDTH = int(os.getenv('POSTER_WIDTH', 320))
+# Most TTS requests and encodes in flight across every video, interactive work is admitted first
+TTS_MAX_IN_FLIGHT = int(os.getenv('TTS_MAX_IN_FLIGHT', 16))
+ENCODE_MAX_IN_FLIGHT = int(os.getenv('ENCODE_MAX_IN_FLIGHT', os.cpu_count() or 2))
+# Owner of the videos generated ahead of time for the learning paths
+LIBRARY_USER_ID = os.getenv('LIBRARY_USER_ID', 'edith-library')
+# UTC hours during which off-peak batches start, as "start-end", empty to start them straight away
+BATCH_WINDOW = os.getenv('BATCH_WINDOW', '1-6')
+# Most batch jobs and draft upgrades running at once, the other video workers stay free for interactive jobs
+BATCH_WORKERS = int(os.getenv('BATCH_WORKERS', 1))
+# Most questions accepted in one batch
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', 500))
+
+# Every Gemini and Imagen request goes through the gateway, which shares the quota between requests
+gateway = ModelGateway(
+    get_client,
+    rates={TEXT_MODEL: TEXT_MODEL_RPM / 60, IMAGE_MODEL: IMAGE_MODEL_RPM / 60},
+    max_concurrency=MODEL_CONCURRENCY,
+    max_attempts=MODEL_ATTEMPTS,
+)
+# Generated images, reused for prompts that ask for nearly the same picture
+image_library = ImageLibrary(threshold=IMAGE_REUSE_THRESHOLD, max_entries=IMAGE_LIBRARY_ENTRIES, max_bytes=IMAGE_LIBRARY_MB * 1024 * 1024)
+metrics.add_gauges(image_library.gauges)
+# Text-to-Speech and the encoder are shared the same way, batch work only takes what requests leave
+speech_gate = PriorityGate(TTS_MAX_IN_FLIGHT)
+encode_gate = PriorityGate(ENCODE_MAX_IN_FLIGHT)
+
+# Cache of pipeline results, kept in memory with a disk tier behind it. Both tiers are
+# bounded in MiB, the default directory is memory-backed on App Engine and Cloud Run
+result_cache = ResultCache(
+    max_entries=int(os.getenv('CACHE_ENTRIES', 64)),
+    ttl=float(os.getenv('CACHE_TTL', 7 * 24 * 3600)),
+    directory=os.getenv('CACHE_DIR', os.path.join(tempfile.gettempdir(), 'edith-cache')),
+    max_disk_entries=int(os.getenv('CACHE_DISK_ENTRIES', 512)),
+    max_bytes=int(os.getenv('CACHE_MEMORY_MB', 32)) * 1024 * 1024,
+    max_disk_bytes=int(os.getenv('CACHE_DISK_MB', 64)) * 1024 * 1024,
+)
+metrics.add_gauges(result_cache.gauges)
+
+# Local copy of the video catalog snapshot, lets a restarted process skip the full collection scan
+CATALOG_PATH = os.getenv('CATALOG_PATH', os.path.join(script_dir, 'catalog.json'))
+# Storage object the snapshot is shared through, new instances start from a fresh filesystem, empty to disable
+CATALOG_BLOB = os.getenv('CATALOG_BLOB', 'snapshots/catalog.json')
+# Age in seconds of the Firestore scan behind a snapshot after which the snapshot is ignored
+CATALOG_MAX_AGE = float(os.getenv('CATALOG_MAX_AGE', 3600))
+# Seconds between snapshot writes of a changed catalog
+CATALOG_SAVE_INTERVAL = float(os.getenv('CATALOG_SAVE_INTERVAL', 60))
+# Seconds between full rescans of the video documents, which pick up what other instances wrote
+CATALOG_REBUILD_INTERVAL = float(os.getenv('CATALOG_REBUILD_INTERVAL', 600))
+# Follow the video documents so videos written by other instances show up straight away
+CATALOG_LISTENER = os.getenv('CATALOG_LISTENER', '0') == '1'
+
+# Size of the cache of encoded listing responses, and the smallest body worth compressing
+RESPONSE_CACHE_MB = int(os.getenv('RESPONSE_CACHE_MB', 32))
+COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', 1024))
+response_cache = ResponseCache(max_bytes=RESPONSE_CACHE_MB * 1024 * 1024, min_size=COMPRESS_MIN_BYTES)
+
+# Number of videos on a page of the trending feed, and the most a client may ask for
+FEED_PAGE_SIZE = int(os.getenv('FEED_PAGE_SIZE', 25))
+FEED_MAX_LIMIT = int(os.getenv('FEED_MAX_LIMIT', 100))
+
+# Index of every video by title and views, used by the search and listing endpoints
+catalog = VideoCatalog()
+# Set once the catalog has been built, it is built by the first request that needs it
+catalog_ready = threading.Event()
+catalog_lock = threading.Lock()
+# Set once the listener has delivered its first snapshot, which only repeats what the catalog holds
+catalog_listening = threading.Event()
+
+# Create the clients and build the catalog in the background as soon as the instance starts
+WARMUP_ON_START = os.getenv('WARMUP_ON_START', '0') == '1'
+# Also import the image and encoding libraries during the warm-up
+WARMUP_RENDER = os.getenv('WARMUP_RENDER', '0') == '1'
+
+# Seconds after which the learning paths are refetched in the background
+CURRICULUM_TTL = float(os.getenv('CURRICULUM_TTL', 3600))
+# Follow the domain documents so an edited learning path shows up straight away
+CURRICULUM_LISTENER = os.getenv('CURRICULUM_LISTENER', '0') == '1'
+
+# The learning-path tree served by /get_path, serialized the same way jsonify would
+curriculum = CurriculumSnapshot(
+    lambda: get_db().collection('domains'),
+    dumps=lambda tree: app.json.dumps(tree),
+    ttl=CURRICULUM_TTL,
+    listen=CURRICULUM_LISTENER,
+)
+
+# Sample the stacks of every thread while a video renders, and where to write the folded stacks
+PROFILE_RENDER = os.getenv('PROFILE_RENDER', '0') == '1'
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'edith-profiles'))
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', 0.01))
+
+# Seconds between flushes of the buffered views, and the number of views that flushes early
+VIEW_FLUSH_INTERVAL = float(os.getenv('VIEW_FLUSH_INTERVAL', 5))
+VIEW_FLUSH_THRESHOLD = int(os.getenv('VIEW_FLUSH_THRESHOLD', 500))
 
 
 def generate_answer_para(text_data:str):
@@ -57,20 +269,21 @@ def generate_answer_para(text_data:str):
     Returns:
         str: The generated answer
     '''
-
+    from google.genai import types
 
     contents = (f""" 
             You have been asked to write a detailed response in good English to the following question: {text_data}. 
             The answer should be less than 300 words.The response should not contain any punctuation marks except fullstop and commas.
             The response must contain full stops only at the end of each sentence.""")
 
-    response = client.models.generate_content(
-        model="gemini-2.0-flash",
-        contents=contents,
-        config=types.GenerateContentConfig(
-            response_modalities=['Text']
+    with span('gemini_text'):
+        response = gateway.generate_content(
+            model=TEXT_MODEL,
+            contents=contents,
+            config=types.GenerateContentConfig(
+                response_modalities=['Text']
+            )
         )
-    )
     response_text = ''
     # Retrieving the text from the response
     for part in response.candidates[0].content.parts:
@@ -88,19 +301,22 @@ def generate_title(text_data:str):
     Returns:
         str: The generated title
     '''
+    from google.genai import types
+
     contents = (f""" 
             You have been asked to write a title in good English to the following para: {text_data}. 
             The title should be less than 10 words. Return only the title.
             The response should not contain any punctuation marks except fullstop and commas.
             """)
 
-    response = client.models.generate_content(
-        model="gemini-2.0-flash",
-        contents=contents,
-        config=types.GenerateContentConfig(
-            response_modalities=['Text']
+    with span('gemini_text'):
+        response = gateway.generate_content(
+            model=TEXT_MODEL,
+            contents=contents,
+            config=types.GenerateContentConfig(
+                response_modalities=['Text']
+            )
         )
-    )
     response_text = ''
     # Retrieving the text from the response
     for part in response.candidates[0].content.parts:
@@ -140,6 +356,8 @@ def generate_answer_image_prompts(text_data:list):
         text_data (list): The list of sentences to generate image prompts for
     Returns:
         list: The list of image prompts'''
+    from google.genai import types
+
     
 
     contents = (f"""You are assigned with a job of converting each sentence in the list into
@@ -149,13 +367,14 @@ def generate_answer_image_prompts(text_data:list):
                 the sentence should be complete and make sense on its own. It should not include any pronouns, 
                 only subject names should be provided.""")
 
-    response = client.models.generate_content(
-        model="gemini-2.0-flash",
-        contents=contents,
-        config=types.GenerateContentConfig(
-            response_modalities=['Text']
+    with span('gemini_text'):
+        response = gateway.generate_content(
+            model=TEXT_MODEL,
+            contents=contents,
+            config=types.GenerateContentConfig(
+                response_modalities=['Text']
+            )
         )
-    )
     response_text = ''
 
     for part in response.candidates[0].content.parts:
@@ -164,50 +383,188 @@ def generate_answer_image_prompts(text_data:list):
     prompt_list = split_text(text_data=response_text)
     return prompt_list
 
-def generate_images(prompt_list:list):
-    '''Generate images for each prompt in the prompt list
+# Response schema of the structured request, each slide pairs a narrated sentence with its image prompt
+SCRIPT_SCHEMA = {
+    'type': 'OBJECT',
+    'properties': {
+        'title': {'type': 'STRING'},
+        'slides': {
+            'type': 'ARRAY',
+            'items': {
+                'type': 'OBJECT',
+                'properties': {
+                    'sentence': {'type': 'STRING'},
+                    'image_prompt': {'type': 'STRING'},
+                },
+                'required': ['sentence', 'image_prompt'],
+            },
+        },
+    },
+    'required': ['title', 'slides'],
+}
+
+def parse_script(data:dict):
+    '''Validate a structured script and convert it into the results of the text stages
     Args:
-        prompt_list (list): The list of prompts to generate images for each sentence
+        data (dict): The decoded JSON response, with the 'title' and the 'slides'
     Returns:
-        list: The list of generated images
+        dict: The 'answer', 'title', 'sentences' and 'prompts', with one prompt for each sentence
     '''
-    images = []
-    for prompt in prompt_list: 
-            contents = f"""Generate an image of a creative scene of {prompt}.
-            Use your own imagination to create the image.
-            The image should be in good quality and should strictly not contain any text or watermarks.
-            """
-
-            response = client.models.generate_images(
-            model='imagen-3.0-generate-002',
-            prompt=contents,
-            config=types.GenerateImagesConfig(
-            number_of_images= 1,
+    title = format_text(str(data.get('title') or '')).strip()
+    slides = data.get('slides')
+    if not title or not isinstance(slides, list) or not slides:
+        raise ValueError("The script has no title or no slides")
+    sentences = []
+    prompts = []
+    for slide in slides:
+        # A sentence keeps any periods inside it, only the closing one is dropped like split_text does
+        sentence = format_text(str(slide.get('sentence') or '')).strip().rstrip('.').strip()
+        prompt = format_text(str(slide.get('image_prompt') or '')).strip()
+        if not sentence or not prompt:
+            raise ValueError("Every slide needs a sentence and an image prompt")
+        sentences.append(sentence)
+        prompts.append(prompt)
+    return {
+        'answer': ' '.join(f"{sentence}." for sentence in sentences),
+        'title': title,
+        'sentences': sentences,
+        'prompts': prompts,
+    }
+
+def request_script(text_data:str):
+    '''Generate the whole script of a video with a single schema-constrained request
+    Args:
+        text_data (str): The question to answer
+    Returns:
+        dict: The 'answer', 'title', 'sentences' and 'prompts', with one prompt for each sentence
+    '''
+    from google.genai import types
+
+    contents = (f"""
+            You have been asked to write a detailed response in good English to the following question: {text_data}.
+            The answer should be less than 300 words, written as a list of slides with one complete sentence each.
+            For every sentence also write a good image prompt describing a scene that illustrates it.
+            The image prompt should not include any pronouns, only subject names should be provided.
+            Also write a title for the answer that is less than 10 words.
+            The sentences and the title should not contain any punctuation marks except fullstop and commas.""")
+
+    with span('gemini_text'):
+        response = gateway.generate_content(
+            model=TEXT_MODEL,
+            contents=contents,
+            config=types.GenerateContentConfig(
+                response_mime_type='application/json',
+                response_schema=SCRIPT_SCHEMA,
             )
+        )
+    return parse_script(json.loads(response.text))
+
+def generate_script_separately(text_data:str):
+    '''Generate the script of a video with separate requests for the answer, the title and the prompts
+    Args:
+        text_data (str): The question to answer
+    Returns:
+        dict: The 'answer', 'title', 'sentences' and 'prompts'
+    '''
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # The title only needs the question, so it is written while the answer is
+        title = executor.submit(bind(generate_title), text_data)
+        answer = generate_answer_para(text_data)
+        sentences = split_text(answer)
+        prompts = generate_answer_image_prompts(sentences)
+        return {'answer': answer, 'title': title.result(), 'sentences': sentences, 'prompts': prompts}
+
+def generate_script(text_data:str):
+    '''Generate the answer sentences, the title and one image prompt per sentence
+    Args:
+        text_data (str): The question to answer
+    Returns:
+        dict: The 'answer', 'title', 'sentences' and 'prompts'
+    '''
+    try:
+        return request_script(text_data)
+    except Exception as e:
+        # Rate limits and outages would hit the separate requests just the same, so they are not retried that way
+        if is_retryable(e):
+            raise
+        # An invalid script falls back to the separate requests
+        return generate_script_separately(text_data)
+
+def generate_image(prompt:str):
+    '''Generate an image for a single prompt, retrying the prompt on failure
+    Args:
+        prompt (str): The prompt to generate an image for
+    Returns:
+        bytes: The generated image, still encoded as Imagen returned it
+    '''
+    # Lessons keep asking for the same pictures, a close enough earlier prompt saves the Imagen call
+    image = image_library.lookup(prompt)
+    if image is not None:
+        return image
+
+    from google.genai import types
+
+    contents = f"""Generate an image of a creative scene of {prompt}.
+    Use your own imagination to create the image.
+    The image should be in good quality and should strictly not contain any text or watermarks.
+    """
+
+    for attempt in range(IMAGE_ATTEMPTS):
+        try:
+            with span('imagen'):
+                response = gateway.generate_images(
+                    model=IMAGE_MODEL,
+                    prompt=contents,
+                    config=types.GenerateImagesConfig(
+                        number_of_images= 1,
+                        # Generate at the shape of the video so the encoder never stretches it
+                        aspect_ratio=IMAGE_ASPECT_RATIO,
+                    )
                 )
-            for generated_image in response.generated_images:
-                    image = Image.open(BytesIO(generated_image.image.image_bytes))
-                    images.append(image)
+            # A filtered prompt comes back without any images, so retry it as well
+            if not response.generated_images:
+                raise ValueError(f"No image was generated for prompt: {prompt}")
+            # Keep the compressed bytes, the image is only decoded by the encoder
+            image = response.generated_images[0].image.image_bytes
+            image_library.add(prompt, image)
+            return image
+        except Exception as e:
+            # The gateway already retried transient errors, give up on the last attempt for this prompt
+            if is_retryable(e) or attempt == IMAGE_ATTEMPTS - 1:
+                raise
+
+def generate_images(prompt_list:list, max_workers:int=IMAGE_CONCURRENCY):
+    '''Generate images for each prompt in the prompt list
+    Args:
+        prompt_list (list): The list of prompts to generate images for each sentence
+        max_workers (int): The maximum number of image requests in flight at once
+    Returns:
+        list: The encoded images, in the same order as the prompts
+    '''
+    if not prompt_list:
+        return []
+    # Send the prompts in parallel, map keeps the results in sentence order
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(prompt_list)))) as executor:
+        images = list(executor.map(bind(generate_image), prompt_list))
     return images
 
 
-def generate_voice(text_data:str,user_name:str):
-    '''Generate a voice for the text data
+def synthesize_speech(ttsclient, text_data:str):
+    '''Synthesize speech for a piece of text
     Args:
+        ttsclient (TextToSpeechClient): The client to send the request with
         text_data (str): The text data to generate voice for
-        user_name (str): The user name to save the voice file to
     Returns:
-        bytes: The generated voice data
+        bytes: The MP3 voice data
     '''
-    # Instantiates a client
-    ttsclient = texttospeech.TextToSpeechClient()
+    from google.cloud import texttospeech
 
     # Set the text input to be synthesized
     synthesis_input = texttospeech.SynthesisInput(text=text_data)
 
     # Build the voice request, select the language code ("en-US") and the ssml
     voice = texttospeech.VoiceSelectionParams(
-        language_code="en-US", ssml_gender=texttospeech.SsmlVoiceGender.NEUTRAL
+        language_code=VOICE_LANGUAGE, ssml_gender=texttospeech.SsmlVoiceGender[VOICE_GENDER]
     )
 
     # Select the type of audio file 
@@ -217,270 +574,984 @@ def generate_voice(text_data:str,user_name:str):
 
     # Perform the text-to-speech request on the text input with the selected
     # voice parameters and audio file type
-    response = ttsclient.synthesize_speech(
-        input=synthesis_input, voice=voice, audio_config=audio_config
-    )
-
+    with speech_gate.slot(), span('tts'):
+        response = ttsclient.synthesize_speech(
+            input=synthesis_input, voice=voice, audio_config=audio_config
+        )
 
     # The response's audio_content is binary.
-    with open(f"{user_name}_output.mp3", "wb") as out:
-        # Write the response to the output file.
-        out.write(response.audio_content)
     return response.audio_content
 
-
-
-def get_audio_duration(voice_bytes):
-    '''Get the duration of the audio data
+def generate_voice(sentences:list):
+    '''Generate a voice for the sentences, with the exact duration of each sentence
     Args:
-        voice_bytes (bytes): The audio data in bytes
+        sentences (list): The sentences to generate voice for
     Returns:
-        float: The duration of the audio in seconds
+        dict: The MP3 voice data as 'audio' and the duration in seconds of each sentence as 'durations'
     '''
-    
-    # Assuming 'audio_bytes' is the received audio data in bytes
-    audio = AudioSegment.from_file(BytesIO(voice_bytes), format="mp3")  # Change format if needed
+    # Reuse the shared client
+    ttsclient = get_tts_client()
+
+    # Synthesize the sentences in parallel, map keeps them in order
+    with ThreadPoolExecutor(max_workers=max(1, min(TTS_CONCURRENCY, len(sentences)))) as executor:
+        segments = list(executor.map(bind(lambda sentence: synthesize_speech(ttsclient, f"{sentence}.")), sentences))
 
-    # Get duration in seconds
-    duration = len(audio) / 1000  # Convert milliseconds to seconds
+    # Join the MP3 frames, the duration of each sentence is read from its frame headers
+    audio, durations = concat_mp3(segments)
+    return {'audio': audio, 'durations': durations}
 
-    return duration
 
-def estimate_tts_duration(text):
-    '''Estimate the duration of a text-to-speech conversion
+def fit_durations(durations:list, count:int):
+    '''Fit the measured sentence durations to the number of images
     Args:
-        text (str): The text to convert to speech
+        durations (list): The duration of each sentence
+        count (int): The number of images
     Returns:
-        float: The estimated duration in seconds
+        list: One duration per image with the same total
     '''
-    # Get the number of characters in the text
-    char_count = len(text)
-
-    # Approx Characters per second (cps) 
-    cps = 16  # Default to WaveNet
-    
-    return round(char_count / cps, 2)  # Return duration in seconds
-
-def adjust_frame_length(duration:float, text_data:str):
-    '''Adjust the frame length to match the desired duration
+    if len(durations) == count:
+        return durations
+    # Spread the total evenly when the prompts did not split like the sentences
+    total = sum(durations)
+    return [total / count] * count
+
+def merge_images(images:list,durations:list,voice_bytes:bytes,workspace:MediaWorkspace,preset:str=ENCODER_PRESET):
+    '''Start merging the images into a video stream
     Args:
-        duration (float): The desired duration in seconds
-        text_data (str): The text data to convert to speech
+        images (list): The encoded images to merge
+        durations (list): The list of total durations
+        voice_bytes (bytes): The MP3 voice data to use as the soundtrack
+        workspace (MediaWorkspace): The scratch space of the job
+        preset (str): The name of an entry in encoder.ENCODER_PRESETS
     Returns:
-        list: The list of frame durations
+        SlideshowStream: The encoder, read it to get the MP4 data
     '''
+    # Write the encoded bytes as they are, the encoder decodes one image at a time
+    image_paths = []
+    for index, image_bytes in enumerate(images):
+        image_paths.append(workspace.write(f"slide_{index:03d}{image_extension(image_bytes)}", image_bytes))
 
-    # Initialize the empty list of estimated durations
-    estimated_duration = []
-    
-    # Split the text data into sentences
-    sentences = split_text(text_data)
-    
-    
-
-    # Estimate the duration of each sentence
-    for sentence in sentences:
-        estimated_duration.append(estimate_tts_duration(sentence))
-    
-    # If the estimated duration is not equal to the desired duration
-    if sum(estimated_duration) != duration:
-        # Calculate the difference
-        difference = duration - sum(estimated_duration)
-        
-        # Distribute the difference across all frames
-        perframe = difference / len(estimated_duration)
-        for i in range(len(estimated_duration)):
-            estimated_duration[i] += perframe
-        
-        # Ensure the total duration matches the desired duration exactly
-        # Adjust the last frame to account for any floating-point inaccuracies
-        estimated_duration[-1] = duration - sum(estimated_duration[:-1])
-    
-    # Return the adjusted durations
-    return estimated_duration
+    # The voice is piped into the encoder, it never touches the disk
+    return SlideshowStream(image_paths, fit_durations(durations, len(images)), voice_bytes,
+                           workspace.file("slides.ffconcat"), preset=preset)
 
+def render_profile(name:str):
+    '''Profile a render when PROFILE_RENDER is set
+    Args:
+        name (str): The kind of render, added to the file name after the request ID
+    Returns:
+        A context manager that samples the render, or does nothing
+    '''
+    if not PROFILE_RENDER:
+        return nullcontext()
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    return profiled(os.path.join(PROFILE_DIR, f"{current_request_id()}-{name}.folded"), PROFILE_INTERVAL)
 
-def merge_images(images:list,durations:list,user_id:str):
-    '''Merge the images into a video clip and writes it to a file
+def publish_video(images:list, durations:list, voice_bytes:bytes, user_id:str, video_count:int, draft:bool=False):
+    '''Encode the video and stream it straight into Firebase Storage
     Args:
         images (list): The list of images to merge
         durations (list): The list of total durations
-        user_id (str): The user ID to save the video to
+        voice_bytes (bytes): The MP3 voice data to use as the soundtrack
+        user_id (str): The user ID to upload the video for
+        video_count (int): The number of the video in the user's folder
+        draft (bool): Encode with DRAFT_PRESET, the video is replaced by upgrade_video later
     Returns:
-        None    
+        dict: The public download URL, size in bytes, duration in seconds, poster URL and quality of
+              the video, with the owner and the Storage objects so the video can be copied for other users
     '''
-    # Convert PIL images to NumPy arrays, resize them, and ensure they are RGB
-    images = [np.array(img.convert("RGB").resize((1024, 500))) for img in images]
-
-    # Create a video clip from images using fps instead of durations
-    video_clip = ImageSequenceClip(images, durations=durations)
-
-    # Load an audio file
-    audio_clip = AudioFileClip(f"{user_id}_output.mp3")
-
-    # Set audio to the video
-    final_video = video_clip.set_audio(audio_clip)
-
-    # Export the final video
-    final_video.write_videofile(f"{user_id}_output_video.mp4", codec="libx264", fps=24)
-
-    # Delete the audio file
-    os.remove(f"{user_id}_output.mp3")
+    # The workspace is removed whether the encode and upload succeed or not
+    with render_profile('render'), encode_gate.slot(), MediaWorkspace(prefix=f"edith-{user_id}-", root=SCRATCH_ROOT) as workspace:
+        stream = merge_images(images, durations, voice_bytes, workspace, preset=DRAFT_PRESET if draft else ENCODER_PRESET)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            # The poster is cut from the first slide while the video is encoded
+            poster = executor.submit(bind(publish_poster), workspace.file(f"slide_000{image_extension(images[0])}"), user_id, video_count, workspace)
+            try:
+                # Players revalidate a draft, so they pick up the final video once it replaces it
+                link, size = upload_to_firebase_storage(stream, user_id, video_count, cache_control='no-cache' if draft else None)
+            except Exception:
+                stream.kill()
+                raise
+        poster = poster.result()
+        return {'link': link, 'size': size, 'duration': round(sum(durations), 1), 'poster': poster,
+                'quality': 'draft' if draft else 'final', 'user_id': user_id, 'blob': video_blob_name(user_id, video_count),
+                'poster_blob': poster_blob_name(user_id, video_count) if poster else None}
+
+def own_video(video:dict, user_id:str):
+    '''Give a user their own copy of a published video
+    Args:
+        video (dict): The published video, as returned by publish_video
+        user_id (str): The user ID the video is for
+    Returns:
+        dict: The video itself if the user owns it, otherwise a copy in the user's folder
+    '''
+    if video['user_id'] == user_id:
+        return video
+    # A cached video of another user is copied server-side, so each user owns the link they list
+    video_count = count_videos_in_user_folder(user_id)
+    bucket = get_bucket()
+    with span('storage_copy'):
+        blob = bucket.copy_blob(bucket.blob(video['blob']), bucket, video_blob_name(user_id, video_count))
+        blob.make_public()
+        poster, poster_blob = None, None
+        if video['poster_blob']:
+            poster_blob = poster_blob_name(user_id, video_count)
+            poster_copy = bucket.copy_blob(bucket.blob(video['poster_blob']), bucket, poster_blob)
+            poster_copy.make_public()
+            poster = poster_copy.public_url
+    return dict(video, link=blob.public_url, user_id=user_id, blob=blob.name, poster=poster, poster_blob=poster_blob)
+
+def publish_poster(image_path:str, user_id:str, video_count:int, workspace:MediaWorkspace):
+    '''Upload a small still of a slide as the poster of a video
+    Args:
+        image_path (str): The path of the slide
+        user_id (str): The user ID the video is uploaded for
+        video_count (int): The number of the video in the user's folder
+        workspace (MediaWorkspace): The scratch space of the job
+    Returns:
+        str: The public download URL of the poster, or None if it could not be made
+    '''
+    settings = POSTER_FORMATS[POSTER_FORMAT]
+    try:
+        with span('poster'):
+            path = encode_poster(image_path, workspace.file(f"poster{settings['extension']}"), width=POSTER_WIDTH, image_format=POSTER_FORMAT)
+            with open(path, 'rb') as f:
+                data = f.read()
+            # A poster never changes, so clients may keep it
+            return upload_public_bytes(poster_blob_name(user_id, video_count), data,
+                                       settings['content_type'], cache_control='public, max-age=31536000')
+    except Exception:
+        # A video without a poster is still listed, with its title only
+        return None
+
+def upgrade_video(images:list, durations:list, voice_bytes:bytes, user_id:str, video_count:int):
+    '''Encode a published draft at final quality and replace it in place
+    Args:
+        images (list): The list of images to merge
+        durations (list): The list of total durations
+        voice_bytes (bytes): The MP3 voice data to use as the soundtrack
+        user_id (str): The user ID the draft was uploaded for
+        video_count (int): The number of the video in the user's folder
+    Returns:
+        tuple: The public download URL of the video, the same as the draft's, and its size in bytes
+    '''
+    with render_profile('upgrade'), encode_gate.slot(), span('upgrade'), MediaWorkspace(prefix=f"edith-{user_id}-", root=SCRATCH_ROOT) as workspace:
+        stream = merge_images(images, durations, voice_bytes, workspace)
+        # Off the critical path the video is encoded completely before the upload,
+        # so a failed encode leaves the draft in place instead of a truncated video
+        path = workspace.file("final.mp4")
+        try:
+            with open(path, 'wb') as f:
+                shutil.copyfileobj(stream, f, UPLOAD_CHUNK_SIZE)
+        except Exception:
+            stream.kill()
+            raise
+        stream.close()
+        # The new generation replaces the draft atomically once the upload completes
+        blob = get_bucket().blob(video_blob_name(user_id, video_count))
+        blob.upload_from_filename(path, content_type='video/mp4')
+        blob.make_public()
+        size = os.path.getsize(path)
+    video_store.update_video(user_id, blob.public_url, quality='final', size=size)
+    if catalog_ready.is_set():
+        catalog.update(blob.public_url, size=size)
+    return blob.public_url, size
+
+def schedule_upgrade(text_data:str, user_id:str, results:dict):
+    '''Queue the final encode of a draft as a job, so it is run again after a restart
+    Args:
+        text_data (str): The question the draft was generated for
+        user_id (str): The user ID the draft was uploaded for
+        results (dict): The pipeline results of the draft
+    Returns:
+        dict: The queued job, or None if the inputs of the draft could not be kept
+    '''
+    # The final encode must show exactly what the draft showed, so its inputs are kept
+    # with the job instead of being looked up in the cache or generated again
+    directory = os.path.join(UPGRADE_DIR, uuid.uuid4().hex)
+    images = []
+    try:
+        os.makedirs(directory)
+        for index, image in enumerate(results['images']):
+            name = f"slide_{index:03d}{image_extension(image)}"
+            with open(os.path.join(directory, name), 'wb') as f:
+                f.write(image)
+            images.append(name)
+        with open(os.path.join(directory, 'voice.mp3'), 'wb') as f:
+            f.write(results['voice']['audio'])
+    except OSError:
+        # The draft is already published and recorded, it just stays a draft
+        shutil.rmtree(directory, ignore_errors=True)
+        metrics.inc('edith_upgrades_total', status='skipped')
+        return None
+    # The script names the final render in the cache
+    script = {field: results[field] for field in ('answer', 'title', 'prompts')}
+    options = {'upgrade': True, 'resumable': True, 'video_count': results['video_count'], 'render': results['render'], 'script': script,
+               'directory': directory, 'images': images, 'durations': results['voice']['durations']}
+    # Upgrades only use the model, speech and encoder capacity requests leave free
+    return job_queue.submit(user_id, text_data, options, priority=UPGRADE)
+
+def read_draft_inputs(options:dict):
+    '''Read the images and voice a draft was encoded from
+    Args:
+        options (dict): The options of the upgrade job
+    Returns:
+        tuple: The images and the voice data
+    '''
+    images = []
+    for name in options['images']:
+        with open(os.path.join(options['directory'], name), 'rb') as f:
+            images.append(f.read())
+    with open(os.path.join(options['directory'], 'voice.mp3'), 'rb') as f:
+        voice_bytes = f.read()
+    return images, voice_bytes
+
+def run_upgrade_job(job:dict, on_stage):
+    '''Replace a draft with its final encode, a failed upgrade leaves the draft published
+    Args:
+        job (dict): The job queued by schedule_upgrade
+        on_stage (callable): Called with each stage name and its new status
+    Returns:
+        dict: The video link and the time spent in each stage
+    '''
+    options = job['options']
+    start = time.perf_counter()
+    try:
+        # Without the exact inputs of the draft the upgrade fails and the draft stays published
+        images, voice_bytes = read_draft_inputs(options)
+        on_stage('upgrade', 'running')
+        link, size = upgrade_video(images, options['durations'], voice_bytes, job['user_id'], options['video_count'])
+        on_stage('upgrade', 'done')
+    except Exception:
+        on_stage('upgrade', 'failed')
+        metrics.inc('edith_upgrades_total', status='error')
+        raise
+    finally:
+        # A finished or failed upgrade is never run again, an interrupted one keeps its inputs
+        shutil.rmtree(options['directory'], ignore_errors=True)
+    metrics.inc('edith_upgrades_total', status='ok')
+    # Only now is the render worth sharing, later requests copy the final video
+    result_cache.set(stage_cache_key('render', options['script']), dict(options['render'], size=size, quality='final'))
+    return {'link': link, 'timings': {'upgrade': round(time.perf_counter() - start, 3)}}
 
 def count_videos_in_user_folder(user_id:str):
-    '''Count the number of videos in the user's folder
+    '''Allocate the number of the next video in the user's folder
     Args:
         user_id (str): The user ID to count videos for
     Returns:
-        int: The number of videos in the user's folder
+        int: The number of videos in the user's folder before this one
     '''
+    # Read and bump the counter in one transaction so concurrent videos never share a number
+    return video_store.allocate_number(user_id)
 
-    # Get the storage bucket
-    user = db.collection('users').document(user_id).get()
-    # Get the user's video count
-    user_dict = user.to_dict()
-    # Fetch the user document to update the video count
-    user_update  = db.collection('users').document(user_id)
-    # Initialize the video count
-    video_count = user_dict["video_count"]
-    # Update the video count
-    user_update.update({"video_count": video_count + 1})
-
-    return video_count
+def flush_views(user_id:str, counts:dict):
+    '''Write a batch of buffered views of a user's videos to Firestore
+    Args:
+        user_id (str): The user ID the videos belong to
+        counts (dict): The number of views to add by video link
+    Returns:
+        list: The links that have no video, their views are dropped
+    '''
+    # Each video document gets an atomic increment, all in one batched write
+    missing = video_store.add_views(user_id, counts)
+    # The catalog takes the views in the same batches, the listener delivers them itself
+    if catalog_ready.is_set() and not CATALOG_LISTENER:
+        catalog.add_views({link: count for link, count in counts.items() if link not in missing})
+    return missing
+
+# Buffer views in memory and write them to Firestore in coalesced batches, only transient errors are retried
+view_counter = ViewCounter(flush_views, interval=VIEW_FLUSH_INTERVAL, max_pending=VIEW_FLUSH_THRESHOLD, retryable=is_retryable)
 
 def increment_views(user_id:str, video_url:str):
-    '''Increment the views for a video in Firestore
+    '''Increment the views for a video, the view is written to Firestore on the next flush
     Args:
         user_id (str): The user ID to increment views for
         video_url (str): The video URL to increment views for
     Returns:
         None
     '''
-    # Fetch the user document
-    user = db.collection('users').document(user_id).get()
-    # Get the user's video list
-    user_dict = user.to_dict()
-    # Get the user's video list
-    video_list = user_dict["generated_videos"]
-    # Find the video in the list and increment its views
-    for video in video_list:
-        if video["link"] == video_url:
-            # Increment the views
-            video["views"] += 1
-            break
-    # Update the user's video list in Firestore
-    user_update = db.collection('users').document(user_id)
-    # Update the user's video list
-    user_update.update({"generated_videos": video_list})
-
-
-def upload_to_firebase_storage(local_file_path:str, user_id:str,video_count:int):
-    '''Upload a file to Firebase Storage
-    Args:
-        local_file_path (str): The local file path to upload
+    # Buffer the view, it is coalesced with the other views of the video and
+    # reaches the search ranking with them when the buffer is flushed
+    view_counter.increment(user_id, video_url)
+
+
+def poster_blob_name(user_id:str, video_count:int):
+    '''The Storage path of the poster of a user's video'''
+    return f"users/{user_id}/posters/{video_count}{POSTER_FORMATS[POSTER_FORMAT]['extension']}"
+
+def video_blob_name(user_id:str, video_count:int):
+    '''Get the path of a video in Firebase Storage'''
+    return f"users/{user_id}/videos/{video_count}"
+
+def upload_to_firebase_storage(stream, user_id:str,video_count:int,cache_control:str=None):
+    '''Upload a video stream to Firebase Storage in resumable chunks
+    Args:
+        stream (SlideshowStream): The encoder to read the video from
         user_id (str): The user ID to upload the file for
         video_count (int): The video count to upload the file for
+        cache_control (str): The Cache-Control header to serve the video with
     Returns:
-        str: The public download URL of the uploaded file
+        tuple: The public download URL and the size in bytes of the uploaded file
     '''
     # Get the storage bucket
-    bucket = storage.bucket()
+    bucket = get_bucket()
 
     # Define the destination path in Firebase Storage
-    destination_blob_name = f"users/{user_id}/videos/{video_count}"
+    destination_blob_name = video_blob_name(user_id, video_count)
 
     # Upload the file
     blob = bucket.blob(destination_blob_name)
-    # Upload the file to Firebase Storage
-    blob.upload_from_filename(local_file_path)
-    # Delete the local file
-    os.remove(local_file_path)
+    if cache_control:
+        blob.cache_control = cache_control
+    # Send each chunk as soon as the encoder has produced it
+    writer = blob.open('wb', chunk_size=UPLOAD_CHUNK_SIZE, content_type='video/mp4')
+    # The encode and the upload overlap, so they are timed as one span
+    size = 0
+    with span('encode_upload'):
+        try:
+            # Copy chunk by chunk, counting the size of the video for the listings
+            for chunk in iter(lambda: stream.read(UPLOAD_CHUNK_SIZE), b''):
+                writer.write(chunk)
+                size += len(chunk)
+        finally:
+            writer.close()
+        try:
+            stream.close()
+        except Exception:
+            # Never leave a truncated video behind when the encoder failed
+            blob.delete()
+            raise
     # Make the file publicly accessible 
     blob.make_public()
     # Return the public download URL
+    return blob.public_url, size
+
+def upload_public_bytes(blob_name:str, data:bytes, content_type:str, cache_control:str=None):
+    '''Upload bytes to Firebase Storage and make them public
+    Args:
+        blob_name (str): The destination path in Firebase Storage
+        data (bytes): The data to upload
+        content_type (str): The MIME type of the data
+        cache_control (str): The Cache-Control header to serve the object with
+    Returns:
+        str: The public download URL of the uploaded object
+    '''
+    blob = get_bucket().blob(blob_name)
+    if cache_control:
+        blob.cache_control = cache_control
+    with span('storage_upload'):
+        blob.upload_from_string(data, content_type=content_type)
+        blob.make_public()
     return blob.public_url
 
-def write_to_firestore(user_id:str, video_url:str,video_title:str):
+def publish_playlist(folder:str, playlist:HlsPlaylist):
+    '''Upload the current state of an HLS playlist
+    Args:
+        folder (str): The Storage folder of the video
+        playlist (HlsPlaylist): The playlist to upload
+    Returns:
+        str: The public URL of the playlist
+    '''
+    # Players reload the playlist while it grows, so it must never be cached
+    return upload_public_bytes(f"{folder}/index.m3u8", playlist.render().encode('utf-8'),
+                               'application/vnd.apple.mpegurl', cache_control='no-cache')
+
+def write_to_firestore(user_id:str, video_url:str,video_title:str,**fields):
     '''Write the video URL to Firestore
     Args:
         user_id (str): The user ID to write the video URL for
         video_url (str): The video URL to write
         video_title (str): The title of the video
+        fields: Any other fields to store with the video
     Returns:
-        list: The updated list of video URLs
+        dict: The stored video
     '''
-    # Get the storage bucket
-    user = db.collection('users').document(user_id).get()
-    # Get the user's video list
-    user_dict = user.to_dict()
-    # Update the user's video list
-    video_list = user_dict["generated_videos"]
-    # Check if the video URL already exists in the list
-    video_list.append({"views":0,"link":video_url,"title":video_title})
-    # Update the user's video list in Firestore
-    user_update = db.collection('users').document(user_id)
-    # Update the user's video list
-    user_update.update({"generated_videos": video_list})
-    # Fetch the updated user document
-    return video_list
-
-
-def fetch_collection_recursively(collection_ref):
-    """Recursively fetch all documents and subcollections in a Firestore collection.
-    Args:
-        collection_ref: A reference to the Firestore collection.
-    Returns:
-        A dictionary containing all documents and their subcollections.
-    """
-    # Initialize an empty dictionary to store the collection data
-    collection_dict = {}
+    # Create the video document, the user document is not rewritten
+    video = video_store.add_video(user_id, video_url, video_title, **fields)
+    # Make the video searchable straight away, an unbuilt catalog reads it from Firestore
+    if catalog_ready.is_set():
+        catalog.add(user_id, public_fields(video))
+    return video
 
-    # Stream all documents in the current collection
-    for doc in collection_ref.stream():
-        doc_data = doc.to_dict()  # Convert document to dictionary
 
-        # Recursively fetch all subcollections of this document
-        subcollections = doc.reference.collections()
-        #  Iterate through each subcollection
-        for subcollection in subcollections:
-            subcollection_name = subcollection.id
-            # Recursively fetch the subcollection data
-            doc_data[subcollection_name] = fetch_collection_recursively(subcollection)
+def load_catalog():
+    '''Build the video catalog from a recent snapshot, or from Firestore when there is none
+    Returns:
+        None
+    '''
+    # A recent snapshot saves a cold instance from reading every user document
+    if catalog.load(CATALOG_PATH, max_age=CATALOG_MAX_AGE):
+        return
+    # A new instance has no local file, but another instance may have shared one
+    if download_catalog_snapshot() and catalog.load(CATALOG_PATH, max_age=CATALOG_MAX_AGE):
+        return
+    rebuild_catalog()
+
+def rebuild_catalog():
+    '''Replace the catalog with a full scan of the video documents, and share it
+    Returns:
+        None
+    '''
+    # Stream every video document of every user, the catalog keeps serving meanwhile
+    scanned_at = time.time()
+    videos = list(video_store.stream_all())
+    catalog.replace_all(videos, scanned_at)
+    # Only a full scan is shared, local changes never overwrite what other instances load
+    save_catalog(share=True)
+
+def download_catalog_snapshot():
+    '''Copy the shared catalog snapshot from Storage to CATALOG_PATH
+    Returns:
+        bool: Whether a snapshot was downloaded
+    '''
+    if not CATALOG_BLOB:
+        return False
+    try:
+        get_bucket().blob(CATALOG_BLOB).download_to_filename(CATALOG_PATH)
+        return True
+    except Exception:
+        # No snapshot has been shared yet, or Storage is unreachable, the scan still works
+        return False
+
+def save_catalog(share:bool=False):
+    '''Write the catalog snapshot to CATALOG_PATH
+    Args:
+        share (bool): Upload it to CATALOG_BLOB too, for other instances to start from
+    Returns:
+        None
+    '''
+    try:
+        catalog.save(CATALOG_PATH)
+        if share and CATALOG_BLOB:
+            get_bucket().blob(CATALOG_BLOB).upload_from_filename(CATALOG_PATH, content_type='application/json')
+    except Exception:
+        # The snapshot only speeds up cold starts, so a failed write is not fatal
+        pass
+
+def ensure_catalog():
+    '''Build the catalog on first use, then keep it current through incremental updates
+    Returns:
+        None
+    '''
+    if catalog_ready.is_set():
+        return
+    with catalog_lock:
+        # Another request may have built it while this one was waiting
+        if catalog_ready.is_set():
+            return
+        load_catalog()
+        threading.Thread(target=maintain_catalog, daemon=True).start()
+        if CATALOG_LISTENER:
+            get_db().collection_group(video_store.collection).on_snapshot(on_videos_snapshot)
+        catalog_ready.set()
+
+def on_videos_snapshot(docs, changes, read_time):
+    '''Apply the changed video documents to the video catalog
+    Args:
+        docs (list): The current video documents
+        changes (list): The document changes since the last snapshot
+        read_time: The time the snapshot was read at
+    Returns:
+        None
+    '''
+    # The first snapshot reports every video as added, the catalog was built without it
+    if not catalog_listening.is_set():
+        catalog_listening.set()
+        return
+    count_firestore('read', len(changes))
+    for change in changes:
+        video = to_video(change.document)
+        if change.type.name == 'REMOVED':
+            catalog.remove(video["link"])
+            continue
+        catalog.add(change.document.reference.parent.parent.id, video)
+
+def maintain_catalog():
+    '''Rescan the catalog once its scan is CATALOG_REBUILD_INTERVAL old, and write the
+    snapshot whenever it has changed in between, runs forever
+    Returns:
+        None
+    '''
+    while True:
+        time.sleep(CATALOG_SAVE_INTERVAL)
+        if CATALOG_REBUILD_INTERVAL > 0 and time.time() - catalog.scanned_at >= CATALOG_REBUILD_INTERVAL:
+            try:
+                rebuild_catalog()
+            except Exception:
+                # The catalog keeps serving the last scan, the next round tries again
+                pass
+        elif catalog.dirty:
+            save_catalog()
+
+def normalize_question(text_data:str):
+    '''Normalize a question so that trivially different phrasings share a cache entry
+    Args:
+        text_data (str): The question to normalize
+    Returns:
+        str: The lower case question without punctuation or repeated whitespace
+    '''
+    text_data = re.sub(r'[^\w\s]', ' ', text_data.lower())
+    return ' '.join(text_data.split())
+
+# The cached stages, the values their results depend on and the settings that change them
+if STRUCTURED_SCRIPT:
+    # The answer, the title, the sentences and the prompts come from one request, and are
+    # cached as one so they always match, lookup_cached_stages unpacks them again
+    SCRIPT_STAGES = {'script': (['question'], [TEXT_MODEL, SCRIPT_MODE])}
+else:
+    # The sentences are a split of the answer, so they are cheaper to split again than to cache
+    SCRIPT_STAGES = {
+        'answer': (['question'], [TEXT_MODEL, SCRIPT_MODE]),
+        'title': (['question'], [TEXT_MODEL, SCRIPT_MODE]),
+        'prompts': (['answer'], [TEXT_MODEL, SCRIPT_MODE]),
+    }
+CACHED_STAGES = {
+    **SCRIPT_STAGES,
+    'images': (['prompts'], [IMAGE_MODEL, IMAGE_ASPECT_RATIO]),
+    'voice': (['answer'], [VOICE_LANGUAGE, VOICE_GENDER]),
+    # The rendered video is shared by every user, each user gets a copy of it
+    'render': (['answer', 'title', 'prompts'], [IMAGE_MODEL, VOICE_LANGUAGE, VOICE_GENDER]),
+}
+
+def stage_cache_key(stage:str, values:dict):
+    '''Build the cache key of a stage result from the values it depends on
+    Args:
+        stage (str): The stage name
+        values (dict): The known pipeline values by name
+    Returns:
+        str: The cache key, or None if a value the stage depends on is unknown
+    '''
+    deps, settings = CACHED_STAGES[stage]
+    if any(dep not in values for dep in deps):
+        return None
+    return make_key(PIPELINE_VERSION, stage, settings, [values[dep] for dep in deps])
 
-        # Add document data to the final collection dictionary
-        collection_dict[doc.id] = doc_data
+def lookup_cached_stages(text_data:str):
+    '''Find every stage result of a question that is still valid in the cache
 
-    return collection_dict
+    The keys chain through the results they depend on, so a stage is only reused
+    when everything upstream of it is reused too.
+    Args:
+        text_data (str): The question
+    Returns:
+        dict: The cached stage results by stage name
+    '''
+    values = {'question': normalize_question(text_data)}
+    for stage in CACHED_STAGES:
+        key = stage_cache_key(stage, values)
+        if key is None:
+            continue
+        value = result_cache.get(key)
+        if value is not None:
+            values[stage] = value
+            # The stages that only pick a field of the script are known along with it
+            if stage == 'script':
+                values.update(value)
+    del values['question']
+    return values
+
+def store_cached_stages(text_data:str, results:dict, timings:dict):
+    '''Cache the results of the stages that ran
+    Args:
+        text_data (str): The question
+        results (dict): The pipeline results by name
+        timings (dict): The time spent in each stage that ran
+    Returns:
+        None
+    '''
+    values = dict(results, question=normalize_question(text_data))
+    for stage in CACHED_STAGES:
+        # A draft is only shared once run_upgrade_job has replaced it with the final encode
+        if stage == 'render' and results.get('render', {}).get('quality') == 'draft':
+            continue
+        if stage in timings:
+            key = stage_cache_key(stage, values)
+            if key is not None:
+                result_cache.set(key, results[stage])
+
+def build_video_pipeline(user_id:str, draft:bool=False, fields:dict=None):
+    '''Build the stage graph that turns a question into a published video
+    Args:
+        user_id (str): The user ID to generate the video for
+        draft (bool): Publish a draft encode, to be replaced by upgrade_video
+        fields (dict): Any other fields to store with the video
+    Returns:
+        Pipeline: The pipeline, run with the 'question' and 'user_id' inputs
+    '''
+    pipeline = Pipeline()
+    if STRUCTURED_SCRIPT:
+        # One request writes the answer, the title and a prompt for every sentence
+        pipeline.add_stage('script', generate_script, ['question'])
+        for field in ('answer', 'title', 'sentences', 'prompts'):
+            pipeline.add_stage(field, itemgetter(field), ['script'])
+    else:
+        # The answer and the title only need the question
+        pipeline.add_stage('answer', generate_answer_para, ['question'])
+        pipeline.add_stage('title', generate_title, ['question'])
+        # The image branch needs the sentences of the answer
+        pipeline.add_stage('sentences', split_text, ['answer'])
+        pipeline.add_stage('prompts', generate_answer_image_prompts, ['sentences'])
+    pipeline.add_stage('images', generate_images, ['prompts'])
+    # The voice branch only needs the sentences, so it runs alongside the images
+    pipeline.add_stage('voice', generate_voice, ['sentences'])
+    # The video counter does not depend on rendering
+    pipeline.add_stage('video_count', count_videos_in_user_folder, ['user_id'])
+    # Encoding and uploading overlap, the upload starts with the first encoded bytes
+    pipeline.add_stage('render', lambda images, voice, video_count: publish_video(images, voice['durations'], voice['audio'], user_id, video_count, draft=draft), ['images', 'voice', 'video_count'])
+    # A render cached for another user is copied into this user's folder
+    pipeline.add_stage('video', own_video, ['render', 'user_id'])
+    pipeline.add_stage('link', itemgetter('link'), ['video'])
+    # The listings show the poster, duration and size without opening the video,
+    # a draft is marked so clients know the video improves in place
+    pipeline.add_stage('record', lambda video, title: write_to_firestore(user_id=user_id, video_url=video['link'], video_title=title, poster=video['poster'],
+                                                                         duration=video['duration'], size=video['size'], quality=video['quality'], **(fields or {})), ['video', 'title'])
+    return pipeline
+
+def record_timings(timings:dict):
+    '''Add the time spent in each stage of a video to the stage histograms'''
+    for stage, seconds in timings.items():
+        # The HLS segments share one series, they are numbered per video
+        metrics.observe('edith_stage_seconds', seconds, stage='segment' if stage.startswith('segment_') else stage)
+
+def run_video_pipeline(text_data:str, user_id:str, on_stage=None, draft:bool=DRAFT_RENDER, fields:dict=None):
+    '''Generate a video for a question, reusing every cached stage result
+    Args:
+        text_data (str): The question to generate the video for
+        user_id (str): The user ID to generate the video for
+        on_stage (callable): Called with each stage name and its new status
+        draft (bool): Publish a draft first and upgrade it to final quality in the background
+        fields (dict): Any other fields to store with the video
+    Returns:
+        tuple: The pipeline results and the time spent in each stage that ran
+    '''
+    # A cached render leaves only the Firestore write, other hits skip their stages
+    inputs = lookup_cached_stages(text_data)
+    inputs.update({'question': text_data, 'user_id': user_id})
+    # A cached video is published already, there is nothing to draft
+    draft = draft and 'render' not in inputs
+    # Only what the link and the record need runs, known values cut off everything upstream of them.
+    # The script fields are targets too, the cache keys need them and once the script is known they are free
+    targets = ['link', 'record', 'answer', 'title', 'sentences', 'prompts']
+    results, timings = build_video_pipeline(user_id, draft=draft, fields=fields).run(inputs, targets=targets, on_stage=on_stage)
+    store_cached_stages(text_data, results, timings)
+    record_timings(timings)
+    if draft:
+        # The upgrade starts after the record stage, so the document it updates exists
+        schedule_upgrade(text_data, user_id, results)
+    return results, timings
+
+def stream_video(text_data:str, user_id:str, video_count:int, on_stage=None):
+    '''Generate a video as HLS segments, publishing each sentence as soon as it is ready
+    Args:
+        text_data (str): The question to generate the video for
+        user_id (str): The user ID to generate the video for
+        video_count (int): The number of the video in the user's folder
+        on_stage (callable): Called with each stage name and its new status
+    Returns:
+        tuple: The playlist URL and the time spent in each stage
+    '''
+    notify = on_stage or (lambda stage, status: None)
+    folder = f"users/{user_id}/videos/{video_count}"
+    # The text stages run as usual, and reuse whatever is cached
+    inputs = lookup_cached_stages(text_data)
+    inputs.update({'question': text_data, 'user_id': user_id})
+    results, timings = build_video_pipeline(user_id).run(inputs, targets=['sentences', 'prompts', 'title'], on_stage=on_stage)
+    sentences, prompts = results['sentences'], results['prompts']
+    if not sentences or not prompts:
+        raise ValueError("The answer has no sentences to narrate")
+    store_cached_stages(text_data, results, timings)
+    for index in range(len(sentences)):
+        notify(f"segment_{index:03d}", 'pending')
+
+    ttsclient = get_tts_client()
+    playlist = HlsPlaylist(HLS_TARGET_DURATION)
+    offset = 0.0
+    size = 0
+    poster = None
+    image_pool = ThreadPoolExecutor(max_workers=IMAGE_CONCURRENCY)
+    voice_pool = ThreadPoolExecutor(max_workers=TTS_CONCURRENCY)
+    try:
+        with render_profile('stream'), MediaWorkspace(prefix=f"edith-{user_id}-", root=SCRATCH_ROOT) as workspace:
+            # Start every image and sentence at once, the segments are cut in order as they land
+            images = [image_pool.submit(bind(generate_image), prompt) for prompt in prompts]
+            voices = [voice_pool.submit(bind(synthesize_speech), ttsclient, f"{sentence}.") for sentence in sentences]
+            for index in range(len(sentences)):
+                stage = f"segment_{index:03d}"
+                notify(stage, 'running')
+                start = time.perf_counter()
+                # Sentences and prompts may not split the same way, so map them proportionally
+                image_bytes = images[index * len(images) // len(sentences)].result()
+                voice_bytes = voices[index].result()
+                duration = mp3_duration(voice_bytes)
+
+                image_path = workspace.write(f"slide_{index:03d}{image_extension(image_bytes)}", image_bytes)
+                audio_path = workspace.write(f"voice_{index:03d}.mp3", voice_bytes)
+                # The target duration is fixed once published, so long sentences are cut into equal parts
+                parts = max(1, math.ceil(duration / HLS_TARGET_DURATION))
+                part_duration = duration / parts
+                for part in range(parts):
+                    segment_name = f"segment_{index:03d}_{part}.ts"
+                    with encode_gate.slot(), span('encode_segment'):
+                        segment_path = encode_segment(image_path, audio_path, part_duration, offset, workspace.file(segment_name),
+                                                      preset=ENCODER_PRESET, start=part * part_duration)
+                    with open(segment_path, 'rb') as f:
+                        segment = f.read()
+                    upload_public_bytes(f"{folder}/{segment_name}", segment, 'video/mp2t')
+                    size += len(segment)
+
+                    # Only list the segment once it can be downloaded
+                    playlist.add_segment(segment_name, part_duration)
+                    offset += part_duration
+                    publish_playlist(folder, playlist)
+                # The poster waits until the first segment can be played
+                if index == 0:
+                    poster = publish_poster(image_path, user_id, video_count, workspace)
+                timings[stage] = round(time.perf_counter() - start, 3)
+                notify(stage, 'done')
+    except Exception:
+        # The playlist was handed out already, so end it rather than leave players waiting for more
+        playlist.end()
+        try:
+            publish_playlist(folder, playlist)
+        except Exception:
+            # Report the error that stopped the render, not this one
+            pass
+        raise
+    finally:
+        image_pool.shutdown(wait=True, cancel_futures=True)
+        voice_pool.shutdown(wait=True, cancel_futures=True)
+
+    playlist.end()
+    link = publish_playlist(folder, playlist)
+    write_to_firestore(user_id=user_id, video_url=link, video_title=results['title'],
+                       poster=poster, duration=round(offset, 1), size=size)
+    record_timings(timings)
+    return link, timings
+
+def create_chat(turns:list):
+    '''Start a chat session with the model, seeded with earlier turns
+    Args:
+        turns (list): The earlier turns, each with a 'role' and a 'text'
+    Returns:
+        Chat: The chat session
+    '''
+    from google.genai import types
+
+    history = [types.Content(role=turn['role'], parts=[types.Part(text=turn['text'])]) for turn in turns]
+    # Messages go through the gateway like every other request to the text model
+    return gateway.chat(get_client().chats.create(model=TEXT_MODEL, history=history), TEXT_MODEL)
 
-def search_all_videos(collection_ref,query:str):
-    """Search all videos in a Firestore collection.
+def load_chat_history(user_id:str):
+    '''Load the persisted chat history of a user
     Args:
-        collection_ref: A reference to the Firestore collection.
-        query (str): The search query to match against video titles.
+        user_id (str): The user ID
     Returns:
-        A list containing all videos.
-    """
-    # Initialize an empty list to store the video data
-    video_list = []
-
-    # Stream all documents in the current collection
-    for doc in collection_ref.stream():
-        doc_data = doc.to_dict()  # Convert document to dictionary
-        doc_data = doc_data["generated_videos"]
-        # Iterate through each document in the collection
-        for video in doc_data:
-            if "title" in video:
-                title = video["title"]
-                title = title.lower()
-                if query.lower() in title:
-                    # Check if the query is in the title
-                    video_list.append(video)
-    video_list.sort(key=lambda x: x['views'], reverse=True)
-    return video_list
+        list: The turns, each with a 'role' and a 'text'
+    '''
+    chat = get_db().collection('chats').document(user_id).get()
+    count_firestore('read')
+    return (chat.to_dict() or {}).get('turns', []) if chat.exists else []
+
+def save_chat_history(user_id:str, turns:list):
+    '''Persist the compacted chat history of a user
+    Args:
+        user_id (str): The user ID
+        turns (list): The turns, each with a 'role' and a 'text'
+    Returns:
+        None
+    '''
+    get_db().collection('chats').document(user_id).set({'turns': turns})
+    count_firestore('write')
+
+def read_response_text(response):
+    '''Get the text of a chat response
+    Args:
+        response: The response of the model
+    Returns:
+        str: The text of the response
+    '''
+    # Handle different response types
+    if isinstance(response, str):
+        return response
+    elif hasattr(response, 'text'):
+        return response.text
+    elif isinstance(response, dict) and 'text' in response:
+        return response['text']
+    raise ValueError(f"Unexpected response type: {type(response)}")
+
+def warm_up():
+    '''Create the shared clients and build the catalog ahead of the first request
+    Returns:
+        None
+    '''
+    services.warm_up(['db', 'bucket', 'genai'])
+    ensure_catalog()
+    curriculum.get()
+    if WARMUP_RENDER:
+        services.warm_up(['tts'])
+
+def run_video_job(job:dict, on_stage):
+    '''Run the video pipeline for a background job
+    Args:
+        job (dict): The job to run, with the 'user_id' and 'text' of the request
+        on_stage (callable): Called with each stage name and its new status
+    Returns:
+        dict: The video link and the time spent in each stage
+    '''
+    # The job ID is the trace ID of everything the job does
+    token = start_trace(job['job_id'], 'job')
+    try:
+        if job['options'].get('stream'):
+            link, timings = stream_video(job['text'], job['user_id'], job['options']['video_count'], on_stage=on_stage)
+            return {'link': link, 'timings': timings}
+        if job['options'].get('batch'):
+            return run_batch_job(job, on_stage)
+        if job['options'].get('upgrade'):
+            return run_upgrade_job(job, on_stage)
+        results, timings = run_video_pipeline(job['text'], job['user_id'], on_stage=on_stage)
+        return {'link': results['link'], 'timings': timings}
+    finally:
+        end_trace(token)
+
+def next_window_start(window:str, now:float=None):
+    '''Get the time the next off-peak window opens
+    Args:
+        window (str): The UTC hours of the window as "start-end", it may wrap past midnight
+        now (float): The current Unix time
+    Returns:
+        float: The Unix time the window opens, now if it is open
+    '''
+    now = time.time() if now is None else now
+    start, end = (int(hour) for hour in window.split('-'))
+    hour = time.gmtime(now).tm_hour
+    if (start <= hour < end) if start < end else (hour >= start or hour < end):
+        return now
+    opens = now - now % 86400 + start * 3600
+    return opens if opens > now else opens + 86400
+
+def curriculum_questions(path:str):
+    '''Collect the chapters below a node of the learning-path tree that have no video yet
+    Args:
+        path (str): The keys from the root of the tree to the node, separated by '/', empty for the whole tree
+    Returns:
+        list: A question for every chapter
+    '''
+    curriculum.get()
+    node = curriculum.tree
+    for key in filter(None, path.split('/')):
+        # Lists of subtopics and chapters are indexed by position
+        node = node[int(key)] if isinstance(node, list) else node[key]
+    questions = []
+    def collect(node, parent:str=None):
+        if isinstance(node, list):
+            for item in node:
+                collect(item, parent)
+        elif isinstance(node, dict):
+            title = node.get('title') if isinstance(node.get('title'), str) else parent
+            for chapter in node.get('chapters') or []:
+                if isinstance(chapter, dict) and chapter.get('title') and not chapter.get('video_url'):
+                    # The subtopic tells the model which sense of the chapter title is meant
+                    questions.append(f"{chapter['title']} in {title}" if title else chapter['title'])
+            for key, value in node.items():
+                if key != 'chapters':
+                    collect(value, title)
+    collect(node)
+    return questions
+
+def find_library_video(question:str, user_id:str):
+    '''Get the video already generated for a batch question, if there is one'''
+    return video_store.find_video(user_id, 'question', normalize_question(question))
+
+def submit_batch(questions:list, user_id:str, off_peak:bool=False):
+    '''Queue a batch job for every question that has no video yet
+    Args:
+        questions (list): The questions to generate videos for
+        user_id (str): The user ID to generate the videos for
+        off_peak (bool): Hold the jobs until the next BATCH_WINDOW opens
+    Returns:
+        dict: The batch ID, the number of queued jobs and the questions that were skipped
+    '''
+    batch_id = uuid.uuid4().hex
+    not_before = next_window_start(BATCH_WINDOW) if off_peak and BATCH_WINDOW else 0
+    # The library user has no account, its document only holds the video counter
+    video_store.ensure_user(user_id)
+    seen = set()
+    queued, skipped = 0, []
+    for question in questions:
+        key = normalize_question(question)
+        if not key or key in seen:
+            continue
+        seen.add(key)
+        if find_library_video(question, user_id) is not None:
+            skipped.append(question)
+            continue
+        # Resumable jobs are run again after a restart, they check for their video first
+        job_queue.submit(user_id, question, {'batch': True, 'resumable': True}, priority=BATCH, batch_id=batch_id, not_before=not_before)
+        queued += 1
+    return {'batch_id': batch_id if queued else None, 'queued': queued, 'skipped': skipped, 'not_before': not_before}
+
+def run_batch_job(job:dict, on_stage):
+    '''Generate the video of one batch question, unless an earlier run already did
+    Args:
+        job (dict): The batch job
+        on_stage (callable): Called with each stage name and its new status
+    Returns:
+        dict: The video link and the time spent in each stage
+    '''
+    existing = find_library_video(job['text'], job['user_id'])
+    if existing is not None:
+        return {'link': existing['link'], 'timings': {}}
+    # Nobody is waiting for a batch video, so it is encoded at final quality straight away
+    results, timings = run_video_pipeline(job['text'], job['user_id'], on_stage=on_stage, draft=False,
+                                          fields={'question': normalize_question(job['text'])})
+    return {'link': results['link'], 'timings': timings}
+
+# Flush the buffered views in the background, and once more on shutdown
+view_counter.start()
+atexit.register(view_counter.stop)
+
+# Live chat sessions, their compacted history is persisted in the chats collection
+chat_sessions = ChatSessionManager(
+    create_chat,
+    load_chat_history,
+    save_chat_history,
+    max_sessions=CHAT_MAX_SESSIONS,
+    idle_timeout=CHAT_IDLE_TIMEOUT,
+    max_turns=CHAT_MAX_TURNS,
+)
+
+# Final-quality encodes of the drafts, behind the interactive renders
+# Run the video jobs on their own pool so they never hold the request threads
+job_queue = JobQueue(JobStore(JOBS_DB), run_video_job, max_workers=VIDEO_WORKERS, max_background=BATCH_WORKERS)
+# Pick up the jobs that were left over by the previous instance
+job_queue.recover()
+
+if WARMUP_ON_START:
+    threading.Thread(target=warm_up, daemon=True).start()
 
 app = Flask(__name__)
 CORS(app)
 
+@app.before_request
+def start_request_trace():
+    # Reuse the ID of a caller or a load balancer, so logs can be joined across services
+    request_id = request.headers.get('X-Request-ID') or request.headers.get('X-Cloud-Trace-Context', '').split('/')[0]
+    g.trace_token = start_trace(request_id or None, request.endpoint or 'unknown')
+    g.started = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    metrics.observe('edith_request_seconds', time.perf_counter() - g.started,
+                    endpoint=request.endpoint or 'unknown', status=str(response.status_code))
+    response.headers['X-Request-ID'] = current_request_id()
+    return response
+
+@app.teardown_request
+def end_request_trace(error=None):
+    token = g.pop('trace_token', None)
+    if token is not None:
+        end_trace(token)
+
 @app.route('/',methods=['POST'])
 def generate_video():
    try:
@@ -491,38 +1562,114 @@ def generate_video():
         # Validate the request
         if not text_data or user_id is None:
             return jsonify({'Error': 'Invalid request'}), 404
-        # Format the text data
-        response_text = generate_answer_para(text_data)
-        # Generate a title for the text data
-        title = generate_title(text_data)
-        # Split the text data into sentences
-        text_data = split_text(response_text)
-        # Generate image prompts for each sentence
-        prompt_list = generate_answer_image_prompts(text_data)
-        # Generate images for each prompt
-        images = generate_images(prompt_list)
-        # Generate a voice for the text
-        voice_bytes = generate_voice(response_text,user_name=user_id)
-        # Get the duration of the audio
-        duration = get_audio_duration(voice_bytes)
-        # Adjust the frame length to match the desired duration
-        total = adjust_frame_length(duration,response_text)
-        # Merge the images into a video clip
-        merge_images(images,total,user_id)
-        # Count the number of videos in the user's folder
-        video_count = count_videos_in_user_folder(user_id)
-        # Upload the video to Firebase Storage
-        video_url = upload_to_firebase_storage(f"{user_id}_output_video.mp4", user_id,video_count)
-        # Write the video URL to Firestore
-        video_list = write_to_firestore(user_id=user_id, video_url=video_url,video_title=title)
-        # Return the video URL and success message
-        return jsonify({'Success':'success','link':video_url}),200
+        # Run the stages, independent branches overlap with each other
+        results, timings = run_video_pipeline(text_data, user_id, draft=bool(request.json.get('draft', DRAFT_RENDER)))
+        # Return the video URL, success message and the time spent in each stage
+        # A draft link keeps working, the final video replaces it at the same URL
+        video = results['video']
+        return jsonify({'Success':'success','link':results['link'],'poster':video['poster'],'quality':video['quality'],'timings':timings}),200
    except Exception as e:
-        # Check and delete files if they exist
-        if os.path.exists(f"{user_id}_output.mp3"):
-            os.remove(f"{user_id}_output.mp3")
-        if os.path.exists(f"{user_id}_output_video.mp4"):
-            os.remove(f"{user_id}_output_video.mp4")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/jobs', methods=['POST'])
+def submit_video_job():
+    try:
+        data = request.get_json()
+        # Extract the text data and user ID from the request
+        text_data = data.get('text')
+        user_id = data.get('user_id')
+        # Validate the request
+        if not text_data or user_id is None:
+            return jsonify({'error': 'Invalid request'}), 400
+        # Queue the video, the pipeline runs on the job workers
+        job = job_queue.submit(user_id, text_data)
+        return jsonify({'job_id': job['job_id'], 'status': job['status']}), 202
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/stream', methods=['POST'])
+def stream_video_route():
+    try:
+        data = request.get_json()
+        # Extract the text data and user ID from the request
+        text_data = data.get('text')
+        user_id = data.get('user_id')
+        # Validate the request
+        if not text_data or user_id is None:
+            return jsonify({'error': 'Invalid request'}), 400
+        # Publish an empty playlist so the link can be handed out straight away
+        video_count = count_videos_in_user_folder(user_id)
+        link = publish_playlist(f"users/{user_id}/videos/{video_count}", HlsPlaylist(HLS_TARGET_DURATION))
+        # The segments are added to the playlist by the job as each sentence is rendered
+        job = job_queue.submit(user_id, text_data, {'stream': True, 'video_count': video_count})
+        return jsonify({'job_id': job['job_id'], 'status': job['status'], 'link': link}), 202
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/batches', methods=['POST'])
+def submit_batch_route():
+    try:
+        data = request.get_json()
+        # Take the questions as a list, and the chapters of a learning path by their path in the tree
+        questions = list(data.get('questions') or [])
+        if data.get('path') is not None:
+            try:
+                questions += curriculum_questions(data['path'])
+            except (LookupError, TypeError, ValueError):
+                return jsonify({'error': 'Path not found'}), 404
+        user_id = data.get('user_id') or LIBRARY_USER_ID
+        # Validate the request
+        if not questions or not all(isinstance(question, str) for question in questions):
+            return jsonify({'error': 'Invalid request'}), 400
+        if len(questions) > BATCH_MAX_ITEMS:
+            return jsonify({'error': f'A batch holds at most {BATCH_MAX_ITEMS} questions'}), 400
+        batch = submit_batch(questions, user_id, off_peak=bool(data.get('off_peak')))
+        return jsonify(batch), 202
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/batches/<batch_id>', methods=['GET'])
+def get_batch(batch_id):
+    try:
+        # The progress of a batch survives restarts, it is read from the job database
+        batch = job_queue.store.batch(batch_id)
+        if batch is None:
+            return jsonify({'error': 'Batch not found'}), 404
+        return jsonify(batch), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/_ah/warmup', methods=['GET'])
+def warmup():
+    # App Engine sends this before routing traffic to a new instance
+    try:
+        warm_up()
+        return jsonify({'Success':'success'}),200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/gateway', methods=['GET'])
+def gateway_stats():
+    # Queue depth, concurrency limit and throttling of each model
+    return jsonify(gateway.stats()), 200
+
+@app.route('/metrics', methods=['GET'])
+def metrics_route():
+    # Prometheus scrapes the counters and latency histograms of this instance
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_video_job(job_id):
+    try:
+        job = job_queue.store.get(job_id)
+        if job is None:
+            return jsonify({'error': 'Job not found'}), 404
+        # Surface the link of a finished job next to its status and stage progress
+        result = job.pop('result') or {}
+        job['link'] = result.get('link')
+        job['timings'] = result.get('timings')
+        return jsonify(job), 200
+    except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
@@ -545,29 +1692,43 @@ def chat():
 
     # Generate the AI's response using the Gemini API
     try:
-           
-        # Start a chat session with the conversation history
-        chat_session = client.chats.create(
-            model="gemini-2.0-flash",
-        )
-
-        # Send the latest user message to the model
-        response = chat_session.send_message(user_message)
-
-        # Handle different response types
-        if isinstance(response, str):
-            response_text = response
-        elif hasattr(response, 'text'):
-            response_text = response.text
-        elif isinstance(response, dict) and 'text' in response:
-            response_text = response['text']
-        else:
-            raise ValueError(f"Unexpected response type: {type(response)}")
+        # Continue the user's chat session, it remembers the earlier messages
+        response_text = chat_sessions.send(user_id, user_message, read_response_text)
         # Return the AI's response
         return jsonify({"response": response_text})
     
     except Exception as e:
         return jsonify({"error": f"An error occurred: {str(e)}"}), 500    
+
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """
+    Streaming variant of /chat.
+    Expects a JSON payload with 'user_id' and 'message'.
+    Returns the AI's response as server-sent events, one per generated chunk,
+    followed by a 'done' event.
+    """
+    data = request.get_json()
+
+    # Extract user_id and message from the request
+    user_id = data.get('user_id')
+    user_message = data.get('message')
+
+    if not user_id or not user_message:
+        return jsonify({"error": "Both 'user_id' and 'message' are required."}), 400
+
+    def events():
+        try:
+            # Send every chunk the moment the model produces it
+            for text in chat_sessions.stream(user_id, user_message):
+                yield f"data: {json.dumps({'text': text})}\n\n"
+            yield "event: done\ndata: {}\n\n"
+        except Exception as e:
+            yield f"event: error\ndata: {json.dumps({'error': f'An error occurred: {str(e)}'})}\n\n"
+
+    # Disable proxy buffering so the chunks reach the client straight away
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
     
 @app.route('/create_user', methods = ['POST'])
 def create_user():
@@ -576,23 +1737,28 @@ def create_user():
 
         # Extract user_id and message from the request
         user_id = data.get('user_id')   
-        data = {'generated_videos':[],'video_count':0}
-        db.collection("users").document(user_id).set(data)
+        data = {'video_count':0,'videos_migrated':True}
+        get_db().collection("users").document(user_id).set(data)
+        count_firestore('write')
         return jsonify({'Success':'success'}),200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/get_user_videos', methods = ['POST'])
+@app.route('/get_user_videos', methods = ['GET', 'POST'])
 def get_user_videos():
     try:
-        data = request.get_json()
+        # A GET can be answered with a 304, POST is kept for older clients
+        data = request.get_json() if request.method == 'POST' else request.args
         # Extract user_id and message from the request
         user_id = data.get('user_id')
-        user = db.collection('users').document(user_id).get()
-        user_dict = user.to_dict()
-        video_list = user_dict["generated_videos"]
-        return jsonify({'videos':video_list}),200
+        def build():
+            # Read the video documents of the user, oldest first
+            video_list = video_store.list_user_videos(user_id)
+            # Add the views that are still buffered in memory
+            return {'videos': view_counter.merge(video_list)}
+        # The videos are read every time, the hash of the body spares an unchanged transfer
+        return response_cache.respond(request, f"user_videos:{user_id}", build, cache_control='private, no-cache')
     
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -600,25 +1766,31 @@ def get_user_videos():
 @app.route('/get_all_videos', methods = ['GET'])
 def get_all_videos():
     try:
-        users = db.collection('users').stream()
-        all_videos = []
-        for user in users:
-            user_dict = user.to_dict()
-            video_list = user_dict["generated_videos"]
-            if len(video_list) > 0:
-                all_videos.extend(video_list)
-        all_videos = sorted(all_videos, key=lambda x: x['views'], reverse=True)
-        return jsonify({'videos':all_videos}),200
+        # Extract the page size, and either a cursor or a 1-based page number
+        limit = max(1, min(request.args.get('limit', FEED_PAGE_SIZE, type=int), FEED_MAX_LIMIT))
+        cursor = request.args.get('cursor')
+        page = request.args.get('page', 1, type=int)
+        if page < 1:
+            return jsonify({'error': 'page must be 1 or more'}), 400
+        # Read the page straight from the views-ordered catalog
+        ensure_catalog()
+        def build():
+            videos, next_cursor = catalog.feed(limit, cursor=cursor, offset=(page - 1) * limit)
+            return {'videos': videos, 'next_cursor': next_cursor}
+        # The page is only rebuilt when the catalog changed since it was last sent
+        return response_cache.respond(request, "feed:" + json.dumps([limit, cursor, page]), build, version=catalog.version)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/get_path', methods = ['GET'])
 def get_path():
     try:
-        doc = db.collection('domains')
-        # Fetch all documents in the collection
-        documents = fetch_collection_recursively(doc)
-        return jsonify(documents),200
+        # Serve the pre-serialized tree, a client that already has it gets a 304
+        body, etag = curriculum.get()
+        # Clients may keep the tree but must check it is still current
+        return response_cache.respond(request, 'path', lambda: body, version=etag)
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -637,16 +1809,29 @@ def increment_views_route():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/search', methods = ['POST'])
+@app.route('/search', methods = ['GET', 'POST'])
 def search():
     try:
-        data = request.get_json()
+        # A GET can be answered with a 304, POST is kept for older clients
+        data = request.get_json() if request.method == 'POST' else request.args
         # Extract query from the request
-        query = data.get('query')
-        # Fetch all videos from Firestore
-        doc = db.collection('users')
-        video_list = search_all_videos(doc,query)
-        return jsonify({'videos':video_list}),200
+        query = data.get('query') or ''
+        # Extract the optional page of results from the request
+        limit = data.get('limit')
+        try:
+            limit = int(limit) if limit is not None else None
+            offset = int(data.get('offset', 0))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'limit and offset must be integers'}), 400
+        # Negative values would slice the results from the end
+        if (limit is not None and limit < 1) or offset < 0:
+            return jsonify({'error': 'limit must be positive and offset must not be negative'}), 400
+        # Look the query up in the catalog instead of scanning Firestore
+        ensure_catalog()
+        def build():
+            video_list, total = catalog.search(query, limit=limit, offset=offset)
+            return {'videos': video_list, 'total': total}
+        return response_cache.respond(request, "search:" + json.dumps([query, limit, offset]), build, version=catalog.version)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -0,0 +1,87 @@
+# Bitrates in kbps of MPEG-1 and MPEG-2/2.5 Layer III frames, by bitrate index
+MPEG1_BITRATES = [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320]
+MPEG2_BITRATES = [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]
+# Sample rates in Hz by MPEG version bits and sample rate index
+SAMPLE_RATES = {
+    3: [44100, 48000, 32000],  # MPEG-1
+    2: [22050, 24000, 16000],  # MPEG-2
+    0: [11025, 12000, 8000],   # MPEG-2.5
+}
+
+
+def strip_id3(data:bytes):
+    '''Remove a leading ID3v2 tag from MP3 data
+    Args:
+        data (bytes): The MP3 data
+    Returns:
+        bytes: The MP3 frames without the tag
+    '''
+    if len(data) < 10 or data[:3] != b"ID3":
+        return data
+    # The tag size is a 28 bit synchsafe integer that excludes the 10 byte header
+    size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+    footer = 10 if data[5] & 0x10 else 0
+    return data[10 + size + footer:]
+
+
+def parse_frame_header(data:bytes, offset:int):
+    '''Parse the MPEG audio Layer III frame header at an offset
+    Args:
+        data (bytes): The MP3 data
+        offset (int): The offset of the header
+    Returns:
+        tuple: The frame length in bytes and the frame duration in seconds, or None if
+               there is no valid header at the offset
+    '''
+    if offset + 4 > len(data) or data[offset] != 0xFF or data[offset + 1] & 0xE0 != 0xE0:
+        return None
+    version = (data[offset + 1] >> 3) & 0x3
+    layer = (data[offset + 1] >> 1) & 0x3
+    bitrate_index = data[offset + 2] >> 4
+    sample_rate_index = (data[offset + 2] >> 2) & 0x3
+    padding = (data[offset + 2] >> 1) & 0x1
+    # Only Layer III with a known bitrate and sample rate is accepted
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+    sample_rate = SAMPLE_RATES[version][sample_rate_index]
+    if version == 3:
+        bitrate = MPEG1_BITRATES[bitrate_index] * 1000
+        samples = 1152
+    else:
+        bitrate = MPEG2_BITRATES[bitrate_index] * 1000
+        samples = 576
+    length = samples // 8 * bitrate // sample_rate + padding
+    return length, samples / sample_rate
+
+
+def mp3_duration(data:bytes):
+    '''Get the exact duration of MP3 data by walking its frame headers, without decoding it
+    Args:
+        data (bytes): The MP3 data
+    Returns:
+        float: The duration in seconds
+    '''
+    data = strip_id3(data)
+    offset = 0
+    duration = 0.0
+    while offset + 4 <= len(data):
+        header = parse_frame_header(data, offset)
+        if header is None:
+            # Skip garbage between frames until the next frame sync
+            offset += 1
+            continue
+        length, frame_duration = header
+        duration += frame_duration
+        offset += length
+    return duration
+
+
+def concat_mp3(segments:list):
+    '''Join MP3 segments into one MP3 stream
+    Args:
+        segments (list): The MP3 data of each segment, in order
+    Returns:
+        tuple: The joined MP3 data and the duration in seconds of each segment
+    '''
+    frames = [strip_id3(segment) for segment in segments]
+    return b"".join(frames), [mp3_duration(segment) for segment in frames]
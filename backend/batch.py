@@ -0,0 +1,92 @@
+'''Queue videos ahead of time on a running backend, for a list of questions or a learning path
+
+The questions are sent to POST /batches, which skips every question that already
+has a video and runs the rest as batch jobs behind the interactive requests:
+
+    python batch.py --path Domains/Science --off-peak
+    python batch.py --questions questions.txt --wait
+    python batch.py --status 3f2a...
+
+Progress is kept by the backend, so a batch survives restarts of either side and
+its status can be checked again at any time.
+'''
+import argparse
+import json
+import os
+import sys
+import time
+import urllib.error
+import urllib.request
+
+
+def call(url:str, method:str="GET", body:dict=None):
+    '''Send a JSON request to the backend
+    Args:
+        url (str): The URL of the endpoint
+        method (str): The HTTP method
+        body (dict): The JSON body, if any
+    Returns:
+        dict: The JSON response
+    '''
+    data = json.dumps(body).encode("utf-8") if body is not None else None
+    request = urllib.request.Request(url, data=data, method=method, headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return json.load(response)
+    except urllib.error.HTTPError as e:
+        sys.exit(f"{method} {url} failed with {e.code}: {e.read().decode('utf-8', 'replace')}")
+
+
+def read_questions(path:str):
+    '''Read one question per line, ignoring blank lines and lines starting with #'''
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+
+def wait(base_url:str, batch_id:str, interval:float):
+    '''Print the progress of a batch until every job has finished'''
+    while True:
+        batch = call(f"{base_url}/batches/{batch_id}")
+        print(f"{batch['progress']:.0%} {json.dumps(batch['statuses'])}")
+        if batch["progress"] >= 1:
+            return batch
+        time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Queue videos ahead of time on a running backend")
+    parser.add_argument("--url", default=os.getenv("EDITH_URL", "http://localhost:8080"), help="Base URL of the backend")
+    parser.add_argument("--questions", help="File with one question per line")
+    parser.add_argument("--path", help="Path of a node of the learning-path tree, e.g. Domains/Science, empty for the whole tree")
+    parser.add_argument("--user-id", help="Owner of the videos, defaults to the library user of the backend")
+    parser.add_argument("--off-peak", action="store_true", help="Hold the jobs until the off-peak window of the backend opens")
+    parser.add_argument("--status", help="Show the progress of a batch instead of queuing one")
+    parser.add_argument("--wait", action="store_true", help="Keep printing the progress until the batch has finished")
+    parser.add_argument("--interval", type=float, default=30, help="Seconds between progress checks")
+    args = parser.parse_args()
+    base_url = args.url.rstrip("/")
+
+    if args.status:
+        batch = wait(base_url, args.status, args.interval) if args.wait else call(f"{base_url}/batches/{args.status}")
+        print(json.dumps(batch, indent=2))
+        return
+    if args.questions is None and args.path is None:
+        parser.error("Give --questions, --path or --status")
+
+    body = {"off_peak": args.off_peak}
+    if args.questions:
+        body["questions"] = read_questions(args.questions)
+    if args.path is not None:
+        body["path"] = args.path
+    if args.user_id:
+        body["user_id"] = args.user_id
+    batch = call(f"{base_url}/batches", "POST", body)
+    print(f"Queued {batch['queued']} videos, skipped {len(batch['skipped'])} that already exist")
+    if batch["batch_id"]:
+        print(f"Batch {batch['batch_id']}")
+        if args.wait:
+            wait(base_url, batch["batch_id"], args.interval)
+
+
+if __name__ == "__main__":
+    main()
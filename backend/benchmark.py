@@ -0,0 +1,354 @@
+'''Benchmark the backend offline, against in-process fakes of every Google service
+
+The Flask app is driven through its test client at a fixed concurrency, and the
+latency percentiles, throughput and peak RSS of each endpoint and of each stage of
+the video pipeline are reported and can be saved as a JSON baseline:
+
+    python benchmark.py --requests 50 --concurrency 8 --output baselines/local.json
+    python benchmark.py --compare baselines/local.json --tolerance 0.2
+
+A run compared against a baseline exits with status 1 when the p95 latency of an
+endpoint or stage regressed by more than the tolerance.
+
+The peak RSS of an endpoint is measured from a reset of the kernel's high-water
+mark on Linux, so each endpoint reports its own peak. The peak RSS of a stage is
+the highest RSS sampled while the stage ran, which includes whatever ran beside
+it, so run with --concurrency 1 to attribute memory to single stages.
+'''
+import argparse
+import bisect
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+ENDPOINTS = ("generate_video", "search", "get_all_videos", "increment_views", "chat")
+
+
+def percentile(values:list, fraction:float):
+    '''Get a percentile of a list of numbers by the nearest-rank method
+    Args:
+        values (list): The numbers
+        fraction (float): The percentile as a fraction, for example 0.95
+    Returns:
+        float: The percentile, or None for an empty list
+    '''
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(round(fraction * len(ordered))) - 1))]
+
+
+def summarize(latencies:list, wall_time:float=None, errors:int=0):
+    '''Summarize the latencies of a set of calls
+    Args:
+        latencies (list): The latency of each call in seconds
+        wall_time (float): The time it took to make every call, for the throughput
+        errors (int): The number of calls that failed
+    Returns:
+        dict: The count, errors, percentiles in milliseconds and throughput per second
+    '''
+    summary = {"count": len(latencies), "errors": errors}
+    for name, fraction in (("p50_ms", 0.5), ("p95_ms", 0.95), ("p99_ms", 0.99)):
+        value = percentile(latencies, fraction)
+        summary[name] = round(value * 1000, 2) if value is not None else None
+    if wall_time:
+        summary["throughput_per_s"] = round(len(latencies) / wall_time, 2)
+    return summary
+
+
+def proc_status_mb(field:str):
+    '''Read a memory field of /proc/self/status in MiB, or None where there is no /proc'''
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    '''Reset the peak resident set size of this process to its current size
+    Returns:
+        bool: Whether the peak could be reset, it needs Linux 4.0 or later
+    '''
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    '''Get the peak resident set size of this process since the last reset, in MiB'''
+    peak = proc_status_mb("VmHWM")
+    if peak is not None:
+        return peak
+    # Without /proc only the peak of the whole run is known, Linux reports KiB and macOS bytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+class StageMemory:
+    '''Samples the resident set size while tracking when each pipeline stage runs'''
+
+    def __init__(self, interval:float=0.01):
+        self.interval = interval
+        self.samples = []
+        self.runs = []
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, name="rss-sampler", daemon=True)
+
+    def sample(self):
+        while not self.stopped.is_set():
+            rss = proc_status_mb("VmRSS")
+            if rss is None:
+                return
+            self.samples.append((time.perf_counter(), rss))
+            self.stopped.wait(self.interval)
+
+    def track(self, name:str, func):
+        '''Wrap a stage function so the times it runs are recorded'''
+        def tracked(*args):
+            start = time.perf_counter()
+            try:
+                return func(*args)
+            finally:
+                self.runs.append((name, start, time.perf_counter()))
+        return tracked
+
+    def instrument(self, backend):
+        '''Track every stage of the video pipelines the backend builds from now on'''
+        build = backend.build_video_pipeline
+        def build_tracked(*args, **kwargs):
+            pipeline = build(*args, **kwargs)
+            for name, (func, deps) in list(pipeline.stages.items()):
+                pipeline.stages[name] = (self.track(name, func), deps)
+            return pipeline
+        backend.build_video_pipeline = build_tracked
+        self.thread.start()
+
+    def peaks(self):
+        '''Get the highest RSS sampled while each stage ran
+        Returns:
+            dict: The peak in MiB by stage name
+        '''
+        self.stopped.set()
+        self.thread.join()
+        times = [t for t, _ in self.samples]
+        peaks = {}
+        for name, start, end in self.runs:
+            # The sample taken just before the start counts, a short stage may fall between two samples
+            low = max(0, bisect.bisect_left(times, start) - 1)
+            high = bisect.bisect_right(times, end)
+            for _, rss in self.samples[low:high]:
+                peaks[name] = max(peaks.get(name, 0.0), rss)
+        return peaks
+
+
+def parse_profiles(value:str):
+    '''Parse a list of service=number pairs, for example "imagen=2.0,tts=0.3"'''
+    pairs = {}
+    for item in filter(None, (value or "").split(",")):
+        name, _, number = item.partition("=")
+        pairs[name.strip()] = float(number)
+    return pairs
+
+
+def load_app(args, workdir:str):
+    '''Import the app with every service replaced by a fake
+    Args:
+        args (argparse.Namespace): The benchmark settings
+        workdir (str): The directory the app keeps its files in during the run
+    Returns:
+        tuple: The app module and the fake profiles by service name
+    '''
+    # Keep the job database, caches and snapshots of the run away from the real ones
+    os.environ.update({
+        "JOBS_DB": os.path.join(workdir, "jobs.db"),
+        "CACHE_DIR": os.path.join(workdir, "cache"),
+        "CATALOG_PATH": os.path.join(workdir, "catalog.json"),
+        "SCRATCH_ROOT": workdir,
+        "CATALOG_LISTENER": "0",
+        "CURRICULUM_LISTENER": "0",
+        "WARMUP_ON_START": "0",
+    })
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as backend
+    import fakes
+
+    latency = {"text": 0.8, "imagen": 2.0, "tts": 0.3, "firestore": 0.01, "storage": 0.05}
+    latency.update(parse_profiles(args.latency))
+    failure_rate = parse_profiles(args.failure_rate)
+    profiles = {
+        name: fakes.ServiceProfile(name, latency=seconds * args.time_scale, jitter=seconds * args.time_scale * args.jitter,
+                                   failure_rate=failure_rate.get(name, 0.0), seed=args.seed)
+        for name, seconds in latency.items()
+    }
+    db = fakes.FakeFirestore(profiles["firestore"])
+    backend.services.override("firebase", object())
+    backend.services.override("db", db)
+    backend.services.override("bucket", fakes.FakeBucket(profiles["storage"]))
+    backend.services.override("genai", fakes.FakeGenaiClient(fakes.FakeModels(profiles["text"], profiles["imagen"], sentences=args.sentences)))
+    backend.services.override("tts", fakes.FakeTextToSpeech(profiles["tts"]))
+    seed_videos(backend, db, args.users, args.videos_per_user)
+    return backend, profiles
+
+
+def seed_videos(backend, db, users:int, videos_per_user:int):
+    '''Fill the fake Firestore with users and videos for the listing endpoints to read'''
+    words = ["black", "holes", "photosynthesis", "roman", "empire", "quantum", "computing", "volcano", "history", "music"]
+    for user in range(users):
+        user_id = f"user-{user}"
+        db.write(("users", user_id), {"video_count": videos_per_user, "videos_migrated": True}, merge=False)
+        for number in range(videos_per_user):
+            title = " ".join(words[(user + number + offset) % len(words)] for offset in range(3))
+            link = f"https://storage.googleapis.com/fake-bucket/users/{user_id}/videos/{number}/video.mp4"
+            backend.video_store.add_video(user_id, link, title, views=(user * 7 + number * 13) % 1000)
+
+
+def request_for(endpoint:str, index:int, args):
+    '''Build the request made by one call to an endpoint
+    Returns:
+        tuple: The method, the path and the JSON body
+    '''
+    user_id = f"user-{index % args.users}"
+    if endpoint == "generate_video":
+        # Every question is new unless the result cache is being measured too
+        question = index % 5 if args.cache else index
+        return "POST", "/", {"text": f"Benchmark question number {question}", "user_id": user_id}
+    if endpoint == "search":
+        return "POST", "/search", {"query": ["black", "roman emp", "quantum", "volc"][index % 4], "limit": 25}
+    if endpoint == "get_all_videos":
+        return "GET", f"/get_all_videos?page={index % 4 + 1}", None
+    if endpoint == "increment_views":
+        link = f"https://storage.googleapis.com/fake-bucket/users/{user_id}/videos/{index % args.videos_per_user}/video.mp4"
+        return "POST", "/increment_views", {"user_id": user_id, "video_url": link}
+    return "POST", "/chat", {"user_id": user_id, "message": f"Tell me more about topic {index}"}
+
+
+def run_endpoint(backend, endpoint:str, count:int, concurrency:int, args):
+    '''Call an endpoint a number of times at a fixed concurrency
+    Returns:
+        tuple: The endpoint summary and the time spent in each pipeline stage, by stage
+    '''
+    latencies = []
+    stages = {}
+    errors = 0
+
+    def call(index:int):
+        method, path, body = request_for(endpoint, index, args)
+        # The Flask test client is not shared between threads
+        client = backend.app.test_client()
+        start = time.perf_counter()
+        result = client.open(path, method=method, json=body)
+        return time.perf_counter() - start, result.status_code, result.get_json(silent=True) or {}
+
+    # Each endpoint reports its own peak, not the peak of the endpoints before it
+    reset_peak_rss()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for latency, status, payload in executor.map(call, range(count)):
+            if status >= 400:
+                errors += 1
+                continue
+            latencies.append(latency)
+            for stage, seconds in (payload.get("timings") or {}).items():
+                stages.setdefault(stage, []).append(seconds)
+    wall_time = time.perf_counter() - start
+    summary = summarize(latencies, wall_time, errors)
+    summary["peak_rss_mb"] = peak_rss_mb()
+    return summary, stages
+
+
+def compare(results:dict, baseline:dict, tolerance:float):
+    '''Find the endpoints and stages whose p95 latency regressed against a baseline
+    Returns:
+        list: A description of each regression
+    '''
+    regressions = []
+    for section in ("endpoints", "stages"):
+        for name, summary in results.get(section, {}).items():
+            before = baseline.get(section, {}).get(name, {}).get("p95_ms")
+            after = summary.get("p95_ms")
+            if before and after and after > before * (1 + tolerance):
+                regressions.append(f"{section[:-1]} {name}: p95 {before} ms -> {after} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the backend against fake Google services")
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS), help="Comma separated endpoints to drive, from " + ", ".join(ENDPOINTS))
+    parser.add_argument("--requests", type=int, default=50, help="Number of calls per endpoint")
+    parser.add_argument("--video-requests", type=int, default=None, help="Number of generate_video calls, defaults to --requests")
+    parser.add_argument("--concurrency", type=int, default=8, help="Number of calls in flight at once")
+    parser.add_argument("--latency", default="", help="Mean latency in seconds per service, e.g. text=0.8,imagen=2,tts=0.3,firestore=0.01,storage=0.05")
+    parser.add_argument("--failure-rate", default="", help="Fraction of failed calls per service, e.g. imagen=0.05")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Latency jitter as a fraction of the mean")
+    parser.add_argument("--time-scale", type=float, default=1.0, help="Multiplier applied to every latency")
+    parser.add_argument("--sentences", type=int, default=6, help="Number of sentences in every generated answer")
+    parser.add_argument("--users", type=int, default=50, help="Number of seeded users")
+    parser.add_argument("--videos-per-user", type=int, default=20, help="Number of seeded videos per user")
+    parser.add_argument("--cache", action="store_true", help="Repeat five questions so the result cache is hit")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the latency and failure generators")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Compare the results with this JSON baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed p95 regression as a fraction of the baseline")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="edith-benchmark-") as workdir:
+        backend, profiles = load_app(args, workdir)
+        memory = StageMemory()
+        memory.instrument(backend)
+        results = {"endpoints": {}, "stages": {}}
+        stage_times = {}
+        for endpoint in args.endpoints.split(","):
+            endpoint = endpoint.strip()
+            if endpoint not in ENDPOINTS:
+                parser.error(f"Unknown endpoint: {endpoint}")
+            count = args.video_requests if endpoint == "generate_video" and args.video_requests is not None else args.requests
+            summary, stages = run_endpoint(backend, endpoint, count, args.concurrency, args)
+            results["endpoints"][endpoint] = summary
+            for stage, seconds in stages.items():
+                stage_times.setdefault(stage, []).extend(seconds)
+            print(f"{endpoint}: {json.dumps(summary)}")
+        stage_peaks = memory.peaks()
+        for stage, seconds in sorted(stage_times.items()):
+            results["stages"][stage] = summarize(seconds)
+            if stage in stage_peaks:
+                results["stages"][stage]["peak_rss_mb"] = stage_peaks[stage]
+            print(f"stage {stage}: {json.dumps(results['stages'][stage])}")
+        backend.view_counter.stop()
+
+    results["services"] = {name: profile.stats() for name, profile in profiles.items()}
+    results["config"] = {key: value for key, value in vars(args).items() if key not in ("output", "compare")}
+    results["environment"] = {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()}
+    results["created"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved the results to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No p95 regression above {args.tolerance:.0%} against {args.compare}")
+
+
+if __name__ == "__main__":
+    main()
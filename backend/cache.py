@@ -0,0 +1,193 @@
+import hashlib
+import json
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+
+def make_key(*parts):
+    '''Build a content-addressed cache key from JSON-serializable parts
+    Args:
+        parts: The values the cached result depends on
+    Returns:
+        str: The hex digest of the parts
+    '''
+    payload = json.dumps(parts, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def value_size(value):
+    '''Estimate the memory held by a cached value from the bytes and strings in it
+    Args:
+        value: The value
+    Returns:
+        int: The size in bytes, images and audio make up nearly all of it
+    '''
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(value_size(key) + value_size(item) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(value_size(item) for item in value)
+    return 8
+
+
+class ResultCache:
+    '''A two-tier cache with an in-memory LRU in front of a directory of pickles
+
+    Entries expire after the TTL in both tiers. The memory tier is bounded by
+    entry count and total size and evicts the least recently used entry; the disk
+    tier is bounded the same way using file modification times. Both bounds count
+    in bytes because a single entry may hold every image of a video.
+    '''
+
+    def __init__(self, max_entries:int=64, ttl:float=7 * 24 * 3600, directory:str=None, max_disk_entries:int=512,
+                 max_bytes:int=32 * 1024 * 1024, max_disk_bytes:int=128 * 1024 * 1024):
+        '''Create the cache
+        Args:
+            max_entries (int): The maximum number of entries kept in memory
+            ttl (float): The number of seconds an entry stays valid
+            directory (str): The directory of the disk tier, None to keep everything in memory
+            max_disk_entries (int): The maximum number of entries kept on disk
+            max_bytes (int): The maximum total size of the entries kept in memory
+            max_disk_bytes (int): The maximum total size of the files of the disk tier
+        '''
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.directory = directory
+        self.max_disk_entries = max_disk_entries
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def path(self, key:str):
+        return os.path.join(self.directory, f"{key}.pkl")
+
+    def get(self, key:str):
+        '''Get a value from the cache
+        Args:
+            key (str): The cache key
+        Returns:
+            The cached value, or None on a miss
+        '''
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires, value, size = entry
+                if expires > now:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self.remove_from_memory(key)
+
+        value = self.get_from_disk(key, now)
+        with self.lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        # Promote the disk hit into the memory tier
+        self.set_in_memory(key, value, now)
+        return value
+
+    def get_from_disk(self, key:str, now:float):
+        if not self.directory:
+            return None
+        path = self.path(key)
+        try:
+            if os.path.getmtime(path) + self.ttl <= now:
+                os.remove(path)
+                return None
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+            # Touch the file so the disk tier evicts in least recently used order
+            os.utime(path, None)
+            return value
+        except (OSError, pickle.PickleError, EOFError):
+            return None
+
+    def set(self, key:str, value):
+        '''Store a value in both tiers
+        Args:
+            key (str): The cache key
+            value: The value to store, it must be picklable when a disk tier is used
+        '''
+        now = time.time()
+        self.set_in_memory(key, value, now)
+        if self.directory:
+            self.set_on_disk(key, value)
+
+    def set_in_memory(self, key:str, value, now:float):
+        size = value_size(value)
+        with self.lock:
+            if key in self.entries:
+                self.remove_from_memory(key)
+            # A value larger than the whole tier is only kept on disk
+            if size > self.max_bytes:
+                return
+            self.entries[key] = (now + self.ttl, value, size)
+            self.size += size
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                self.remove_from_memory(next(iter(self.entries)))
+
+    def remove_from_memory(self, key:str):
+        self.size -= self.entries.pop(key)[2]
+
+    def set_on_disk(self, key:str, value):
+        path = self.path(key)
+        # Write to a temporary file first so readers never see a partial pickle
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        self.evict_from_disk()
+
+    def evict_from_disk(self):
+        try:
+            files = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".pkl"):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in files)
+            if len(files) <= self.max_disk_entries and total <= self.max_disk_bytes:
+                return
+            # Remove the least recently used files until both bounds hold
+            files.sort()
+            count = len(files)
+            for _, size, path in files:
+                if count <= self.max_disk_entries and total <= self.max_disk_bytes:
+                    break
+                os.remove(path)
+                count -= 1
+                total -= size
+        except OSError:
+            # Another thread evicted the same file first
+            pass
+
+    def stats(self):
+        '''Get the hit and miss counters of the cache
+        Returns:
+            dict: The number of hits, misses, entries and bytes in memory
+        '''
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries), "bytes": self.size}
+
+    def gauges(self):
+        '''Report the statistics as metric series'''
+        stats = self.stats()
+        return [
+            ("edith_result_cache_entries", {}, stats["entries"]),
+            ("edith_result_cache_bytes", {}, stats["bytes"]),
+            ("edith_result_cache_hits_total", {}, stats["hits"]),
+            ("edith_result_cache_misses_total", {}, stats["misses"]),
+        ]
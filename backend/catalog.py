@@ -0,0 +1,291 @@
+import base64
+import heapq
+import json
+import os
+import re
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+
+
+def tokenize(text:str):
+    '''Split text into lower case word tokens
+    Args:
+        text (str): The text to split
+    Returns:
+        list: The tokens
+    '''
+    return re.findall(r"\w+", text.lower())
+
+
+def encode_cursor(rank:tuple):
+    '''Encode the ranking key of the last video on a page as an opaque cursor
+    Args:
+        rank (tuple): The ranking key of the video
+    Returns:
+        str: The cursor
+    '''
+    return base64.urlsafe_b64encode(json.dumps(list(rank)).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor:str):
+    '''Decode a cursor made by encode_cursor
+    Args:
+        cursor (str): The cursor
+    Returns:
+        tuple: The ranking key the next page starts after
+    '''
+    try:
+        views, link = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return (int(views), str(link))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+
+
+class VideoCatalog:
+    '''An in-process index of every video, searchable by title token prefix and ranked by views
+
+    The catalog is built from Firestore (or a snapshot file) and then kept current
+    through incremental updates, so queries never scan the users collection. A full
+    rescan replaces it from time to time to pick up what other instances wrote.
+    '''
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.reset_index()
+        self.dirty = False
+        # Bumped by every change, responses built from the catalog are cached per version
+        self.version = 0
+        # Unix time of the Firestore scan the catalog was built from
+        self.scanned_at = 0.0
+
+    def reset_index(self):
+        # link -> video dict with the fields of video_store.VIDEO_FIELDS stored in Firestore
+        self.videos = {}
+        # link -> user ID of the owner of the video
+        self.owners = {}
+        # user ID -> links of the videos of the user
+        self.user_links = {}
+        # token -> links of the videos whose title contains the token
+        self.postings = {}
+        # Sorted distinct tokens, used to expand a prefix into the tokens it matches
+        self.tokens = []
+        # Sorted (-views, link) keys, the trending order of every video
+        self.ranking = []
+
+    def add(self, user_id:str, video:dict):
+        '''Add a video to the catalog, or replace the stored copy of it
+        Args:
+            user_id (str): The user ID of the owner of the video
+            video (dict): The video with its 'link', 'title' and 'views'
+        '''
+        with self.lock:
+            link = video["link"]
+            if link in self.videos:
+                self.remove(link)
+            self.videos[link] = dict(video)
+            self.owners[link] = user_id
+            insort(self.ranking, self.rank(link))
+            self.user_links.setdefault(user_id, set()).add(link)
+            for token in set(tokenize(video.get("title", ""))):
+                links = self.postings.get(token)
+                if links is None:
+                    links = self.postings[token] = set()
+                    insort(self.tokens, token)
+                links.add(link)
+            self.dirty = True
+            self.version += 1
+
+    def remove(self, link:str):
+        '''Remove a video from the catalog
+        Args:
+            link (str): The link of the video
+        '''
+        with self.lock:
+            if link not in self.videos:
+                return
+            self.unrank(link)
+            video = self.videos.pop(link)
+            user_id = self.owners.pop(link)
+            self.user_links[user_id].discard(link)
+            for token in set(tokenize(video.get("title", ""))):
+                links = self.postings[token]
+                links.discard(link)
+                if not links:
+                    del self.postings[token]
+                    del self.tokens[bisect_left(self.tokens, token)]
+            self.dirty = True
+            self.version += 1
+
+    def replace_user(self, user_id:str, videos:list):
+        '''Replace every video of a user, used when a whole user document is read
+        Args:
+            user_id (str): The user ID
+            videos (list): The current videos of the user
+        '''
+        with self.lock:
+            for link in list(self.user_links.get(user_id, ())):
+                self.remove(link)
+            for video in videos:
+                self.add(user_id, video)
+
+    def replace_all(self, videos:list, scanned_at:float):
+        '''Replace every video with the result of a full Firestore scan
+        Args:
+            videos (list): Pairs of the user ID of the owner and the video
+            scanned_at (float): The Unix time the scan started
+        '''
+        with self.lock:
+            self.reset_index()
+            for user_id, video in videos:
+                self.add(user_id, video)
+            self.scanned_at = scanned_at
+            self.dirty = True
+            self.version += 1
+
+    def add_views(self, counts:dict):
+        '''Add views to videos, as one change of the catalog
+        Args:
+            counts (dict): The number of views to add by video link
+        '''
+        with self.lock:
+            changed = False
+            for link, count in counts.items():
+                video = self.videos.get(link)
+                if video is not None and count:
+                    self.unrank(link)
+                    video["views"] = video.get("views", 0) + count
+                    insort(self.ranking, self.rank(link))
+                    changed = True
+            # One version per batch of views, so cached listings are not invalidated by every view
+            if changed:
+                self.dirty = True
+                self.version += 1
+
+    def update(self, link:str, **fields):
+        '''Change fields of a video other than its title and views
+        Args:
+            link (str): The link of the video
+            fields: The fields to set
+        '''
+        with self.lock:
+            video = self.videos.get(link)
+            if video is not None:
+                video.update(fields)
+                self.dirty = True
+                self.version += 1
+
+    def rank(self, link:str):
+        '''Get the key of a video in the trending order, most viewed first'''
+        return (-self.videos[link].get("views", 0), link)
+
+    def unrank(self, link:str):
+        '''Remove a video from the trending order'''
+        del self.ranking[bisect_left(self.ranking, self.rank(link))]
+
+    def feed(self, limit:int, cursor:str=None, offset:int=0):
+        '''Get a page of the most viewed videos
+        Args:
+            limit (int): The maximum number of videos to return
+            cursor (str): The cursor returned with the previous page
+            offset (int): The number of videos to skip when no cursor is given
+        Returns:
+            tuple: The videos of the page, and the cursor of the next page or None
+        '''
+        with self.lock:
+            if cursor:
+                views, link = decode_cursor(cursor)
+                start = bisect_right(self.ranking, (-views, link))
+            else:
+                start = offset
+            page = self.ranking[start:start + limit]
+            videos = [dict(self.videos[link]) for _, link in page]
+            more = start + limit < len(self.ranking)
+        next_cursor = encode_cursor((-page[-1][0], page[-1][1])) if page and more else None
+        return videos, next_cursor
+
+    def matching_links(self, query:str):
+        '''Find the videos whose title has a token starting with every token of the query
+        Args:
+            query (str): The search query
+        Returns:
+            set: The links of the matching videos
+        '''
+        query_tokens = tokenize(query)
+        if not query_tokens:
+            return set(self.videos)
+        matches = None
+        # Check the longest, most selective tokens first so the intersection shrinks fast
+        for query_token in sorted(set(query_tokens), key=len, reverse=True):
+            links = set()
+            index = bisect_left(self.tokens, query_token)
+            while index < len(self.tokens) and self.tokens[index].startswith(query_token):
+                links.update(self.postings[self.tokens[index]])
+                index += 1
+            matches = links if matches is None else matches & links
+            if not matches:
+                break
+        return matches
+
+    def search(self, query:str, limit:int=None, offset:int=0):
+        '''Search the video titles
+        Args:
+            query (str): The search query
+            limit (int): The maximum number of videos to return, None for all of them
+            offset (int): The number of top ranked videos to skip
+        Returns:
+            tuple: The matching videos ordered by views, and the total number of matches
+        '''
+        with self.lock:
+            links = self.matching_links(query)
+            if limit is None:
+                ranked = sorted(links, key=self.rank)[offset:]
+            else:
+                # Only the top offset + limit videos have to be ordered
+                ranked = heapq.nsmallest(offset + limit, links, key=self.rank)[offset:]
+            return [dict(self.videos[link]) for link in ranked], len(links)
+
+    def __len__(self):
+        return len(self.videos)
+
+    def save(self, path:str):
+        '''Write the catalog to a JSON snapshot file
+        Args:
+            path (str): The path of the snapshot file
+        '''
+        with self.lock:
+            users = {}
+            for link, video in self.videos.items():
+                users.setdefault(self.owners[link], []).append(video)
+            payload = json.dumps({"scanned_at": self.scanned_at, "users": users})
+            self.dirty = False
+        # Write to a temporary file first so a crash never leaves a partial snapshot
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(payload)
+        os.replace(tmp_path, path)
+
+    def load(self, path:str, max_age:float=None):
+        '''Load the catalog from a JSON snapshot file
+        Args:
+            path (str): The path of the snapshot file
+            max_age (float): The age in seconds after which the snapshot is ignored
+        Returns:
+            bool: Whether the snapshot could be loaded
+        '''
+        try:
+            with open(path) as f:
+                snapshot = json.load(f)
+            users = snapshot["users"]
+        except (OSError, ValueError, KeyError):
+            return False
+        # The age is that of the scan behind the snapshot, not of the file, which a download renews
+        scanned_at = snapshot.get("scanned_at", 0)
+        if max_age is not None and time.time() - scanned_at >= max_age:
+            return False
+        with self.lock:
+            for user_id, videos in users.items():
+                self.replace_user(user_id, videos)
+            self.scanned_at = scanned_at
+            self.dirty = False
+        return True
@@ -0,0 +1,129 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class ChatSession:
+    '''A live chat with the model and the turns it has seen so far'''
+
+    def __init__(self, chat, turns:list):
+        self.chat = chat
+        # Each turn is a dict with the 'role' ('user' or 'model') and the 'text'
+        self.turns = turns
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+
+
+class ChatSessionManager:
+    '''A bounded LRU of live chat sessions keyed by user ID
+
+    Sessions idle for longer than the timeout, or pushed out by newer ones, are
+    dropped from memory. Their compacted history is persisted after every message,
+    so an evicted session, or one that lives on another instance, is rehydrated
+    from the store on the next message.
+    '''
+
+    def __init__(self, create_chat, load_history, save_history, max_sessions:int=256,
+                 idle_timeout:float=1800, max_turns:int=40):
+        '''Create the manager
+        Args:
+            create_chat (callable): Called with a list of turns, returns a new model chat
+            load_history (callable): Called with a user ID, returns the persisted turns
+            save_history (callable): Called with a user ID and the turns to persist
+            max_sessions (int): The maximum number of live sessions
+            idle_timeout (float): The number of seconds after which an idle session is dropped
+            max_turns (int): The number of most recent turns kept when history is compacted
+        '''
+        self.create_chat = create_chat
+        self.load_history = load_history
+        self.save_history = save_history
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.max_turns = max_turns
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, user_id:str):
+        '''Get the live session of a user, rehydrating it from the store if needed
+        Args:
+            user_id (str): The user ID
+        Returns:
+            ChatSession: The session
+        '''
+        with self.lock:
+            self.evict_idle()
+            session = self.sessions.get(user_id)
+            if session is not None:
+                self.sessions.move_to_end(user_id)
+                session.last_used = time.monotonic()
+                return session
+        # Load outside the lock so a slow read does not block other users
+        turns = self.compact(self.load_history(user_id) or [])
+        session = ChatSession(self.create_chat(turns), turns)
+        with self.lock:
+            # Another request may have created the session in the meantime
+            session = self.sessions.setdefault(user_id, session)
+            self.sessions.move_to_end(user_id)
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+        return session
+
+    def evict_idle(self):
+        cutoff = time.monotonic() - self.idle_timeout
+        while self.sessions:
+            user_id, session = next(iter(self.sessions.items()))
+            if session.last_used > cutoff:
+                break
+            del self.sessions[user_id]
+
+    def compact(self, turns:list):
+        '''Keep only the most recent turns, starting with a user turn'''
+        turns = turns[-self.max_turns:]
+        while turns and turns[0]["role"] != "user":
+            turns = turns[1:]
+        return turns
+
+    def record(self, user_id:str, session:ChatSession, message:str, reply:str):
+        '''Add an exchange to the session history and persist it'''
+        session.turns.append({"role": "user", "text": message})
+        session.turns.append({"role": "model", "text": reply})
+        if len(session.turns) > 2 * self.max_turns:
+            # Restart the model chat from the compacted history so requests stay small
+            session.turns = self.compact(session.turns)
+            session.chat = self.create_chat(session.turns)
+        session.last_used = time.monotonic()
+        self.save_history(user_id, self.compact(session.turns))
+
+    def send(self, user_id:str, message:str, read_text):
+        '''Send a message and wait for the complete reply
+        Args:
+            user_id (str): The user ID
+            message (str): The message
+            read_text (callable): Called with the model response, returns its text
+        Returns:
+            str: The reply
+        '''
+        session = self.get(user_id)
+        # Messages of one user are answered in order
+        with session.lock:
+            reply = read_text(session.chat.send_message(message))
+            self.record(user_id, session, message, reply)
+        return reply
+
+    def stream(self, user_id:str, message:str):
+        '''Send a message and yield the reply as it is generated
+        Args:
+            user_id (str): The user ID
+            message (str): The message
+        Returns:
+            generator: The text chunks of the reply
+        '''
+        session = self.get(user_id)
+        with session.lock:
+            chunks = []
+            for chunk in session.chat.send_message_stream(message):
+                if chunk.text:
+                    chunks.append(chunk.text)
+                    yield chunk.text
+            # Only a reply that streamed to the end becomes part of the history
+            self.record(user_id, session, message, "".join(chunks))
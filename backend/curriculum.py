@@ -0,0 +1,167 @@
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from telemetry import count_firestore
+
+
+class CurriculumSnapshot:
+    '''The learning-path tree of the domains collection, kept in memory as ready-to-send JSON
+
+    The tree is fetched level by level, with every collection of a level streamed
+    concurrently and the subcollections of every document listed concurrently, so a
+    rebuild costs one round trip per level instead of one per document. A changed
+    domain is refetched on its own and spliced into the tree.
+    '''
+
+    def __init__(self, get_collection, dumps=None, ttl:float=3600, max_workers:int=8, listen:bool=False):
+        '''Create the snapshot, nothing is fetched until it is first read
+        Args:
+            get_collection (callable): Returns the reference of the root collection
+            dumps (callable): Serializes the tree into a JSON string, defaults to json.dumps
+            ttl (float): The number of seconds after which the tree is refetched in the background
+            max_workers (int): The maximum number of Firestore reads in flight at once
+            listen (bool): Follow the domain documents once the tree is fetched, and refetch the ones that change
+        '''
+        self.get_collection = get_collection
+        self.dumps = dumps or (lambda tree: json.dumps(tree, default=str))
+        self.ttl = ttl
+        self.max_workers = max_workers
+        self.listen = listen
+        self.tree = None
+        self.body = None
+        self.etag = None
+        self.loaded = 0.0
+        self.refreshing = False
+        self.lock = threading.Lock()
+        self.fetch_lock = threading.Lock()
+        self.listening = False
+
+    def fill(self, executor, collections:list):
+        '''Fetch collections and everything below them, one level at a time
+        Args:
+            executor (ThreadPoolExecutor): The pool the reads run on
+            collections (list): Pairs of the dictionary to fill and the collection reference
+        '''
+        while collections:
+            streamed = list(executor.map(lambda ref: list(ref.stream()), [ref for _, ref in collections]))
+            count_firestore('read', sum(len(docs) for docs in streamed))
+            documents = []
+            for (target, _), docs in zip(collections, streamed):
+                for doc in docs:
+                    target[doc.id] = doc.to_dict() or {}
+                    documents.append((target[doc.id], doc.reference))
+            collections = self.subcollections(executor, documents)
+
+    def subcollections(self, executor, documents:list):
+        '''List the subcollections of documents concurrently
+        Args:
+            executor (ThreadPoolExecutor): The pool the reads run on
+            documents (list): Pairs of the document data and the document reference
+        Returns:
+            list: Pairs of the dictionary to fill and the collection reference, for the next level
+        '''
+        listed = executor.map(lambda ref: list(ref.collections()), [ref for _, ref in documents])
+        collections = []
+        for (data, _), subs in zip(documents, listed):
+            for sub in subs:
+                data[sub.id] = {}
+                collections.append((data[sub.id], sub))
+        return collections
+
+    def fetch(self):
+        '''Fetch the whole tree
+        Returns:
+            dict: The documents by ID, with their subcollections nested under the subcollection names
+        '''
+        tree = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            self.fill(executor, [(tree, self.get_collection())])
+        return tree
+
+    def fetch_domain(self, domain_id:str):
+        '''Fetch a single domain and everything below it
+        Args:
+            domain_id (str): The ID of the domain document
+        Returns:
+            dict: The domain, or None if it was deleted
+        '''
+        doc = self.get_collection().document(domain_id).get()
+        count_firestore('read')
+        if not doc.exists:
+            return None
+        data = doc.to_dict() or {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            self.fill(executor, self.subcollections(executor, [(data, doc.reference)]))
+        return data
+
+    def publish(self, tree:dict):
+        '''Serialize a tree and make it the one that is served'''
+        body = self.dumps(tree).encode('utf-8')
+        etag = hashlib.sha1(body).hexdigest()[:16]
+        with self.lock:
+            self.tree, self.body, self.etag = tree, body, etag
+            self.loaded = time.monotonic()
+
+    def refresh(self):
+        '''Refetch the whole tree
+        Returns:
+            None
+        '''
+        try:
+            self.publish(self.fetch())
+        finally:
+            self.refreshing = False
+
+    def refresh_domain(self, domain_id:str):
+        '''Refetch one domain and splice it into the tree
+        Args:
+            domain_id (str): The ID of the changed domain document
+        '''
+        if self.tree is None:
+            return
+        data = self.fetch_domain(domain_id)
+        # The served tree is never mutated, a changed domain produces a new top level
+        tree = dict(self.tree)
+        if data is None:
+            tree.pop(domain_id, None)
+        else:
+            tree[domain_id] = data
+        self.publish(tree)
+
+    def get(self):
+        '''Get the serialized tree, fetching it on first use
+        Returns:
+            tuple: The JSON body as bytes and its ETag
+        '''
+        if self.body is None:
+            with self.fetch_lock:
+                # Only the first request fetches, the others wait for its result
+                if self.body is None:
+                    self.publish(self.fetch())
+                    if self.listen:
+                        self.get_collection().on_snapshot(self.on_snapshot)
+        elif time.monotonic() - self.loaded > self.ttl:
+            with self.lock:
+                start = not self.refreshing
+                self.refreshing = True
+            if start:
+                # Serve the current tree while a fresh one is fetched
+                threading.Thread(target=self.refresh, daemon=True).start()
+        with self.lock:
+            return self.body, self.etag
+
+    def on_snapshot(self, docs, changes, read_time):
+        '''Refetch the domains whose documents changed
+        Args:
+            docs (list): The current domain documents
+            changes (list): The document changes since the last snapshot
+            read_time: The time the snapshot was read at
+        '''
+        # The first snapshot reports every domain as added, the tree is fetched on its own
+        if not self.listening:
+            self.listening = True
+            return
+        for change in changes:
+            self.refresh_domain(change.document.id)
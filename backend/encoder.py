@@ -0,0 +1,189 @@
+import os
+import subprocess
+import threading
+
+
+# Output settings of the slideshow encoder, selected by name, all 16:9 like the generated images
+ENCODER_PRESETS = {
+    # Balanced quality for the published videos
+    'final': {'width': 1024, 'height': 576, 'x264_preset': 'veryfast', 'crf': 23},
+    # Higher quality at a higher CPU cost, for off-peak renders
+    'quality': {'width': 1024, 'height': 576, 'x264_preset': 'medium', 'crf': 20},
+    # Cheapest encode, for previews
+    'fast': {'width': 1024, 'height': 576, 'x264_preset': 'ultrafast', 'crf': 28},
+    # Quarter of the pixels at the cheapest settings, for drafts that are upgraded later
+    'draft': {'width': 640, 'height': 360, 'x264_preset': 'ultrafast', 'crf': 30},
+}
+
+# Formats of the poster stills shown by the video listings
+POSTER_FORMATS = {
+    'webp': {'codec': ['-c:v', 'libwebp', '-quality', '70'], 'extension': '.webp', 'content_type': 'image/webp'},
+    'jpeg': {'codec': ['-c:v', 'mjpeg', '-q:v', '5'], 'extension': '.jpg', 'content_type': 'image/jpeg'},
+}
+
+
+def scale_filter(settings:dict):
+    '''Build the filter that fits an image into the frame without distorting it
+    Args:
+        settings (dict): An entry of ENCODER_PRESETS
+    Returns:
+        str: The ffmpeg video filter
+    '''
+    width, height = settings['width'], settings['height']
+    # Images of another shape are letterboxed instead of stretched
+    return (f"scale={width}:{height}:force_original_aspect_ratio=decrease,"
+            f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,format=yuv420p")
+
+
+def write_concat_list(path:str, image_paths:list, durations:list):
+    '''Write an ffconcat file that shows each image for its duration
+    Args:
+        path (str): The path of the list file to write
+        image_paths (list): The paths of the images, in order
+        durations (list): The number of seconds to show each image for
+    Returns:
+        None
+    '''
+    lines = ["ffconcat version 1.0"]
+    for image_path, duration in zip(image_paths, durations):
+        lines.append(f"file '{os.path.abspath(image_path)}'")
+        lines.append(f"duration {max(duration, 0.04):.3f}")
+    # The concat demuxer ignores the duration of the last entry unless the file is repeated
+    lines.append(f"file '{os.path.abspath(image_paths[-1])}'")
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+class SlideshowStream:
+    '''An ffmpeg process encoding still images and an MP3 soundtrack into a fragmented MP4 stream
+
+    Each image is decoded and encoded once with its own duration instead of being
+    repeated at a fixed frame rate, and the MP3 soundtrack is fed through stdin and
+    copied without being decoded. The video is read from stdout as it is encoded,
+    so it never has to be written to disk.
+    '''
+
+    def __init__(self, image_paths:list, durations:list, audio_bytes:bytes, list_path:str, preset:str='final'):
+        '''Start the encoder
+        Args:
+            image_paths (list): The paths of the images, in order
+            durations (list): The number of seconds to show each image for
+            audio_bytes (bytes): The MP3 soundtrack
+            list_path (str): The path to write the ffconcat list to
+            preset (str): The name of an entry in ENCODER_PRESETS
+        '''
+        if not image_paths or len(image_paths) != len(durations):
+            raise ValueError("Every image needs exactly one duration")
+        settings = ENCODER_PRESETS[preset]
+        write_concat_list(list_path, image_paths, durations)
+        command = [
+            "ffmpeg", "-y", "-loglevel", "error",
+            "-f", "concat", "-safe", "0", "-i", list_path,
+            "-f", "mp3", "-i", "pipe:0",
+            "-map", "0:v", "-map", "1:a",
+            "-vf", scale_filter(settings),
+            # Keep one frame per image instead of duplicating frames up to a fixed rate
+            "-fps_mode", "vfr",
+            "-c:v", "libx264", "-preset", settings['x264_preset'], "-tune", "stillimage", "-crf", str(settings['crf']),
+            "-c:a", "copy",
+            # A fragmented MP4 can be written to a pipe because it never seeks back
+            "-movflags", "frag_keyframe+empty_moov+default_base_moof",
+            "-f", "mp4", "pipe:1",
+        ]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.errors = b""
+        # Feed the soundtrack from a thread so stdin and stdout never block each other
+        self.feeder = threading.Thread(target=self.feed, args=(audio_bytes,), daemon=True)
+        self.feeder.start()
+        self.drainer = threading.Thread(target=self.drain, daemon=True)
+        self.drainer.start()
+
+    def feed(self, audio_bytes:bytes):
+        try:
+            self.process.stdin.write(audio_bytes)
+            self.process.stdin.close()
+        except (BrokenPipeError, ValueError):
+            # ffmpeg exited early, the error is reported by close()
+            pass
+
+    def drain(self):
+        self.errors = self.process.stderr.read()
+
+    def read(self, size:int=-1):
+        '''Read encoded MP4 bytes
+        Args:
+            size (int): The maximum number of bytes to read
+        Returns:
+            bytes: The data, empty once the video is complete
+        '''
+        return self.process.stdout.read(size)
+
+    def close(self):
+        '''Wait for the encoder and check that it succeeded'''
+        return_code = self.process.wait()
+        self.feeder.join()
+        self.drainer.join()
+        self.process.stdout.close()
+        if return_code != 0:
+            raise RuntimeError(f"ffmpeg failed: {self.errors.decode('utf-8', 'replace')[-500:]}")
+
+    def kill(self):
+        '''Stop the encoder without waiting for it to finish'''
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+
+
+def encode_poster(image_path:str, output_path:str, width:int=320, image_format:str='webp'):
+    '''Encode a small still of an image, for listings that should not download the video
+    Args:
+        image_path (str): The path of the image
+        output_path (str): The path of the poster to write
+        width (int): The width of the poster, the height keeps the aspect ratio
+        image_format (str): The name of an entry in POSTER_FORMATS
+    Returns:
+        str: The output path
+    '''
+    command = [
+        "ffmpeg", "-y", "-loglevel", "error", "-i", image_path,
+        "-vf", f"scale={width}:-2", "-frames:v", "1",
+        *POSTER_FORMATS[image_format]['codec'], output_path,
+    ]
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {result.stderr.decode('utf-8', 'replace')[-500:]}")
+    return output_path
+
+
+def encode_segment(image_path:str, audio_path:str, duration:float, offset:float, output_path:str, preset:str='final', start:float=0):
+    '''Encode one still image and its narration into an MPEG-TS segment for HLS
+    Args:
+        image_path (str): The path of the image
+        audio_path (str): The path of the MP3 narration of the segment
+        duration (float): The length of the segment in seconds
+        offset (float): The start time of the segment in the whole video, in seconds
+        output_path (str): The path of the segment to write
+        preset (str): The name of an entry in ENCODER_PRESETS
+        start (float): Where the segment starts in the narration, in seconds
+    Returns:
+        str: The output path
+    '''
+    settings = ENCODER_PRESETS[preset]
+    command = [
+        "ffmpeg", "-y", "-loglevel", "error",
+        "-loop", "1", "-framerate", "2", "-i", image_path,
+        # Seek into the narration when a long sentence is split over several segments
+        "-ss", f"{start:.3f}", "-i", audio_path,
+        "-map", "0:v", "-map", "1:a", "-t", f"{duration:.3f}",
+        "-vf", scale_filter(settings),
+        "-c:v", "libx264", "-preset", settings['x264_preset'], "-tune", "stillimage", "-crf", str(settings['crf']),
+        # HLS players expect AAC in transport streams
+        "-c:a", "aac", "-b:a", "96k",
+        # Continue the timestamps of the previous segment so playback is seamless
+        "-output_ts_offset", f"{offset:.3f}", "-muxdelay", "0",
+        "-f", "mpegts", output_path,
+    ]
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {result.stderr.decode('utf-8', 'replace')[-500:]}")
+    return output_path
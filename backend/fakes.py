@@ -0,0 +1,458 @@
+'''In-process stand-ins for Gemini, Imagen, Text-to-Speech, Firestore and Storage
+
+Each fake implements only the part of the client interface the backend uses, and
+waits and fails according to a ServiceProfile so the benchmark can model slow or
+flaky services without touching the network.
+'''
+import json
+import os
+import random
+import struct
+import threading
+import time
+import zlib
+from types import SimpleNamespace
+from firebase_admin import firestore
+from google.api_core.exceptions import AlreadyExists, NotFound
+
+
+class FakeServiceError(Exception):
+    '''A failure injected by a fake service, reported as a retryable 503 like an overloaded backend'''
+
+    code = 503
+
+
+class ServiceProfile:
+    '''The latency and failure rate of a fake service'''
+
+    def __init__(self, name:str, latency:float=0.0, jitter:float=0.0, failure_rate:float=0.0, seed:int=None):
+        '''Create the profile
+        Args:
+            name (str): The name of the service, used in the injected errors
+            latency (float): The mean number of seconds a call takes
+            jitter (float): The most a call deviates from the mean, in seconds
+            failure_rate (float): The fraction of calls that fail
+            seed (int): The seed of the random generator, for repeatable runs
+        '''
+        self.name = name
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.failures = 0
+
+    def wait(self):
+        '''Wait for one call, and raise FakeServiceError if the call is chosen to fail'''
+        with self.lock:
+            self.calls += 1
+            delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+            failed = self.random.random() < self.failure_rate
+            if failed:
+                self.failures += 1
+        if delay:
+            time.sleep(delay)
+        if failed:
+            raise FakeServiceError(f"Injected {self.name} failure")
+
+    def stats(self):
+        return {"calls": self.calls, "failures": self.failures}
+
+
+def solid_png(size:tuple, color:tuple):
+    '''Encode a single-colour RGB image as PNG
+    Args:
+        size (tuple): The width and height
+        color (tuple): The red, green and blue values
+    Returns:
+        bytes: The PNG file
+    '''
+    width, height = size
+    def chunk(kind:bytes, data:bytes):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    # Every row starts with filter type 0
+    rows = (b"\x00" + bytes(color) * width) * height
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(rows)) + chunk(b"IEND", b"")
+
+
+def response(text:str):
+    '''Build a generate_content response carrying some text'''
+    part = SimpleNamespace(text=text)
+    return SimpleNamespace(text=text, candidates=[SimpleNamespace(content=SimpleNamespace(parts=[part]))])
+
+
+class FakeChat:
+    def __init__(self, models, history:list):
+        self.models = models
+        self.history = list(history or [])
+
+    def send_message(self, message:str):
+        self.models.text.wait()
+        self.history.append(message)
+        return response(f"This is reply {len(self.history)} to {message}")
+
+    def send_message_stream(self, message:str):
+        reply = self.send_message(message).text
+        for word in reply.split(" "):
+            yield SimpleNamespace(text=word + " ")
+
+
+class FakeModels:
+    '''Stand-in for genai.Client().models and .chats'''
+
+    def __init__(self, text:ServiceProfile, image:ServiceProfile, sentences:int=6, image_size:tuple=(1024, 576)):
+        '''Create the fake
+        Args:
+            text (ServiceProfile): The profile of the text model
+            image (ServiceProfile): The profile of the image model
+            sentences (int): The number of sentences in every generated answer
+            image_size (tuple): The width and height of the generated images
+        '''
+        self.text = text
+        self.image = image
+        self.sentences = sentences
+        self.image_size = image_size
+        self.images = {}
+        self.lock = threading.Lock()
+
+    def generate_content(self, model:str, contents, config=None):
+        self.text.wait()
+        sentences = [f"Sentence {index + 1} of the answer explains the topic in about ten words" for index in range(self.sentences)]
+        # A request with a response schema gets the structured script
+        if getattr(config, "response_schema", None) is not None:
+            slides = [{"sentence": f"{sentence}.", "image_prompt": f"A scene showing {sentence.lower()}"} for sentence in sentences]
+            return response(json.dumps({"title": "A benchmark video", "slides": slides}))
+        return response(" ".join(f"{sentence}." for sentence in sentences))
+
+    def image_bytes(self, prompt:str):
+        '''Get PNG bytes for a prompt, the same few images are reused to keep the fake cheap'''
+        shade = hash(prompt) % 8
+        with self.lock:
+            if shade not in self.images:
+                self.images[shade] = solid_png(self.image_size, (32 * shade, 96, 255 - 32 * shade))
+            return self.images[shade]
+
+    def generate_images(self, model:str, prompt:str, config=None):
+        self.image.wait()
+        image = SimpleNamespace(image_bytes=self.image_bytes(prompt), mime_type="image/png")
+        return SimpleNamespace(generated_images=[SimpleNamespace(image=image)])
+
+    def create(self, model:str, history:list=None):
+        return FakeChat(self, history)
+
+
+class FakeGenaiClient:
+    def __init__(self, models:FakeModels):
+        self.models = models
+        self.chats = models
+
+
+# A silent MPEG-1 Layer III frame, 128 kbps mono at 44.1 kHz, lasting 1152 samples
+MP3_FRAME = b"\xff\xfb\x90\xc4" + bytes(413)
+MP3_FRAME_SECONDS = 1152 / 44100
+
+
+class FakeTextToSpeech:
+    '''Stand-in for texttospeech.TextToSpeechClient, returning silence as long as the text would take to read'''
+
+    def __init__(self, profile:ServiceProfile, words_per_second:float=2.5):
+        self.profile = profile
+        self.words_per_second = words_per_second
+
+    def synthesize_speech(self, input, voice=None, audio_config=None):
+        self.profile.wait()
+        seconds = max(1, len(input.text.split())) / self.words_per_second
+        return SimpleNamespace(audio_content=MP3_FRAME * max(1, round(seconds / MP3_FRAME_SECONDS)))
+
+
+class FakeNotFound(NotFound):
+    '''Raised when a missing fake document is updated, handled like the NotFound of Firestore'''
+
+
+class FakeAlreadyExists(AlreadyExists):
+    '''Raised when a fake document that exists is created again'''
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data:dict):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self.data = data
+
+    def to_dict(self):
+        return dict(self.data) if self.data is not None else None
+
+
+class FakeCollection:
+    def __init__(self, db, path:tuple):
+        self.db = db
+        self.path = path
+        self.id = path[-1]
+        self.order = None
+        self.filters = ()
+        self.count = None
+
+    @property
+    def parent(self):
+        return FakeDocument(self.db, self.path[:-1]) if len(self.path) > 1 else None
+
+    def document(self, document_id:str):
+        return FakeDocument(self.db, self.path + (document_id,))
+
+    def query(self, **changes):
+        query = FakeCollection(self.db, self.path)
+        query.order, query.filters, query.count = self.order, self.filters, self.count
+        for name, value in changes.items():
+            setattr(query, name, value)
+        return query
+
+    def order_by(self, field:str):
+        return self.query(order=field)
+
+    def where(self, field:str, op:str, value):
+        # Only equality filters are used by the backend
+        return self.query(filters=self.filters + ((field, value),))
+
+    def limit(self, count:int):
+        return self.query(count=count)
+
+    def stream(self):
+        self.db.profile.wait()
+        snapshots = [FakeSnapshot(FakeDocument(self.db, path), data) for path, data in self.db.children(self.path)
+                     if all(data.get(field) == value for field, value in self.filters)]
+        if self.order:
+            snapshots.sort(key=lambda snapshot: snapshot.data.get(self.order) or 0)
+        return iter(snapshots[:self.count] if self.count is not None else snapshots)
+
+
+class FakeCollectionGroup:
+    def __init__(self, db, name:str):
+        self.db = db
+        self.name = name
+
+    def stream(self):
+        self.db.profile.wait()
+        with self.db.lock:
+            items = [(path, dict(data)) for path, data in self.db.documents.items() if path[-2] == self.name]
+        return iter(FakeSnapshot(FakeDocument(self.db, path), data) for path, data in items)
+
+
+class FakeDocument:
+    def __init__(self, db, path:tuple):
+        self.db = db
+        self.path = path
+        self.id = path[-1]
+
+    @property
+    def parent(self):
+        return FakeCollection(self.db, self.path[:-1])
+
+    def collection(self, name:str):
+        return FakeCollection(self.db, self.path + (name,))
+
+    def collections(self):
+        self.db.profile.wait()
+        return [FakeCollection(self.db, self.path + (name,)) for name in self.db.subcollections(self.path)]
+
+    def get(self, transaction=None):
+        self.db.profile.wait()
+        with self.db.lock:
+            data = self.db.documents.get(self.path)
+            return FakeSnapshot(self, dict(data) if data is not None else None)
+
+    def create(self, data:dict):
+        self.db.profile.wait()
+        with self.db.lock:
+            if self.path in self.db.documents:
+                raise FakeAlreadyExists(f"Document already exists: {'/'.join(self.path)}")
+            self.db.write(self.path, data, merge=False)
+
+    def set(self, data:dict, merge:bool=False):
+        self.db.profile.wait()
+        self.db.write(self.path, data, merge=merge and self.path in self.db.documents)
+
+    def update(self, data:dict):
+        self.db.profile.wait()
+        self.db.write(self.path, data, merge=True)
+
+
+class FakeBatch:
+    def __init__(self, db):
+        self.db = db
+        self.writes = []
+
+    def set(self, reference, data:dict):
+        self.writes.append((reference.path, data, False))
+
+    def update(self, reference, data:dict):
+        self.writes.append((reference.path, data, True))
+
+    def commit(self):
+        self.db.profile.wait()
+        with self.db.lock:
+            # Like Firestore, a batch that updates a missing document writes nothing
+            for path, data, merge in self.writes:
+                if merge and path not in self.db.documents:
+                    raise FakeNotFound(f"No document to update: {'/'.join(path)}")
+            for path, data, merge in self.writes:
+                self.db.write(path, data, merge)
+        self.writes = []
+
+
+class FakeTransaction(FakeBatch):
+    '''The part of the Transaction interface that firestore.transactional drives
+
+    The whole fake database is locked from the start of the transaction until it
+    commits or rolls back, so read-modify-write sequences are serialized.
+    '''
+
+    _max_attempts = 1
+    _read_only = False
+
+    def __init__(self, db):
+        super().__init__(db)
+        self._id = None
+
+    @property
+    def in_progress(self):
+        return self._id is not None
+
+    def _clean_up(self):
+        self.writes = []
+
+    def _begin(self, retry_id=None):
+        self.db.lock.acquire()
+        self._id = b"fake-transaction"
+
+    def _commit(self):
+        try:
+            self.commit()
+        finally:
+            self._id = None
+            self.db.lock.release()
+        return []
+
+    def _rollback(self):
+        if self._id is not None:
+            self._id = None
+            self.writes = []
+            self.db.lock.release()
+
+
+class FakeFirestore:
+    '''Stand-in for the Firestore client, keeping every document in a dictionary keyed by its path'''
+
+    def __init__(self, profile:ServiceProfile):
+        self.profile = profile
+        self.documents = {}
+        self.lock = threading.RLock()
+
+    def collection(self, name:str):
+        return FakeCollection(self, (name,))
+
+    def collection_group(self, name:str):
+        return FakeCollectionGroup(self, name)
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def transaction(self):
+        return FakeTransaction(self)
+
+    def children(self, path:tuple):
+        with self.lock:
+            return [(key, dict(data)) for key, data in self.documents.items() if len(key) == len(path) + 1 and key[:-1] == path]
+
+    def subcollections(self, path:tuple):
+        with self.lock:
+            return sorted({key[len(path)] for key in self.documents if len(key) > len(path) + 1 and key[:len(path)] == path})
+
+    def write(self, path:tuple, data:dict, merge:bool):
+        '''Apply a set or an update, resolving the Firestore sentinels'''
+        with self.lock:
+            current = self.documents.get(path)
+            if merge and current is None:
+                raise FakeNotFound(f"No document to update: {'/'.join(path)}")
+            document = dict(current) if merge else {}
+            for field, value in data.items():
+                if value is firestore.DELETE_FIELD:
+                    document.pop(field, None)
+                elif value is firestore.SERVER_TIMESTAMP:
+                    document[field] = time.time()
+                elif isinstance(value, firestore.Increment):
+                    document[field] = document.get(field, 0) + value.value
+                else:
+                    document[field] = value
+            self.documents[path] = document
+
+
+class FakeBlobWriter:
+    def __init__(self, blob):
+        self.blob = blob
+        self.size = 0
+
+    def write(self, data:bytes):
+        self.size += len(data)
+        return len(data)
+
+    def close(self):
+        self.blob.bucket.profile.wait()
+        self.blob.bucket.store(self.blob.name, self.size)
+
+
+class FakeBlob:
+    def __init__(self, bucket, name:str):
+        self.bucket = bucket
+        self.name = name
+        self.cache_control = None
+        self.public_url = f"https://storage.googleapis.com/fake-bucket/{name}"
+
+    def open(self, mode:str="wb", chunk_size:int=None, content_type:str=None):
+        return FakeBlobWriter(self)
+
+    def upload_from_string(self, data, content_type:str=None):
+        self.bucket.profile.wait()
+        self.bucket.store(self.name, len(data))
+
+    def upload_from_filename(self, filename:str, content_type:str=None):
+        self.bucket.profile.wait()
+        self.bucket.store(self.name, os.path.getsize(filename))
+
+    def download_to_filename(self, filename:str):
+        # Only sizes are kept, so there is never any content to download
+        self.bucket.profile.wait()
+        raise FakeNotFound(f"No content kept for {self.name}")
+
+    def make_public(self):
+        self.bucket.profile.wait()
+
+    def delete(self):
+        self.bucket.profile.wait()
+        with self.bucket.lock:
+            self.bucket.sizes.pop(self.name, None)
+
+
+class FakeBucket:
+    '''Stand-in for the Storage bucket, it only remembers the size of each object'''
+
+    def __init__(self, profile:ServiceProfile):
+        self.profile = profile
+        self.sizes = {}
+        self.lock = threading.Lock()
+
+    def blob(self, name:str):
+        return FakeBlob(self, name)
+
+    def copy_blob(self, blob, destination_bucket, new_name:str):
+        self.profile.wait()
+        with self.lock:
+            size = self.sizes[blob.name]
+        destination_bucket.store(new_name, size)
+        return destination_bucket.blob(new_name)
+
+    def store(self, name:str, size:int):
+        with self.lock:
+            self.sizes[name] = size
@@ -0,0 +1,264 @@
+import hashlib
+import random
+import threading
+import time
+from concurrent.futures import Future
+from priority import PriorityGate
+from telemetry import metrics
+
+
+# HTTP status codes of model errors worth retrying, 429 means the quota was hit
+RETRYABLE_CODES = {408, 429, 500, 502, 503, 504}
+
+
+def error_code(error:Exception):
+    '''Get the HTTP status code of a model error, if it has one'''
+    code = getattr(error, "code", None) or getattr(error, "status_code", None)
+    return code if isinstance(code, int) else None
+
+
+def is_retryable(error:Exception):
+    '''Check whether a failed model call may succeed when it is sent again'''
+    return error_code(error) in RETRYABLE_CODES or isinstance(error, (ConnectionError, TimeoutError))
+
+
+class TokenBucket:
+    '''Allows a steady number of calls per second, with short bursts up to the bucket size'''
+
+    def __init__(self, rate:float, burst:float):
+        '''Create a full bucket
+        Args:
+            rate (float): The number of tokens added per second
+            burst (float): The most tokens the bucket holds
+        '''
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        '''Take one token, waiting until one is available
+        Returns:
+            float: The number of seconds spent waiting
+        '''
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class ModelLane:
+    '''The rate limit, adaptive concurrency limit and statistics of one model
+
+    The concurrency limit grows by one call per round of successful calls and is
+    halved whenever the model reports that the quota was hit. Interactive calls
+    get a free slot before batch calls.
+    '''
+
+    def __init__(self, model:str, rate:float, burst:float, max_concurrency:int, min_concurrency:int=1):
+        self.model = model
+        self.bucket = TokenBucket(rate, burst)
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.gate = PriorityGate(max_concurrency)
+        self.counts = {"calls": 0, "retries": 0, "throttled": 0, "failures": 0, "coalesced": 0}
+
+    def acquire(self):
+        '''Wait for a free call slot and a token of the rate limit
+        Returns:
+            bool: Whether the slot is a background one, to pass to release
+        '''
+        start = time.perf_counter()
+        background = self.gate.acquire()
+        self.bucket.acquire()
+        self.count("calls")
+        metrics.observe("edith_model_wait_seconds", time.perf_counter() - start, model=self.model)
+        return background
+
+    def release(self, background:bool=False, throttled:bool=False):
+        '''Free the call slot and adapt the concurrency limit to the outcome of the call
+        Args:
+            background (bool): Whether the slot is a background one
+            throttled (bool): Whether the model rejected the call because of the quota
+        '''
+        with self.gate.condition:
+            if throttled:
+                self.counts["throttled"] += 1
+                self.gate.limit = max(self.min_concurrency, self.gate.limit / 2)
+            else:
+                self.gate.limit = min(self.max_concurrency, self.gate.limit + 1 / self.gate.limit)
+        self.gate.release(background)
+
+    def count(self, name:str):
+        with self.gate.condition:
+            self.counts[name] += 1
+
+    def stats(self):
+        with self.gate.condition:
+            return dict(self.counts, queued=self.gate.queued, in_flight=self.gate.in_flight, limit=round(self.gate.limit, 2))
+
+
+class ModelGateway:
+    '''The single way the backend calls Gemini and Imagen
+
+    Every call goes through the lane of its model, which applies the rate limit and
+    the concurrency limit. A call that fails with a retryable error is sent again
+    after a jittered exponential backoff. Identical concurrent requests share one
+    upstream call.
+    '''
+
+    def __init__(self, get_client, rates:dict=None, default_rate:float=10, burst:float=10,
+                 max_concurrency:int=16, max_attempts:int=4, base_delay:float=0.5, max_delay:float=20):
+        '''Create the gateway
+        Args:
+            get_client (callable): Returns the genai client
+            rates (dict): The calls per second allowed for each model
+            default_rate (float): The calls per second allowed for any other model
+            burst (float): The number of calls a model may receive at once after a quiet period
+            max_concurrency (int): The most calls in flight per model
+            max_attempts (int): The number of times a call is sent before its error is raised
+            base_delay (float): The backoff before the first retry, in seconds, doubled for each retry
+            max_delay (float): The longest backoff, in seconds
+        '''
+        self.get_client = get_client
+        self.rates = rates or {}
+        self.default_rate = default_rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lanes = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+        metrics.add_gauges(self.gauges)
+
+    def lane(self, model:str):
+        with self.lock:
+            lane = self.lanes.get(model)
+            if lane is None:
+                lane = self.lanes[model] = ModelLane(model, self.rates.get(model, self.default_rate), self.burst, self.max_concurrency)
+            return lane
+
+    def backoff(self, attempt:int):
+        '''Get the delay before a retry, with full jitter so retries of many callers spread out'''
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, model:str, func, key:str=None):
+        '''Call a model through its lane
+        Args:
+            model (str): The model name
+            func (callable): Makes the call, without arguments
+            key (str): Concurrent calls with the same key share one upstream call
+        Returns:
+            The result of the call
+        '''
+        if key is not None:
+            return self.coalesce(model, key, lambda: self.call(model, func))
+        lane = self.lane(model)
+        for attempt in range(self.max_attempts):
+            background = lane.acquire()
+            try:
+                result = func()
+            except Exception as e:
+                lane.release(background, throttled=error_code(e) == 429)
+                if not is_retryable(e) or attempt == self.max_attempts - 1:
+                    lane.count("failures")
+                    raise
+                lane.count("retries")
+                time.sleep(self.backoff(attempt))
+                continue
+            lane.release(background)
+            return result
+
+    def coalesce(self, model:str, key:str, func):
+        '''Run a call once for every concurrent caller with the same key'''
+        with self.lock:
+            future = self.pending.get(key)
+            leader = future is None
+            if leader:
+                future = self.pending[key] = Future()
+        if not leader:
+            self.lane(model).count("coalesced")
+            return future.result()
+        try:
+            result = func()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+
+    def request_key(self, *parts):
+        # The configs are pydantic models, their repr lists every field in order
+        return hashlib.sha256(repr(parts).encode("utf-8")).hexdigest()
+
+    def generate_content(self, model:str, contents, config=None):
+        '''Generate content, see genai.Client().models.generate_content'''
+        return self.call(model, lambda: self.get_client().models.generate_content(model=model, contents=contents, config=config),
+                         key=self.request_key("generate_content", model, contents, config))
+
+    def generate_images(self, model:str, prompt:str, config=None):
+        '''Generate images, see genai.Client().models.generate_images'''
+        return self.call(model, lambda: self.get_client().models.generate_images(model=model, prompt=prompt, config=config),
+                         key=self.request_key("generate_images", model, prompt, config))
+
+    def chat(self, chat, model:str):
+        '''Wrap a chat session so its messages go through the lane of its model'''
+        return GatedChat(self, chat, model)
+
+    def stats(self):
+        '''Get the queue depth, concurrency limit and call counts of every model
+        Returns:
+            dict: The statistics by model name
+        '''
+        with self.lock:
+            lanes = list(self.lanes.values())
+        return {lane.model: lane.stats() for lane in lanes}
+
+    def gauges(self):
+        '''Report the statistics as metric series'''
+        series = []
+        for model, stats in self.stats().items():
+            for name in ("queued", "in_flight", "limit"):
+                series.append((f"edith_model_{name}", {"model": model}, stats[name]))
+            for name in ("calls", "retries", "throttled", "failures", "coalesced"):
+                series.append((f"edith_model_{name}_total", {"model": model}, stats[name]))
+        return series
+
+
+class GatedChat:
+    '''A chat session whose messages are rate limited, limited in concurrency and retried'''
+
+    def __init__(self, gateway:ModelGateway, chat, model:str):
+        self.gateway = gateway
+        self.chat = chat
+        self.model = model
+
+    def send_message(self, message:str):
+        # Chat messages are never coalesced, each one extends its own history
+        return self.gateway.call(self.model, lambda: self.chat.send_message(message))
+
+    def send_message_stream(self, message:str):
+        lane = self.gateway.lane(self.model)
+        background = lane.acquire()
+        throttled = False
+        try:
+            yield from self.chat.send_message_stream(message)
+        except Exception as e:
+            throttled = error_code(e) == 429
+            raise
+        finally:
+            lane.release(background, throttled=throttled)
@@ -0,0 +1,51 @@
+class HlsPlaylist:
+    '''An HLS EVENT playlist that grows one segment at a time
+
+    Players reload an EVENT playlist until it is marked as ended, so a client can
+    start playing the first segments while later ones are still being rendered.
+    '''
+
+    def __init__(self, target_duration:int=30):
+        '''Create an empty playlist
+        Args:
+            target_duration (int): The longest segment in seconds, fixed once the playlist is published
+        '''
+        self.target_duration = target_duration
+        self.segments = []
+        self.ended = False
+
+    def add_segment(self, uri:str, duration:float):
+        '''Append a segment
+        Args:
+            uri (str): The URI of the segment, relative to the playlist
+            duration (float): The length of the segment in seconds
+        Raises:
+            ValueError: If the segment is longer than the target duration
+        '''
+        # Players must not see the target duration change, so longer segments have to be split
+        if round(duration) > self.target_duration:
+            raise ValueError(f"A {duration:.3f}s segment is longer than the {self.target_duration}s target duration")
+        self.segments.append((uri, duration))
+
+    def end(self):
+        '''Mark the playlist as complete'''
+        self.ended = True
+
+    def render(self):
+        '''Render the playlist
+        Returns:
+            str: The M3U8 text
+        '''
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:3",
+            "#EXT-X-PLAYLIST-TYPE:EVENT",
+            f"#EXT-X-TARGETDURATION:{self.target_duration}",
+            "#EXT-X-MEDIA-SEQUENCE:0",
+        ]
+        for uri, duration in self.segments:
+            lines.append(f"#EXTINF:{duration:.3f},")
+            lines.append(uri)
+        if self.ended:
+            lines.append("#EXT-X-ENDLIST")
+        return "\n".join(lines) + "\n"
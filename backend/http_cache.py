@@ -0,0 +1,151 @@
+import gzip
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from flask import Response
+from telemetry import metrics
+
+# orjson and brotli are optional, the standard library is used without them
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def dumps(value):
+    '''Serialize a value as compact UTF-8 JSON, with orjson when it is installed
+    Args:
+        value: The value to serialize
+    Returns:
+        bytes: The JSON
+    '''
+    if orjson is not None:
+        return orjson.dumps(value, default=str, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(value, default=str, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class ResponseCache:
+    '''Encoded JSON responses with ETags, for endpoints that are read far more often than their data changes
+
+    A body is serialized and compressed once per version of the data behind it,
+    and kept for each content encoding in an LRU bounded by total size. The ETag is
+    a hash of the body, so it means the same on every instance while versions are
+    only counted within one process. A client that sends the ETag of the current
+    version gets an empty 304 without the body being built again.
+    '''
+
+    def __init__(self, max_bytes:int=32 * 1024 * 1024, min_size:int=1024, gzip_level:int=6, brotli_quality:int=5, max_versions:int=4096):
+        '''Create the cache
+        Args:
+            max_bytes (int): The maximum total size of the kept bodies
+            min_size (int): The smallest body that is compressed
+            gzip_level (int): The gzip compression level
+            brotli_quality (int): The brotli quality, used when brotli is installed
+            max_versions (int): The most ETags of built versions that are remembered
+        '''
+        self.max_bytes = max_bytes
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.entries = OrderedDict()
+        # (name, version) -> ETag of the body built for that version
+        self.etags = OrderedDict()
+        self.max_versions = max_versions
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def encoding_for(self, request):
+        '''Pick the best content encoding the client accepts'''
+        accepted = request.accept_encodings
+        if brotli is not None and accepted["br"]:
+            return "br"
+        if accepted["gzip"]:
+            return "gzip"
+        return "identity"
+
+    def compress(self, body:bytes, encoding:str):
+        if encoding == "br":
+            return brotli.compress(body, quality=self.brotli_quality)
+        # A fixed mtime keeps the compressed bytes the same for the same body
+        return gzip.compress(body, self.gzip_level, mtime=0)
+
+    def get(self, key:tuple):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key:tuple, entry:tuple):
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key)[0])
+            self.entries[key] = entry
+            self.size += len(entry[0])
+            while self.size > self.max_bytes and self.entries:
+                self.size -= len(self.entries.popitem(last=False)[1][0])
+
+    def etag_for(self, name:str, version):
+        with self.lock:
+            etag = self.etags.get((name, version))
+            if etag is not None:
+                self.etags.move_to_end((name, version))
+            return etag
+
+    def remember_etag(self, name:str, version, etag:str):
+        with self.lock:
+            self.etags[(name, version)] = etag
+            while len(self.etags) > self.max_versions:
+                self.etags.popitem(last=False)
+
+    def respond(self, request, name:str, build, version:str=None, cache_control:str="no-cache"):
+        '''Answer a request with a JSON body
+        Args:
+            request (flask.Request): The request
+            name (str): Identifies the resource and its parameters
+            build (callable): Returns the value to send, or its JSON as bytes, only called when nothing is cached
+            version (str): Changes whenever the data behind the body changes, the body is only built
+                once per version, without it the body is built every time, which still saves the transfer
+            cache_control (str): The Cache-Control header of the response
+        Returns:
+            flask.Response: The response, a 304 when the client has the current version
+        '''
+        raw = None
+        etag = self.etag_for(name, version) if version is not None else None
+        if etag is None:
+            raw = self.serialize(build())
+            etag = hashlib.sha1(raw).hexdigest()[:20]
+            if version is not None:
+                self.remember_etag(name, version, etag)
+        # A 304 only applies to reads, POST bodies are always sent
+        if request.method in ("GET", "HEAD") and request.if_none_match.contains_weak(etag):
+            metrics.inc("edith_response_cache_total", result="not_modified")
+            response = Response(status=304)
+        else:
+            encoding = self.encoding_for(request)
+            entry = self.get((name, etag, encoding))
+            metrics.inc("edith_response_cache_total", result="hit" if entry is not None else "miss")
+            if entry is None:
+                if raw is None:
+                    raw = self.serialize(build())
+                # Small bodies are not worth the CPU of compressing them
+                used = encoding if len(raw) >= self.min_size else "identity"
+                entry = (self.compress(raw, used) if used != "identity" else raw, used)
+                self.put((name, etag, encoding), entry)
+            body, used = entry
+            response = Response(body, mimetype="application/json")
+            if used != "identity":
+                response.headers["Content-Encoding"] = used
+        # The ETag names the data, every encoding of it shares the weak ETag
+        response.set_etag(etag, weak=True)
+        response.headers["Cache-Control"] = cache_control
+        response.vary.add("Accept-Encoding")
+        return response
+
+    def serialize(self, value):
+        return value if isinstance(value, bytes) else dumps(value)
@@ -0,0 +1,122 @@
+import re
+import threading
+from collections import Counter, OrderedDict
+
+
+# Words that do not change what an image shows
+STOPWORDS = frozenset("""
+a an the of in on at to for with and or by from into over under its their his her this that these those
+is are be being showing shows depicting depicts featuring image picture photo illustration scene view
+""".split())
+
+
+def prompt_words(prompt:str):
+    '''Reduce a prompt to the set of words that decide what its image shows
+    Args:
+        prompt (str): The image prompt
+    Returns:
+        frozenset: The lower case words without stopwords, plurals made singular
+    '''
+    words = set()
+    for word in re.findall(r"[a-z0-9]+", prompt.lower()):
+        if word in STOPWORDS:
+            continue
+        if len(word) > 4 and word.endswith("ies"):
+            word = word[:-3] + "y"
+        elif len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        words.add(word)
+    return frozenset(words)
+
+
+class ImageLibrary:
+    '''Generated images kept with their prompts, reused for prompts that say nearly the same thing
+
+    Prompts are compared as sets of words by their Jaccard similarity. An inverted
+    index from each word to the prompts containing it means a lookup only scores
+    the prompts that share a word with it. The library is bounded by entry count
+    and total size and evicts the least recently used image.
+    '''
+
+    def __init__(self, threshold:float=0.8, max_entries:int=512, max_bytes:int=96 * 1024 * 1024):
+        '''Create an empty library
+        Args:
+            threshold (float): The lowest similarity at which a stored image is reused, 1 only reuses identical prompts
+            max_entries (int): The maximum number of images kept
+            max_bytes (int): The maximum total size of the images kept
+        '''
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.index = {}
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, prompt:str):
+        '''Find the stored image of the most similar prompt
+        Args:
+            prompt (str): The image prompt
+        Returns:
+            bytes: The image, or None if no stored prompt is similar enough
+        '''
+        words = prompt_words(prompt)
+        with self.lock:
+            best, best_score = None, 0.0
+            if words:
+                # Count the shared words of every prompt that has at least one
+                shared = Counter(key for word in words for key in self.index.get(word, ()))
+                for key, count in shared.items():
+                    score = count / (len(words) + len(key) - count)
+                    if score > best_score:
+                        best, best_score = key, score
+            if best is None or best_score < self.threshold:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(best)
+            self.hits += 1
+            return self.entries[best]
+
+    def add(self, prompt:str, image:bytes):
+        '''Store the image generated for a prompt
+        Args:
+            prompt (str): The image prompt
+            image (bytes): The encoded image
+        '''
+        words = prompt_words(prompt)
+        if not words or self.max_entries <= 0 or len(image) > self.max_bytes:
+            return
+        with self.lock:
+            if words in self.entries:
+                self.remove(words)
+            self.entries[words] = image
+            self.size += len(image)
+            for word in words:
+                self.index.setdefault(word, set()).add(words)
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, key:frozenset):
+        image = self.entries.pop(key)
+        self.size -= len(image)
+        for word in key:
+            keys = self.index[word]
+            keys.discard(key)
+            if not keys:
+                del self.index[word]
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.size, "hits": self.hits, "misses": self.misses}
+
+    def gauges(self):
+        '''Report the statistics as metric series'''
+        stats = self.stats()
+        return [
+            ("edith_image_library_entries", {}, stats["entries"]),
+            ("edith_image_library_bytes", {}, stats["bytes"]),
+            ("edith_image_library_hits_total", {}, stats["hits"]),
+            ("edith_image_library_misses_total", {}, stats["misses"]),
+        ]
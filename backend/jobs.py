@@ -0,0 +1,280 @@
+import heapq
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from priority import INTERACTIVE, prioritized
+
+
+class JobStore:
+    '''SQLite-backed persistence for video generation jobs'''
+
+    def __init__(self, path:str):
+        '''Open the job database, creating the table if needed
+        Args:
+            path (str): The path of the SQLite file, or ':memory:'
+        '''
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock, self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    user_id TEXT NOT NULL,
+                    text TEXT NOT NULL,
+                    options TEXT NOT NULL DEFAULT '{}',
+                    priority INTEGER NOT NULL DEFAULT 0,
+                    batch_id TEXT,
+                    not_before REAL NOT NULL DEFAULT 0,
+                    status TEXT NOT NULL,
+                    stages TEXT NOT NULL,
+                    result TEXT,
+                    error TEXT,
+                    created REAL NOT NULL,
+                    updated REAL NOT NULL
+                )""")
+            # Databases created before jobs had options, priorities or batches get the columns added
+            columns = [row["name"] for row in self.conn.execute("PRAGMA table_info(jobs)")]
+            if "options" not in columns:
+                self.conn.execute("ALTER TABLE jobs ADD COLUMN options TEXT NOT NULL DEFAULT '{}'")
+            if "priority" not in columns:
+                self.conn.execute("ALTER TABLE jobs ADD COLUMN priority INTEGER NOT NULL DEFAULT 0")
+                self.conn.execute("ALTER TABLE jobs ADD COLUMN batch_id TEXT")
+                self.conn.execute("ALTER TABLE jobs ADD COLUMN not_before REAL NOT NULL DEFAULT 0")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_batch ON jobs (batch_id)")
+
+    def to_dict(self, row):
+        '''Convert a database row into the job dictionary returned by the API
+        Args:
+            row (sqlite3.Row): The row to convert
+        Returns:
+            dict: The job
+        '''
+        stages = json.loads(row["stages"])
+        done = sum(1 for status in stages.values() if status == "done")
+        return {
+            "job_id": row["id"],
+            "user_id": row["user_id"],
+            "text": row["text"],
+            "options": json.loads(row["options"]),
+            "priority": row["priority"],
+            "batch_id": row["batch_id"],
+            "not_before": row["not_before"],
+            "status": row["status"],
+            "stages": stages,
+            "progress": round(done / len(stages), 2) if stages else 0.0,
+            "result": json.loads(row["result"]) if row["result"] else None,
+            "error": row["error"],
+            "created": row["created"],
+            "updated": row["updated"],
+        }
+
+    def create(self, user_id:str, text:str, options:dict=None, priority:int=INTERACTIVE, batch_id:str=None, not_before:float=0):
+        '''Create a queued job
+        Args:
+            user_id (str): The user ID the video is generated for
+            text (str): The question to generate the video for
+            options (dict): Settings the runner needs for this job
+            priority (int): The priority of the job, lower runs first
+            batch_id (str): The ID of the batch the job belongs to
+            not_before (float): The Unix time before which the job must not start
+        Returns:
+            dict: The created job
+        '''
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO jobs (id, user_id, text, options, priority, batch_id, not_before, status, stages, created, updated)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, 'queued', '{}', ?, ?)",
+                (job_id, user_id, text, json.dumps(options or {}), priority, batch_id, not_before, now, now))
+        return self.get(job_id)
+
+    def get(self, job_id:str):
+        '''Get a job by its ID
+        Args:
+            job_id (str): The job ID
+        Returns:
+            dict: The job, or None if it does not exist
+        '''
+        with self.lock:
+            row = self.conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self.to_dict(row) if row else None
+
+    def update(self, job_id:str, status:str, result:dict=None, error:str=None):
+        '''Update the status of a job
+        Args:
+            job_id (str): The job ID
+            status (str): One of 'queued', 'running', 'done' or 'failed'
+            result (dict): The result of a finished job
+            error (str): The error message of a failed job
+        '''
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, updated = ? WHERE id = ?",
+                (status, json.dumps(result) if result is not None else None, error, time.time(), job_id))
+
+    def set_stage(self, job_id:str, stage:str, status:str):
+        '''Record the state of a single pipeline stage of a job
+        Args:
+            job_id (str): The job ID
+            stage (str): The stage name
+            status (str): One of 'pending', 'running', 'done' or 'failed'
+        '''
+        with self.lock, self.conn:
+            row = self.conn.execute("SELECT stages FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return
+            stages = json.loads(row["stages"])
+            stages[stage] = status
+            self.conn.execute(
+                "UPDATE jobs SET stages = ?, updated = ? WHERE id = ?",
+                (json.dumps(stages), time.time(), job_id))
+
+    def batch(self, batch_id:str):
+        '''Summarize the progress of a batch
+        Args:
+            batch_id (str): The batch ID
+        Returns:
+            dict: The number of jobs by status and the finished fraction, or None if the batch does not exist
+        '''
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT status, COUNT(*) AS count FROM jobs WHERE batch_id = ? GROUP BY status", (batch_id,)).fetchall()
+        if not rows:
+            return None
+        statuses = {row["status"]: row["count"] for row in rows}
+        total = sum(statuses.values())
+        finished = statuses.get("done", 0) + statuses.get("failed", 0)
+        return {"batch_id": batch_id, "jobs": total, "statuses": statuses, "progress": round(finished / total, 2)}
+
+    def unfinished(self):
+        '''Get every job that was queued or running
+        Returns:
+            list: The unfinished jobs, oldest first
+        '''
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT * FROM jobs WHERE status IN ('queued', 'running') ORDER BY created").fetchall()
+        return [self.to_dict(row) for row in rows]
+
+
+class JobQueue:
+    '''A worker pool that runs jobs from a JobStore in the background
+
+    Jobs start in order of priority, then of their earliest start time, then of
+    creation. Jobs below interactive priority may only occupy some of the workers,
+    so an interactive job never waits for a whole batch to finish.
+    '''
+
+    def __init__(self, store:JobStore, runner, max_workers:int=2, max_background:int=None):
+        '''Create the queue
+        Args:
+            store (JobStore): The store the jobs are persisted in
+            runner (callable): Called with the job and a stage callback, returns the job result
+            max_workers (int): The number of jobs that run at the same time
+            max_background (int): The number of jobs below interactive priority that run at the same time,
+                defaults to all but one of the workers
+        '''
+        self.store = store
+        self.runner = runner
+        self.max_background = max(1, max_workers - 1) if max_background is None else max_background
+        self.background = 0
+        self.heap = []
+        self.condition = threading.Condition()
+        for index in range(max_workers):
+            threading.Thread(target=self.work, name=f"video-job-{index}", daemon=True).start()
+
+    def submit(self, user_id:str, text:str, options:dict=None, priority:int=INTERACTIVE, batch_id:str=None, not_before:float=0):
+        '''Persist a new job and schedule it
+        Args:
+            user_id (str): The user ID the video is generated for
+            text (str): The question to generate the video for
+            options (dict): Settings the runner needs for this job
+            priority (int): The priority of the job, lower runs first
+            batch_id (str): The ID of the batch the job belongs to
+            not_before (float): The Unix time before which the job must not start
+        Returns:
+            dict: The queued job
+        '''
+        job = self.store.create(user_id, text, options, priority=priority, batch_id=batch_id, not_before=not_before)
+        self.schedule(job)
+        return job
+
+    def schedule(self, job:dict):
+        with self.condition:
+            heapq.heappush(self.heap, (job["priority"], job["not_before"], job["created"], job["job_id"]))
+            self.condition.notify_all()
+
+    def next_job(self):
+        '''Wait for the most urgent job that may start now
+        Returns:
+            tuple: The job ID and whether the job runs below interactive priority
+        '''
+        with self.condition:
+            while True:
+                timeout = None
+                if self.heap:
+                    priority, not_before, _, job_id = self.heap[0]
+                    background = priority > INTERACTIVE
+                    delay = not_before - time.time()
+                    # A background job also waits for one of the background workers to finish
+                    if delay <= 0 and not (background and self.background >= self.max_background):
+                        heapq.heappop(self.heap)
+                        if background:
+                            self.background += 1
+                        return job_id, background
+                    if delay > 0:
+                        timeout = delay
+                # A new job or a finished background job wakes the workers up
+                self.condition.wait(timeout)
+
+    def work(self):
+        while True:
+            job_id, background = self.next_job()
+            try:
+                self.run(job_id)
+            finally:
+                if background:
+                    with self.condition:
+                        self.background -= 1
+                        self.condition.notify_all()
+
+    def run(self, job_id:str):
+        '''Run a job and record its outcome
+        Args:
+            job_id (str): The job ID
+        '''
+        job = self.store.get(job_id)
+        if job is None:
+            return
+        self.store.update(job_id, "running")
+        try:
+            # Every call the job makes waits behind the calls of higher priority work
+            with prioritized(job["priority"]):
+                result = self.runner(job, lambda stage, status: self.store.set_stage(job_id, stage, status))
+        except Exception as e:
+            self.store.update(job_id, "failed", error=str(e))
+            return
+        self.store.update(job_id, "done", result=result)
+
+    def recover(self):
+        '''Resume jobs that were still queued when the instance stopped
+
+        Jobs that were already running may have written partial results, so
+        they are failed instead of being run a second time, unless their options
+        mark them as resumable.
+        Returns:
+            int: The number of resumed jobs
+        '''
+        resumed = 0
+        for job in self.store.unfinished():
+            if job["status"] == "running" and not job["options"].get("resumable"):
+                self.store.update(job["job_id"], "failed", error="Interrupted by an instance restart")
+            else:
+                self.store.update(job["job_id"], "queued")
+                self.schedule(job)
+                resumed += 1
+        return resumed
@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+
+
+def image_extension(data:bytes):
+    '''Get the file extension matching the format of encoded image bytes
+    Args:
+        data (bytes): The encoded image
+    Returns:
+        str: '.png', '.jpg' or '.webp'
+    '''
+    if data[:3] == b"\xff\xd8\xff":
+        return ".jpg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return ".webp"
+    return ".png"
+
+
+class MediaWorkspace:
+    '''An isolated scratch directory for the media files of one job
+
+    Every job gets its own directory, so simultaneous videos of the same user never
+    overwrite each other's files, and the directory is removed when the job ends
+    whether it succeeded or failed.
+    '''
+
+    def __init__(self, prefix:str='edith-', root:str=None):
+        '''Create the scratch directory
+        Args:
+            prefix (str): The prefix of the directory name
+            root (str): The directory to create it in, defaults to the system temp directory
+        '''
+        self.path = tempfile.mkdtemp(prefix=prefix, dir=root)
+
+    def file(self, name:str):
+        '''Get the path of a file in the workspace
+        Args:
+            name (str): The file name
+        Returns:
+            str: The path
+        '''
+        return os.path.join(self.path, name)
+
+    def write(self, name:str, data:bytes):
+        '''Write bytes to a file in the workspace
+        Args:
+            name (str): The file name
+            data (bytes): The data to write
+        Returns:
+            str: The path of the written file
+        '''
+        path = self.file(name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def cleanup(self):
+        '''Remove the workspace and everything in it'''
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
+        return False
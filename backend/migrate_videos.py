@@ -0,0 +1,54 @@
+'''Migrate the generated_videos array of every user into the users/{user_id}/videos subcollection
+
+Run it once before deploying the version of app.py that reads through VideoStore:
+
+    python migrate_videos.py --dry-run
+    python migrate_videos.py --drop-array
+'''
+import argparse
+import firebase_admin
+from firebase_admin import credentials, firestore
+from dotenv import load_dotenv
+from video_store import VideoStore
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move the videos of every user into one document per video")
+    parser.add_argument("--user", help="Migrate a single user instead of every user")
+    parser.add_argument("--dry-run", action="store_true", help="Only report what would be migrated")
+    parser.add_argument("--drop-array", action="store_true", help="Delete generated_videos once it has been copied")
+    parser.add_argument("--force", action="store_true", help="Migrate users that are already marked as migrated")
+    parser.add_argument("--batch-size", type=int, default=400, help="Number of writes per batch, at most 500")
+    args = parser.parse_args()
+
+    load_dotenv()
+    # Initialize the app with the same credentials as the server
+    firebase_admin.initialize_app(credentials.Certificate("service.json"))
+    db = firestore.client()
+    store = VideoStore(lambda: db)
+
+    if args.user:
+        users = [db.collection("users").document(args.user).get()]
+    else:
+        users = db.collection("users").stream()
+
+    migrated_users = 0
+    migrated_videos = 0
+    for user in users:
+        user_dict = user.to_dict() or {}
+        # Copying again would overwrite views counted since the first migration
+        if user_dict.get("videos_migrated") and not args.force:
+            continue
+        video_count = len(user_dict.get("generated_videos", []))
+        if not args.dry_run:
+            store.migrate_user(user.id, drop_array=args.drop_array, batch_size=args.batch_size)
+        print(f"{user.id}: {video_count} videos")
+        migrated_users += 1
+        migrated_videos += video_count
+
+    action = "Would migrate" if args.dry_run else "Migrated"
+    print(f"{action} {migrated_videos} videos of {migrated_users} users")
+
+
+if __name__ == "__main__":
+    main()
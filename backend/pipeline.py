@@ -0,0 +1,117 @@
+import contextvars
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+class Pipeline:
+    '''A dependency graph of stages that runs every stage as soon as its inputs are ready
+
+    Each stage is a function whose positional arguments are the results of the
+    stages (or pipeline inputs) it depends on, so independent branches of the
+    graph run at the same time and the total time is bounded by the critical path.
+    '''
+
+    def __init__(self, max_workers:int=8):
+        '''Create an empty pipeline
+        Args:
+            max_workers (int): The maximum number of stages running at once
+        '''
+        self.max_workers = max_workers
+        self.stages = {}
+
+    def add_stage(self, name:str, func, deps:list=()):
+        '''Add a stage to the pipeline
+        Args:
+            name (str): The name of the stage, used as the key of its result
+            func (callable): The function to run, called with the results of deps in order
+            deps (list): The names of the stages or inputs this stage depends on
+        Returns:
+            Pipeline: The pipeline, so calls can be chained
+        '''
+        if name in self.stages:
+            raise ValueError(f"Stage '{name}' is already defined")
+        self.stages[name] = (func, tuple(deps))
+        return self
+
+    def required_stages(self, inputs:dict, targets:list=None):
+        '''Find the stages that have to run to produce the targets
+        Args:
+            inputs (dict): The values that are already known, by name
+            targets (list): The stages to produce, defaults to every stage
+        Returns:
+            set: The names of the stages to run
+        '''
+        required = set()
+        stack = list(targets if targets is not None else self.stages)
+        while stack:
+            name = stack.pop()
+            # Known values cut the graph, nothing upstream of them has to run
+            if name in inputs or name in required:
+                continue
+            if name not in self.stages:
+                raise KeyError(f"Unknown stage or input '{name}'")
+            required.add(name)
+            stack.extend(self.stages[name][1])
+        return required
+
+    def run(self, inputs:dict=None, targets:list=None, on_stage=None):
+        '''Run the pipeline
+        Args:
+            inputs (dict): The initial values, a stage given here is skipped
+            targets (list): The stages to produce, defaults to every stage
+            on_stage (callable): Called with the stage name and 'pending', 'running',
+                                 'done' or 'failed' whenever a stage changes state
+        Returns:
+            tuple: The results of every input and stage by name, and the
+                   time in seconds spent in each stage that ran
+        '''
+        results = dict(inputs or {})
+        timings = {}
+        pending = self.required_stages(results, targets)
+        running = {}
+
+        def notify(name, status):
+            if on_stage is not None:
+                on_stage(name, status)
+
+        def timed(name, func, args):
+            # Time the stage inside the worker so queueing is not counted
+            notify(name, 'running')
+            start = time.perf_counter()
+            try:
+                result = func(*args)
+            except Exception:
+                notify(name, 'failed')
+                raise
+            finally:
+                timings[name] = round(time.perf_counter() - start, 3)
+            notify(name, 'done')
+            return result
+
+        for name in sorted(pending):
+            notify(name, 'pending')
+
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            while pending or running:
+                # Start every stage whose dependencies have all finished
+                ready = [name for name in pending if all(dep in results for dep in self.stages[name][1])]
+                for name in ready:
+                    func, deps = self.stages[name]
+                    args = [results[dep] for dep in deps]
+                    # Run the stage in a copy of the caller's context so it keeps the trace of the request
+                    running[executor.submit(contextvars.copy_context().run, timed, name, func, args)] = name
+                    pending.discard(name)
+                if not running:
+                    raise ValueError(f"Stages {sorted(pending)} have cyclic dependencies")
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    # Re-raises the exception of a failed stage and stops the run
+                    results[name] = future.result()
+        finally:
+            # Never start new stages after a failure, but let running ones finish
+            executor.shutdown(wait=True, cancel_futures=True)
+
+        return results, timings
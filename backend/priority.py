@@ -0,0 +1,104 @@
+import contextvars
+import threading
+from contextlib import contextmanager
+
+
+# Priorities of work, lower numbers run first
+INTERACTIVE = 0
+# Final encodes of published drafts run ahead of videos made ahead of time
+UPGRADE = 5
+BATCH = 10
+
+# The priority of the work being done in the current context, requests are interactive
+work_priority = contextvars.ContextVar("work_priority", default=INTERACTIVE)
+
+
+def current_priority():
+    return work_priority.get()
+
+
+@contextmanager
+def prioritized(priority:int):
+    '''Run a block, and everything it hands to bound threads, at a priority
+    Args:
+        priority (int): INTERACTIVE, BATCH or any other level, lower runs first
+    '''
+    token = work_priority.set(priority)
+    try:
+        yield
+    finally:
+        work_priority.reset(token)
+
+
+class PriorityGate:
+    '''Limits the number of calls in flight, admitting interactive callers before background ones
+
+    A background caller only starts while no interactive caller is waiting, and
+    background callers never hold more than their share of the slots, so a batch
+    of pre-generated videos always leaves room for the next request.
+    '''
+
+    def __init__(self, limit:float, background_share:float=0.5):
+        '''Create the gate
+        Args:
+            limit (float): The most calls in flight, may be changed while the gate is in use
+            background_share (float): The fraction of the slots background callers may hold
+        '''
+        self.limit = float(limit)
+        self.background_share = background_share
+        self.in_flight = 0
+        self.background_in_flight = 0
+        self.waiting = 0
+        self.background_waiting = 0
+        self.condition = threading.Condition()
+
+    @property
+    def queued(self):
+        return self.waiting + self.background_waiting
+
+    def admits(self, background:bool):
+        if self.in_flight >= int(self.limit):
+            return False
+        if not background:
+            return True
+        return self.waiting == 0 and self.background_in_flight < max(1, int(self.limit * self.background_share))
+
+    def acquire(self):
+        '''Wait for a slot at the priority of the current context
+        Returns:
+            bool: Whether the slot is a background one, to pass to release
+        '''
+        background = current_priority() > INTERACTIVE
+        with self.condition:
+            if background:
+                self.background_waiting += 1
+            else:
+                self.waiting += 1
+            try:
+                while not self.admits(background):
+                    self.condition.wait()
+            finally:
+                if background:
+                    self.background_waiting -= 1
+                else:
+                    self.waiting -= 1
+            self.in_flight += 1
+            if background:
+                self.background_in_flight += 1
+        return background
+
+    def release(self, background:bool=False):
+        with self.condition:
+            self.in_flight -= 1
+            if background:
+                self.background_in_flight -= 1
+            self.condition.notify_all()
+
+    @contextmanager
+    def slot(self):
+        '''Hold a slot for the duration of a block'''
+        background = self.acquire()
+        try:
+            yield
+        finally:
+            self.release(background)
@@ -0,0 +1,56 @@
+import threading
+
+
+class ServiceRegistry:
+    '''Creates shared clients on first use and hands out the same instance to every thread
+
+    Nothing is created at import time, so an instance only pays for the clients
+    the requests it serves actually need.
+    '''
+
+    def __init__(self):
+        self.factories = {}
+        self.instances = {}
+        self.lock = threading.RLock()
+
+    def register(self, name:str, factory):
+        '''Register how to create a service
+        Args:
+            name (str): The name of the service
+            factory (callable): Called without arguments to create the service
+        '''
+        self.factories[name] = factory
+
+    def get(self, name:str):
+        '''Get a service, creating it on first use
+        Args:
+            name (str): The name of the service
+        Returns:
+            The service instance
+        '''
+        instance = self.instances.get(name)
+        if instance is not None:
+            return instance
+        with self.lock:
+            # Another thread may have created it while this one was waiting
+            instance = self.instances.get(name)
+            if instance is None:
+                instance = self.instances[name] = self.factories[name]()
+            return instance
+
+    def override(self, name:str, instance):
+        '''Replace a service with a ready-made instance, for example a fake in a benchmark
+        Args:
+            name (str): The name of the service
+            instance: The instance to hand out
+        '''
+        with self.lock:
+            self.instances[name] = instance
+
+    def warm_up(self, names:list=None):
+        '''Create services ahead of the first request that needs them
+        Args:
+            names (list): The services to create, defaults to every registered service
+        '''
+        for name in names or list(self.factories):
+            self.get(name)
@@ -0,0 +1,263 @@
+import contextvars
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+
+
+# Upper bounds in seconds of the latency histogram buckets, from a cache hit to a full render
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# Log every finished span as a JSON line
+SPAN_LOG = os.getenv('TRACE_LOG', '0') == '1'
+
+logger = logging.getLogger("edith.trace")
+
+# The request or job being served and the endpoint it came in through
+trace_context = contextvars.ContextVar("trace_context", default=(None, None))
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_labels(labels:tuple):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels) + "}"
+
+
+class Metrics:
+    '''Counters and latency histograms rendered in the Prometheus text format'''
+
+    def __init__(self, buckets:tuple=DEFAULT_BUCKETS):
+        '''Create the registry
+        Args:
+            buckets (tuple): The upper bounds of the histogram buckets, in increasing order
+        '''
+        self.buckets = buckets
+        self.counters = {}
+        self.histograms = {}
+        self.sources = []
+        self.lock = threading.Lock()
+
+    def inc(self, name:str, amount:float=1, **labels):
+        '''Add to a counter
+        Args:
+            name (str): The metric name
+            amount (float): The amount to add
+            labels: The label values of the series
+        '''
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name:str, value:float, **labels):
+        '''Record a value in a histogram
+        Args:
+            name (str): The metric name
+            value (float): The observed value, in seconds for latencies
+            labels: The label values of the series
+        '''
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram["buckets"][index] += 1
+                    break
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def add_gauges(self, source):
+        '''Add a source of series whose values are read when the page is rendered
+        Args:
+            source (callable): Returns a list of (name, labels dict, value) tuples
+        '''
+        with self.lock:
+            self.sources.append(source)
+
+    def render(self):
+        '''Render every series in the Prometheus text exposition format
+        Returns:
+            str: The metrics page
+        '''
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, dict(value, buckets=list(value["buckets"]))) for key, value in self.histograms.items())
+            sources = list(self.sources)
+        typed = set()
+        # Every series of a metric has to be listed together
+        gauges = sorted((series for source in sources for series in source()), key=lambda series: series[0])
+        for name, labels, value in gauges:
+            if name not in typed:
+                typed.add(name)
+                # Totals only ever grow, everything else is a current value
+                lines.append(f"# TYPE {name} {'counter' if name.endswith('_total') else 'gauge'}")
+            lines.append(f"{name}{format_labels(tuple(sorted(labels.items())))} {value}")
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        for (name, labels), histogram in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            # Prometheus buckets are cumulative
+            cumulative = 0
+            for bound, count in zip(self.buckets, histogram["buckets"]):
+                cumulative += count
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {histogram['count']}")
+            lines.append(f"{name}_sum{format_labels(labels)} {round(histogram['sum'], 6)}")
+            lines.append(f"{name}_count{format_labels(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+
+# The metrics of this instance, served by /metrics
+metrics = Metrics()
+
+
+def start_trace(request_id:str=None, endpoint:str=None):
+    '''Start tracing a request or a job in the current context
+    Args:
+        request_id (str): The ID of the request or job, a new one is made if not given
+        endpoint (str): The endpoint or kind of job, used as a metric label
+    Returns:
+        Token: The token to pass to end_trace
+    '''
+    return trace_context.set((request_id or uuid.uuid4().hex, endpoint))
+
+
+def end_trace(token):
+    try:
+        trace_context.reset(token)
+    except ValueError:
+        # A streamed response finishes in another context, the trace is simply cleared there
+        trace_context.set((None, None))
+
+
+def current_request_id():
+    return trace_context.get()[0]
+
+
+def current_endpoint():
+    return trace_context.get()[1] or "background"
+
+
+def bind(func):
+    '''Wrap a function so it runs in the trace and priority of the caller, for functions handed to a thread pool
+    Args:
+        func (callable): The function
+    Returns:
+        callable: The wrapped function
+    '''
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        # A context can only be entered by one thread at a time, every call gets its own copy
+        return context.copy().run(func, *args, **kwargs)
+    return run
+
+
+@contextmanager
+def span(name:str):
+    '''Time a block, such as one external call or one encode, as a span of the current trace
+    Args:
+        name (str): The span name, used as a metric label
+    '''
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except Exception:
+        status = "error"
+        metrics.inc("edith_span_errors_total", span=name)
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        metrics.observe("edith_span_seconds", seconds, span=name)
+        if SPAN_LOG:
+            request_id, endpoint = trace_context.get()
+            logger.info(json.dumps({"request_id": request_id, "endpoint": endpoint, "span": name,
+                                    "seconds": round(seconds, 4), "status": status}))
+
+
+def count_firestore(op:str, count:int=1):
+    '''Count Firestore document reads or writes against the current endpoint
+    Args:
+        op (str): 'read' or 'write'
+        count (int): The number of documents
+    '''
+    if count:
+        metrics.inc("edith_firestore_operations_total", count, op=op, endpoint=current_endpoint())
+
+
+class SamplingProfiler:
+    '''Samples the stack of every thread at a fixed interval and counts identical stacks
+
+    The counts are written in the folded format read by flamegraph.pl and speedscope.
+    '''
+
+    def __init__(self, interval:float=0.01):
+        '''Create the profiler
+        Args:
+            interval (float): The number of seconds between samples
+        '''
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def save(self, path:str):
+        '''Write the counted stacks in the folded format
+        Args:
+            path (str): The path of the file to write
+        '''
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+@contextmanager
+def profiled(path:str, interval:float=0.01):
+    '''Sample every thread while a block runs and save the folded stacks
+    Args:
+        path (str): The path of the file to write the stacks to
+        interval (float): The number of seconds between samples
+    '''
+    profiler = SamplingProfiler(interval)
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        profiler.save(path)
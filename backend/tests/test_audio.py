@@ -0,0 +1,96 @@
+import pytest
+from audio import concat_mp3, mp3_duration, parse_frame_header, strip_id3
+
+
+def frame(header:bytes, length:int):
+    '''Build an MP3 frame of silence-like zero bytes after its header'''
+    return header + bytes(length - len(header))
+
+
+# MPEG-1 Layer III, 128 kbps, 44.1 kHz: 1152 samples, 144 * 128000 // 44100 = 417 bytes
+MPEG1 = bytes([0xFF, 0xFB, 0x90, 0x00])
+MPEG1_PADDED = bytes([0xFF, 0xFB, 0x92, 0x00])
+# MPEG-2 Layer III, 64 kbps, 22.05 kHz: 576 samples, 72 * 64000 // 22050 = 208 bytes
+MPEG2 = bytes([0xFF, 0xF3, 0x80, 0x00])
+
+
+def id3_tag(size:int, footer:bool=False):
+    '''Build an ID3v2.4 tag header followed by its body'''
+    synchsafe = bytes([(size >> 21) & 0x7F, (size >> 14) & 0x7F, (size >> 7) & 0x7F, size & 0x7F])
+    flags = 0x10 if footer else 0x00
+    return b"ID3" + bytes([4, 0, flags]) + synchsafe + bytes(size) + (bytes(10) if footer else b"")
+
+
+def test_mpeg1_frame_length():
+    assert parse_frame_header(frame(MPEG1, 417), 0) == (417, 1152 / 44100)
+
+
+def test_mpeg1_padding_adds_a_byte():
+    assert parse_frame_header(frame(MPEG1_PADDED, 418), 0) == (418, 1152 / 44100)
+
+
+def test_mpeg2_frame_length():
+    assert parse_frame_header(frame(MPEG2, 208), 0) == (208, 576 / 22050)
+
+
+@pytest.mark.parametrize("header", [
+    bytes([0xFF, 0xFB, 0x00, 0x00]),  # free format bitrate
+    bytes([0xFF, 0xFB, 0xF0, 0x00]),  # bad bitrate index
+    bytes([0xFF, 0xFB, 0x9C, 0x00]),  # reserved sample rate
+    bytes([0xFF, 0xEB, 0x90, 0x00]),  # reserved version
+    bytes([0xFF, 0xFD, 0x90, 0x00]),  # Layer II
+    bytes([0x00, 0xFB, 0x90, 0x00]),  # no frame sync
+])
+def test_invalid_headers(header):
+    assert parse_frame_header(header + bytes(500), 0) is None
+
+
+def test_header_past_the_end():
+    assert parse_frame_header(MPEG1[:3], 0) is None
+
+
+def test_mp3_duration_sums_frames():
+    data = frame(MPEG1, 417) + frame(MPEG1_PADDED, 418) + frame(MPEG1, 417)
+    assert mp3_duration(data) == pytest.approx(3 * 1152 / 44100)
+
+
+def test_mp3_duration_mpeg2():
+    assert mp3_duration(frame(MPEG2, 208) * 10) == pytest.approx(10 * 576 / 22050)
+
+
+def test_strip_id3():
+    data = frame(MPEG1, 417)
+    assert strip_id3(id3_tag(200) + data) == data
+
+
+def test_strip_id3_with_footer():
+    data = frame(MPEG1, 417)
+    assert strip_id3(id3_tag(300, footer=True) + data) == data
+
+
+def test_strip_id3_without_tag():
+    data = frame(MPEG1, 417)
+    assert strip_id3(data) == data
+
+
+def test_mp3_duration_ignores_id3_tag():
+    # The tag body is long enough to hold several frames, none of them may be counted
+    tag = id3_tag(2000)
+    assert mp3_duration(tag + frame(MPEG1, 417)) == pytest.approx(1152 / 44100)
+
+
+def test_mp3_duration_skips_garbage_between_frames():
+    data = frame(MPEG1, 417) + b"\x00junk\xff\x00" + frame(MPEG1, 417) + b"\x12\x34" + frame(MPEG1, 417)
+    assert mp3_duration(data) == pytest.approx(3 * 1152 / 44100)
+
+
+def test_mp3_duration_of_garbage():
+    assert mp3_duration(b"not an mp3 at all") == 0.0
+
+
+def test_concat_mp3():
+    first = id3_tag(100) + frame(MPEG1, 417) * 2
+    second = id3_tag(50) + frame(MPEG1, 417)
+    joined, durations = concat_mp3([first, second])
+    assert joined == frame(MPEG1, 417) * 3
+    assert durations == pytest.approx([2 * 1152 / 44100, 1152 / 44100])
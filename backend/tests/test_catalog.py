@@ -0,0 +1,56 @@
+import pytest
+from catalog import VideoCatalog, decode_cursor, encode_cursor
+
+
+def make_catalog(views:list):
+    '''Build a catalog with one video per view count, owned by alternating users'''
+    catalog = VideoCatalog()
+    for index, count in enumerate(views):
+        catalog.add(f"user{index % 2}", {"link": f"v{index}", "title": f"Video {index}", "views": count})
+    return catalog
+
+
+def test_cursor_round_trip():
+    assert decode_cursor(encode_cursor((12, "v3"))) == (12, "v3")
+
+
+@pytest.mark.parametrize("cursor", ["", "not base64!", "bm90IGpzb24=", encode_cursor(("many", "v1")), encode_cursor((1,))])
+def test_invalid_cursor(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor)
+
+
+def test_feed_pages_cover_every_video_once():
+    catalog = make_catalog([5, 9, 1, 9, 3, 0, 7])
+    seen = []
+    videos, cursor = catalog.feed(3)
+    seen += videos
+    while cursor:
+        videos, cursor = catalog.feed(3, cursor=cursor)
+        seen += videos
+    assert [video["link"] for video in seen] == ["v1", "v3", "v6", "v0", "v4", "v2", "v5"]
+
+
+def test_feed_cursor_survives_new_views():
+    catalog = make_catalog([5, 4, 3, 2])
+    videos, cursor = catalog.feed(2)
+    assert [video["link"] for video in videos] == ["v0", "v1"]
+    # A video on a later page overtakes the first page, the next page continues after v1
+    catalog.add_views({"v3": 10})
+    videos, cursor = catalog.feed(2, cursor=cursor)
+    assert [video["link"] for video in videos] == ["v2"]
+    assert cursor is None
+
+
+def test_feed_offset_without_cursor():
+    catalog = make_catalog([3, 2, 1])
+    videos, cursor = catalog.feed(5, offset=1)
+    assert [video["link"] for video in videos] == ["v1", "v2"]
+    assert cursor is None
+
+
+def test_search_by_prefix():
+    catalog = make_catalog([1, 2])
+    catalog.add("user0", {"link": "x", "title": "Black holes explained", "views": 0})
+    videos, total = catalog.search("bla ho")
+    assert total == 1 and videos[0]["link"] == "x"
@@ -0,0 +1,59 @@
+import threading
+import time
+from jobs import JobQueue, JobStore
+from priority import BATCH, INTERACTIVE, UPGRADE
+
+
+def wait_until_done(store:JobStore, job_ids:list, timeout:float=5.0):
+    '''Wait for jobs to finish
+    Args:
+        store (JobStore): The store the jobs are persisted in
+        job_ids (list): The job IDs
+        timeout (float): The number of seconds to wait
+    Returns:
+        list: The finished jobs
+    '''
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        jobs = [store.get(job_id) for job_id in job_ids]
+        if all(job["status"] in ("done", "failed") for job in jobs):
+            return jobs
+        time.sleep(0.01)
+    raise TimeoutError("The jobs did not finish")
+
+
+def test_jobs_start_in_priority_order(tmp_path):
+    store = JobStore(str(tmp_path / "jobs.db"))
+    started = threading.Event()
+    release = threading.Event()
+    order = []
+    def runner(job, on_stage):
+        order.append(job["text"])
+        if job["text"] == "first":
+            started.set()
+            release.wait(5)
+        return {}
+    queue = JobQueue(store, runner, max_workers=1)
+    # Hold the only worker while the other jobs queue up
+    jobs = [queue.submit("a", "first")]
+    assert started.wait(5)
+    jobs.append(queue.submit("a", "batch", priority=BATCH))
+    jobs.append(queue.submit("a", "upgrade", priority=UPGRADE))
+    jobs.append(queue.submit("a", "batch 2", priority=BATCH))
+    jobs.append(queue.submit("a", "interactive", priority=INTERACTIVE))
+    release.set()
+    wait_until_done(store, [job["job_id"] for job in jobs])
+    assert order == ["first", "interactive", "upgrade", "batch", "batch 2"]
+
+
+def test_failed_job_records_its_error(tmp_path):
+    store = JobStore(str(tmp_path / "jobs.db"))
+    def runner(job, on_stage):
+        on_stage("render", "running")
+        raise RuntimeError("ffmpeg failed")
+    queue = JobQueue(store, runner, max_workers=1)
+    job_id = queue.submit("a", "question")["job_id"]
+    job, = wait_until_done(store, [job_id])
+    assert job["status"] == "failed"
+    assert job["error"] == "ffmpeg failed"
+    assert job["stages"] == {"render": "running"}
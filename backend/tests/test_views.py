@@ -0,0 +1,83 @@
+from views import ViewCounter
+
+
+class TransientError(Exception):
+    pass
+
+
+def test_flush_coalesces_views_per_user():
+    calls = []
+    counter = ViewCounter(lambda owner, counts: calls.append((owner, dict(counts))), shards=4)
+    for _ in range(3):
+        counter.increment("a", "v1")
+    counter.increment("a", "v2", 2)
+    counter.increment("b", "v3")
+    assert counter.flush() == 6
+    assert sorted(calls) == [("a", {"v1": 3, "v2": 2}), ("b", {"v3": 1})]
+    assert counter.flush() == 0
+
+
+def test_failed_flush_is_retried():
+    attempts = []
+    def flush(owner, counts):
+        attempts.append(dict(counts))
+        if len(attempts) == 1:
+            raise TransientError()
+    counter = ViewCounter(flush, max_attempts=3)
+    counter.increment("a", "v1", 2)
+    assert counter.flush() == 0
+    # The views are buffered again and still count as pending
+    assert counter.pending("v1") == 2
+    counter.increment("a", "v1")
+    assert counter.flush() == 3
+    assert attempts == [{"v1": 2}, {"v1": 3}]
+    assert counter.pending("v1") == 0
+
+
+def test_views_are_dropped_after_max_attempts():
+    def flush(owner, counts):
+        raise TransientError()
+    counter = ViewCounter(flush, max_attempts=2)
+    counter.increment("a", "v1")
+    counter.flush()
+    assert counter.pending("v1") == 1
+    counter.flush()
+    assert counter.pending("v1") == 0
+    assert counter.failures == {}
+
+
+def test_permanent_errors_are_not_retried():
+    def flush(owner, counts):
+        raise ValueError()
+    counter = ViewCounter(flush, retryable=lambda error: isinstance(error, TransientError))
+    counter.increment("a", "v1")
+    counter.flush()
+    assert counter.pending("v1") == 0
+
+
+def test_failing_user_does_not_hold_up_others():
+    written = {}
+    def flush(owner, counts):
+        if owner == "a":
+            raise TransientError()
+        written.update(counts)
+    counter = ViewCounter(flush)
+    counter.increment("a", "v1")
+    counter.increment("b", "v2")
+    assert counter.flush() == 1
+    assert written == {"v2": 1}
+
+
+def test_missing_videos_are_dropped():
+    counter = ViewCounter(lambda owner, counts: ["gone"])
+    counter.increment("a", "v1", 2)
+    counter.increment("a", "gone", 5)
+    assert counter.flush() == 2
+    assert counter.pending("gone") == 0
+
+
+def test_merge_adds_pending_views():
+    counter = ViewCounter(lambda owner, counts: None)
+    counter.increment("a", "v1", 4)
+    assert counter.merge([{"link": "v1", "views": 10}, {"link": "v2"}]) == [
+        {"link": "v1", "views": 14}, {"link": "v2", "views": 0}]
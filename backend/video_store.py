@@ -0,0 +1,224 @@
+import hashlib
+from firebase_admin import firestore
+from google.api_core.exceptions import AlreadyExists, NotFound
+from telemetry import count_firestore
+
+
+# Fields of a video document that are returned by the API
+VIDEO_FIELDS = ("link", "title", "views", "poster", "duration", "size")
+
+
+def video_id(link:str):
+    '''Get the document ID of a video, derived from its link so lookups by link are O(1)
+    Args:
+        link (str): The link of the video
+    Returns:
+        str: The document ID
+    '''
+    return hashlib.sha1(link.encode("utf-8")).hexdigest()
+
+
+def to_video(snapshot):
+    '''Convert a video document into the video dict returned by the API
+    Args:
+        snapshot: The Firestore document snapshot
+    Returns:
+        dict: The video
+    '''
+    return public_fields(snapshot.to_dict())
+
+
+def public_fields(data:dict):
+    '''Keep only the fields of a video that are returned by the API
+    Args:
+        data (dict): The video document
+    Returns:
+        dict: The video
+    '''
+    return {field: data[field] for field in VIDEO_FIELDS if field in data}
+
+
+@firestore.transactional
+def allocate_in_transaction(transaction, user_ref):
+    '''Read and bump the video counter of a user inside a transaction'''
+    user_dict = user_ref.get(transaction=transaction).to_dict() or {}
+    video_count = user_dict.get("video_count", 0)
+    transaction.update(user_ref, {"video_count": video_count + 1})
+    return video_count
+
+
+class VideoStore:
+    '''Storage layer keeping one Firestore document per video in users/{user_id}/videos
+
+    Appending a video or adding views touches a single small document instead of
+    rewriting the whole generated_videos array of the user, so a user document
+    stays the same size no matter how many videos the user has.
+    '''
+
+    def __init__(self, get_db, collection:str="videos"):
+        '''Create the store
+        Args:
+            get_db (callable): Returns the Firestore client, it is only called once the store is used
+            collection (str): The name of the per-user video subcollection
+        '''
+        self.get_db = get_db
+        self.collection = collection
+
+    @property
+    def db(self):
+        return self.get_db()
+
+    def user_ref(self, user_id:str):
+        return self.db.collection("users").document(user_id)
+
+    def video_ref(self, user_id:str, link:str):
+        return self.user_ref(user_id).collection(self.collection).document(video_id(link))
+
+    def ensure_user(self, user_id:str):
+        '''Create the document of a user that has none, such as a service account owning videos'''
+        # A merge leaves the video counter of an existing user untouched
+        self.user_ref(user_id).set({"videos_migrated": True}, merge=True)
+        count_firestore("write")
+
+    def allocate_number(self, user_id:str):
+        '''Atomically allocate the next video number of a user
+        Args:
+            user_id (str): The user ID
+        Returns:
+            int: The allocated number, unique for the user
+        '''
+        number = allocate_in_transaction(self.db.transaction(), self.user_ref(user_id))
+        count_firestore("read")
+        count_firestore("write")
+        return number
+
+    def add_video(self, user_id:str, link:str, title:str, views:int=0, **fields):
+        '''Create the document of a new video, a video that is already recorded is left as it is
+        Args:
+            user_id (str): The user ID of the owner of the video
+            link (str): The link of the video
+            title (str): The title of the video
+            views (int): The initial number of views
+            fields: Any other fields to store with the video
+        Returns:
+            dict: The video, the stored one if the link was already recorded
+        '''
+        video = {"views": views, "link": link, "title": title}
+        video.update(fields)
+        ref = self.video_ref(user_id, link)
+        try:
+            # Create-only, so asking for a cached video again never resets its views or creation time
+            ref.create(dict(video, user_id=user_id, created=firestore.SERVER_TIMESTAMP))
+            count_firestore("write")
+            return video
+        except AlreadyExists:
+            pass
+        existing = ref.get().to_dict()
+        count_firestore("read")
+        return existing
+
+    def add_views(self, user_id:str, counts:dict):
+        '''Atomically add views to videos of a user in one batch
+        Args:
+            user_id (str): The user ID of the owner of the videos
+            counts (dict): The number of views to add by video link
+        Returns:
+            list: The links that have no video, their views are not written
+        '''
+        batch = self.db.batch()
+        for link, count in counts.items():
+            batch.update(self.video_ref(user_id, link), {"views": firestore.Increment(count)})
+        try:
+            batch.commit()
+            count_firestore("write", len(counts))
+            return []
+        except NotFound:
+            pass
+        # One unknown link fails the whole batch, so the videos are written one by one to find it
+        missing = []
+        for link, count in counts.items():
+            try:
+                self.video_ref(user_id, link).update({"views": firestore.Increment(count)})
+                count_firestore("write")
+            except NotFound:
+                missing.append(link)
+        return missing
+
+    def update_video(self, user_id:str, link:str, **fields):
+        '''Change fields of an existing video
+        Args:
+            user_id (str): The user ID of the owner of the video
+            link (str): The link of the video
+            fields: The fields to set
+        '''
+        self.video_ref(user_id, link).update(fields)
+        count_firestore("write")
+
+    def find_video(self, user_id:str, field:str, value):
+        '''Find a video of a user by the value of one of its fields
+        Args:
+            user_id (str): The user ID of the owner of the video
+            field (str): The field to match
+            value: The value the field must have
+        Returns:
+            dict: The video, or None if there is none
+        '''
+        query = self.user_ref(user_id).collection(self.collection).where(field, "==", value).limit(1)
+        snapshots = list(query.stream())
+        # A query that matches nothing is still billed as one read
+        count_firestore("read", max(1, len(snapshots)))
+        return to_video(snapshots[0]) if snapshots else None
+
+    def list_user_videos(self, user_id:str):
+        '''Get the videos of a user in the order they were created
+        Args:
+            user_id (str): The user ID
+        Returns:
+            list: The videos
+        '''
+        query = self.user_ref(user_id).collection(self.collection).order_by("created")
+        videos = [to_video(snapshot) for snapshot in query.stream()]
+        count_firestore("read", len(videos))
+        return videos
+
+    def stream_all(self):
+        '''Stream every video of every user
+        Returns:
+            generator: (user ID, video) pairs
+        '''
+        for snapshot in self.db.collection_group(self.collection).stream():
+            count_firestore("read")
+            yield snapshot.reference.parent.parent.id, to_video(snapshot)
+
+    def migrate_user(self, user_id:str, drop_array:bool=False, batch_size:int=400):
+        '''Copy the generated_videos array of a user into the video subcollection
+
+        The copy is idempotent because the document IDs derive from the links,
+        so an interrupted migration can simply be run again.
+        Args:
+            user_id (str): The user ID
+            drop_array (bool): Whether to delete the array once it has been copied
+            batch_size (int): The number of writes per batch, at most 500
+        Returns:
+            int: The number of videos copied
+        '''
+        user_dict = self.user_ref(user_id).get().to_dict() or {}
+        video_list = user_dict.get("generated_videos", [])
+        batch = self.db.batch()
+        pending = 0
+        for index, video in enumerate(video_list):
+            # Keep the array order, Firestore sorts these numbers before the
+            # timestamps of videos created after the migration
+            data = dict(video, user_id=user_id, created=index)
+            batch.set(self.video_ref(user_id, video["link"]), data)
+            pending += 1
+            if pending == batch_size:
+                batch.commit()
+                batch = self.db.batch()
+                pending = 0
+        updates = {"videos_migrated": True, "video_count": max(user_dict.get("video_count", 0), len(video_list))}
+        if drop_array:
+            updates["generated_videos"] = firestore.DELETE_FIELD
+        batch.update(self.user_ref(user_id), updates)
+        batch.commit()
+        return len(video_list)
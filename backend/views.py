@@ -0,0 +1,161 @@
+import threading
+import zlib
+from telemetry import metrics
+
+
+class ViewCounter:
+    '''A write-behind view counter that coalesces views per video and flushes them in batches
+
+    Views are buffered in striped shards, each with its own lock, so concurrent
+    views of a hot video only contend for one shard lock for a dict update
+    instead of a Firestore document. A background thread flushes the buffered
+    counts on an interval, or earlier once enough views are pending. Views of
+    videos that do not exist, and views that keep failing, are dropped so they
+    never hold up the other views of their owner.
+    '''
+
+    def __init__(self, flush_func, shards:int=16, interval:float=5.0, max_pending:int=500, retryable=None, max_attempts:int=5):
+        '''Create the counter
+        Args:
+            flush_func (callable): Called with a user ID and a dict of link -> views to add,
+                                   must apply the counts atomically and return the links that do not exist
+            shards (int): The number of independently locked buffers
+            interval (float): The number of seconds between flushes
+            max_pending (int): The number of buffered views that triggers an early flush
+            retryable (callable): Tells whether a failed flush may succeed later, defaults to always
+            max_attempts (int): The number of failed flushes in a row after which a user's views are dropped
+        '''
+        self.flush_func = flush_func
+        self.shards = [(threading.Lock(), {}) for _ in range(shards)]
+        self.interval = interval
+        self.max_pending = max_pending
+        self.retryable = retryable or (lambda error: True)
+        self.max_attempts = max_attempts
+        # user ID -> number of failed flushes in a row
+        self.failures = {}
+        self.pending_total = 0
+        # link -> [user ID, count] taken out of the shards and still being written to Firestore
+        self.in_flight = {}
+        self.flush_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def shard(self, link:str):
+        return self.shards[zlib.crc32(link.encode("utf-8")) % len(self.shards)]
+
+    def increment(self, user_id:str, link:str, count:int=1):
+        '''Buffer views of a video
+        Args:
+            user_id (str): The user ID of the owner of the video
+            link (str): The link of the video
+            count (int): The number of views
+        '''
+        lock, deltas = self.shard(link)
+        with lock:
+            entry = deltas.get(link)
+            if entry is None:
+                deltas[link] = [user_id, count]
+            else:
+                entry[1] += count
+            # Shared across shards, so this is only an approximate trigger for an early flush
+            self.pending_total += count
+            full = self.pending_total >= self.max_pending
+        if full:
+            self.wake.set()
+
+    def pending(self, link:str):
+        '''Get the views of a video that are not in Firestore yet
+        Args:
+            link (str): The link of the video
+        Returns:
+            int: The number of pending views
+        '''
+        lock, deltas = self.shard(link)
+        with lock:
+            entry = deltas.get(link)
+            buffered = entry[1] if entry else 0
+        entry = self.in_flight.get(link)
+        return buffered + (entry[1] if entry else 0)
+
+    def merge(self, videos:list):
+        '''Add the pending views to videos read from Firestore
+        Args:
+            videos (list): The videos with their stored 'views'
+        Returns:
+            list: Copies of the videos with the pending views added
+        '''
+        merged = []
+        for video in videos:
+            video = dict(video)
+            video["views"] = video.get("views", 0) + self.pending(video["link"])
+            merged.append(video)
+        return merged
+
+    def flush(self):
+        '''Write every buffered view to Firestore, one call per user
+        Returns:
+            int: The number of views written
+        '''
+        with self.flush_lock:
+            # Swap out every shard so new views keep buffering during the writes
+            batch = {}
+            for lock, deltas in self.shards:
+                with lock:
+                    for link, (owner, count) in deltas.items():
+                        batch.setdefault(owner, {})[link] = count
+                        self.pending_total -= count
+                    deltas.clear()
+            self.in_flight = {link: [owner, count] for owner, counts in batch.items() for link, count in counts.items()}
+
+            written = 0
+            for owner, counts in batch.items():
+                retry = False
+                try:
+                    missing = self.flush_func(owner, counts) or ()
+                    self.failures.pop(owner, None)
+                    written += sum(count for link, count in counts.items() if link not in missing)
+                    if missing:
+                        self.drop(sum(counts[link] for link in missing), "not_found")
+                except Exception as e:
+                    attempts = self.failures.get(owner, 0) + 1
+                    retry = self.retryable(e) and attempts < self.max_attempts
+                    if retry:
+                        self.failures[owner] = attempts
+                    else:
+                        self.failures.pop(owner, None)
+                        self.drop(sum(counts.values()), "failed")
+                for link in counts:
+                    self.in_flight.pop(link, None)
+                if retry:
+                    # Put the counts back so they are retried on the next flush
+                    for link, count in counts.items():
+                        self.increment(owner, link, count)
+            return written
+
+    def drop(self, count:int, reason:str):
+        metrics.inc("edith_views_dropped_total", count, reason=reason)
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            self.flush()
+
+    def start(self):
+        '''Start the background flush thread
+        Returns:
+            ViewCounter: The counter, so calls can be chained
+        '''
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="view-counter", daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        '''Stop the background thread and flush what is left'''
+        self.stopped.set()
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()